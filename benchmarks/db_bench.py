@@ -0,0 +1,247 @@
+"""MongoDB access benchmark for the per-user settings and premium paths.
+
+Seeds a local mongod with a realistic user collection, then replays the
+exact helper/database.py calls each handler makes:
+
+    rename        auto_rename_files + process_rename + add_metadata (13 user reads, sequence check)
+    metadata      the /metadata view (7 user reads)
+    sequence      a sequence session: start, files, coalesced $push flushes, end
+    premiumusers  /premiumusers, a scan of every user
+    broadcast     /broadcast, a scan of every user, count, deletes for blocked users
+
+Every command the driver sends is counted through pymongo's command
+monitoring, so the report has round trips per operation next to latency
+percentiles and ops/sec. Caching or indexing work should move these.
+
+    python -m benchmarks.db_bench --users 100000 --json baseline.json
+    python -m benchmarks.db_bench --users 100000 --reuse --scenario rename --concurrency 200
+
+Run from the repository root against a throwaway database, it is dropped
+and reseeded unless --reuse is given.
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+import datetime
+from collections import Counter
+
+from pymongo import monitoring
+
+from benchmarks.load_test import ROOT, percentile
+
+
+class CommandCounter(monitoring.CommandListener):
+    """Round trips and server time per command name"""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.commands = Counter()
+        self.micros = Counter()
+        self.errors = 0
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self.commands[event.command_name] += 1
+        self.micros[event.command_name] += event.duration_micros
+
+    def failed(self, event):
+        self.commands[event.command_name] += 1
+        self.errors += 1
+
+
+def setup_environment(args):
+    """Point the bot config at the benchmark database before importing it"""
+    os.environ["DB_URL"] = args.mongo
+    os.environ["DB_NAME"] = args.db_name
+    os.environ.setdefault("LOG_CHANNEL", "-1001")
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+
+
+async def seed(db, count, rng, batch=5000):
+    """`count` users shaped like real ones: mostly defaults, some customised, a few premium"""
+    now = datetime.datetime.now(datetime.timezone.utc)
+    docs = []
+    for index in range(count):
+        user = db.new_user(1_000_000 + index)
+        if rng.random() < 0.6:
+            user["format_template"] = "[S{season}E{episode}] Show Name {quality} @Channel"
+        if rng.random() < 0.3:
+            user["caption"] = "📕Name ➠ : {filename}\n\n🔗 Size ➠ : {filesize}\n\n⏰ Duration ➠ : {duration}"
+        if rng.random() < 0.25:
+            user["file_id"] = "AgACAgUAAxkBAAI" + "x" * 60
+        if rng.random() < 0.4:
+            user["media_type"] = rng.choice(["document", "video", "audio"])
+        if rng.random() < 0.2:
+            user.update(title="Encoded by @Channel", author="@Channel", artist="@Channel",
+                        audio="By @Channel", subtitle="By @Channel", video="Encoded By @Channel")
+        if rng.random() < 0.05:
+            expiry = now + datetime.timedelta(days=rng.randint(-30, 90))
+            user["premium"] = dict(is_premium=True, expiry_date=expiry.isoformat(), added_on=now.isoformat(), duration="1mh")
+        docs.append(user)
+        if len(docs) == batch:
+            await db.col.insert_many(docs, ordered=False)
+            docs = []
+    if docs:
+        await db.col.insert_many(docs, ordered=False)
+
+
+async def rename(db, sequence, user_id):
+    # Same order as auto_rename_files -> process_rename -> add_metadata
+    await sequence.is_in_sequence_mode(user_id)
+    await db.is_premium_user(user_id)
+    await db.get_format_template(user_id)
+    await db.get_format_template(user_id)
+    await db.get_caption(user_id)
+    await db.get_thumbnail(user_id)
+    await db.get_media_preference(user_id)
+    for get in (db.get_title, db.get_artist, db.get_author, db.get_video, db.get_audio, db.get_subtitle):
+        await get(user_id)
+
+
+async def metadata(db, sequence, user_id):
+    await db.get_metadata(user_id)
+    for get in (db.get_title, db.get_author, db.get_artist, db.get_video, db.get_audio, db.get_subtitle):
+        await get(user_id)
+
+
+async def sequence_session(db, sequence, user_id, files=24, flush_every=8):
+    # /startsequence, a forwarded batch acknowledged in flushes, /endsequence
+    await sequence.sequence_collection.insert_one({"user_id": user_id, "files": [], "started_at": datetime.datetime.now()})
+    batch = []
+    for index in range(files):
+        await sequence.is_in_sequence_mode(user_id)
+        batch.append({"filename": f"Show S01E{index + 1:02d} 1080p.mkv", "msg_id": index, "chat_id": user_id})
+        if len(batch) == flush_every:
+            await sequence.sequence_collection.update_one({"user_id": user_id}, {"$push": {"files": {"$each": batch}}})
+            batch = []
+    await sequence.sequence_collection.find_one({"user_id": user_id})
+    await sequence.users_collection.update_one(
+        {"user_id": user_id}, {"$inc": {"files_sequenced": files}, "$set": {"username": "bench"}}, upsert=True
+    )
+    await sequence.sequence_collection.delete_one({"user_id": user_id})
+
+
+async def premium_users(db, sequence, user_id):
+    # list_premium_users filters every user document client side
+    now = datetime.datetime.now(datetime.timezone.utc)
+    active = 0
+    async for user in await db.get_all_users():
+        premium = user.get("premium") or {}
+        if premium.get("is_premium") and premium.get("expiry_date"):
+            active += datetime.datetime.fromisoformat(premium["expiry_date"]) > now
+    return active
+
+
+def broadcast(blocked_rate, rng):
+    async def run(db, sequence, user_id):
+        await db.total_users_count()
+        async for user in await db.get_all_users():
+            if rng.random() < blocked_rate:
+                await db.delete_user(user["_id"])
+    return run
+
+
+async def run_scenario(name, operation, count, concurrency, users, db, sequence, counter, rng):
+    latencies = []
+    todo = iter(range(count))
+
+    async def worker():
+        for _ in todo:
+            # A few heavy users send most files
+            user_id = 1_000_000 + min(int(rng.paretovariate(1.2)) - 1, users - 1)
+            start = time.perf_counter()
+            await operation(db, sequence, user_id)
+            latencies.append(time.perf_counter() - start)
+
+    counter.reset()
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(min(concurrency, count))))
+    elapsed = time.perf_counter() - start
+    round_trips = sum(counter.commands.values())
+    return dict(
+        operations=count,
+        elapsed=round(elapsed, 3),
+        ops_per_sec=round(count / elapsed, 2),
+        round_trips=round_trips,
+        round_trips_per_op=round(round_trips / count, 2),
+        p50=round(percentile(latencies, 50) * 1000, 2),
+        p95=round(percentile(latencies, 95) * 1000, 2),
+        p99=round(percentile(latencies, 99) * 1000, 2),
+        commands=dict(counter.commands),
+        server_ms=round(sum(counter.micros.values()) / 1000, 1),
+        failed=counter.errors,
+    )
+
+
+async def main(args):
+    setup_environment(args)
+    counter = CommandCounter()
+    # Must be registered before helper.database creates its client
+    monitoring.register(counter)
+
+    logging.disable(logging.WARNING)
+    from helper.database import codeflixbots
+    import plugins.sequence as sequence
+
+    rng = random.Random(args.seed)
+    await codeflixbots.ping()
+    if not args.reuse:
+        await codeflixbots._client.drop_database(args.db_name)
+        start = time.perf_counter()
+        await seed(codeflixbots, args.users, rng)
+        print(f"seeded {args.users} users in {time.perf_counter() - start:.1f}s")
+    users = await codeflixbots.total_users_count()
+
+    scenarios = {
+        "rename": (rename, args.ops),
+        "metadata": (metadata, args.ops),
+        "sequence": (sequence_session, max(1, args.ops // 20)),
+        "premiumusers": (premium_users, args.scans),
+        # Last, it deletes users
+        "broadcast": (broadcast(args.blocked_rate, rng), args.scans),
+    }
+    names = list(scenarios) if args.scenario == "all" else args.scenario.split(",")
+    results = {}
+    print(f"\n{'scenario':<13} {'ops':>6} {'ops/s':>9} {'trips/op':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for name in names:
+        operation, count = scenarios[name]
+        concurrency = 1 if name in ("premiumusers", "broadcast") else args.concurrency
+        r = results[name] = await run_scenario(name, operation, count, concurrency, users, codeflixbots, sequence, counter, rng)
+        print(f"{name:<13} {r['operations']:>6} {r['ops_per_sec']:>9} {r['round_trips_per_op']:>9}"
+              f" {r['p50']:>9} {r['p95']:>9} {r['p99']:>9}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(dict(config=vars(args), users=users, scenarios=results), f, indent=2)
+
+
+def cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mongo", default="mongodb://127.0.0.1:27017")
+    parser.add_argument("--db-name", default="rename_db_bench")
+    parser.add_argument("--users", type=int, default=100_000)
+    parser.add_argument("--reuse", action="store_true", help="keep the existing benchmark database instead of reseeding")
+    parser.add_argument("--scenario", default="all", help="all, or a comma separated list of rename, metadata, sequence, premiumusers, broadcast")
+    parser.add_argument("--ops", type=int, default=2000, help="renames and /metadata views, sequences run ops/20")
+    parser.add_argument("--scans", type=int, default=3, help="runs of the full-collection scenarios")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--blocked-rate", type=float, default=0.01, help="share of users a broadcast deletes")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--json", help="write the full report to this file")
+    args = parser.parse_args()
+    if args.json:
+        args.json = os.path.abspath(args.json)
+    asyncio.run(main(args))
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,269 @@
+"""In-process fake of the parts of pyrogram.Client the plugins touch.
+
+Transfers go through a shared simulated link per direction, so concurrent
+downloads/uploads compete for bandwidth like they do on the real bot. Every
+API call goes through the rate limiter as a raw query, like Bot.invoke
+sends it, then pays a fixed latency and may raise an injected FloodWait.
+"""
+import os
+import time
+import random
+import asyncio
+import inspect
+import itertools
+import shutil
+from functools import partial
+from types import SimpleNamespace
+from pyrogram import StopPropagation, raw
+from pyrogram.errors import FloodWait
+from helper.rate_limit import rate_limiter
+
+CHUNK_SIZE = 1024 * 1024
+_message_ids = itertools.count(1000)
+
+# Raw function each high-level method ends up invoking
+RAW_METHODS = {
+    "send_message": "messages.SendMessage",
+    "send_photo": "messages.SendMedia",
+    "send_document": "messages.SendMedia",
+    "send_video": "messages.SendMedia",
+    "send_audio": "messages.SendMedia",
+    "copy_message": "messages.ForwardMessages",
+    "edit_message_text": "messages.EditMessage",
+    "edit_message_caption": "messages.EditMessage",
+    "delete_messages": "messages.DeleteMessages",
+    "get_messages": "messages.GetMessages",
+    "get_users": "users.GetUsers",
+    "get_chat_member": "channels.GetParticipant",
+    # File parts use media sessions, which Bot.invoke never sees
+    "download_media": "upload.GetFile",
+    "stream_media": "upload.GetFile",
+}
+
+
+def raw_query(method, chat_id=None):
+    """Stand-in for the raw query of `method`, enough for the rate limiter to route it"""
+    if chat_id is None:
+        peer = None
+    elif chat_id > 0:
+        peer = raw.types.InputPeerUser(user_id=chat_id, access_hash=0)
+    else:
+        peer = raw.types.InputPeerChannel(channel_id=-chat_id, access_hash=0)
+    return SimpleNamespace(QUALNAME=f"functions.{RAW_METHODS.get(method, method)}", peer=peer)
+
+
+class SharedLink:
+    """Serialises byte transfers over a link of fixed bandwidth"""
+
+    def __init__(self, bytes_per_sec):
+        self.bytes_per_sec = bytes_per_sec
+        self._next_free = 0.0
+        self.transferred = 0
+
+    async def consume(self, nbytes):
+        now = time.monotonic()
+        start = max(now, self._next_free)
+        self._next_free = start + nbytes / self.bytes_per_sec
+        self.transferred += nbytes
+        await asyncio.sleep(self._next_free - now)
+
+
+class FakeStats:
+    def __init__(self):
+        self.calls = {}
+        self.flood_waits = 0
+        self.dropped_streams = 0
+
+    def count(self, method):
+        self.calls[method] = self.calls.get(method, 0) + 1
+
+
+class FakeMessage:
+    def __init__(self, client, chat_id, user=None, text=None, media=None, media_type=None, reply_to=None):
+        self._client = client
+        self.id = next(_message_ids)
+        self.chat = SimpleNamespace(id=chat_id)
+        self.from_user = user
+        self.text = text
+        self.caption = None
+        self.command = text.split() if text and text.startswith("/") else None
+        if self.command:
+            self.command[0] = self.command[0][1:]
+        self.reply_to_message = reply_to
+        self.document = media if media_type == "document" else None
+        self.video = media if media_type == "video" else None
+        self.audio = media if media_type == "audio" else None
+        self.photo = None
+        self.empty = False
+
+    async def reply_text(self, text, **kwargs):
+        return await self._client.send_message(self.chat.id, text, **kwargs)
+
+    reply = reply_text
+
+    async def reply_photo(self, photo, **kwargs):
+        return await self._client.send_photo(self.chat.id, photo, **kwargs)
+
+    async def edit(self, text, **kwargs):
+        await self._client._api("edit_message_text", self.chat.id)
+        self.text = text
+        return self
+
+    edit_text = edit
+
+    async def edit_caption(self, caption, **kwargs):
+        await self._client._api("edit_message_caption", self.chat.id)
+        self.caption = caption
+        return self
+
+    async def delete(self):
+        await self._client._api("delete_messages", self.chat.id)
+        return True
+
+    async def copy(self, chat_id, **kwargs):
+        return await self._client.copy_message(chat_id, self.chat.id, self.id)
+
+    def stop_propagation(self):
+        raise StopPropagation
+
+    def continue_propagation(self):
+        pass
+
+
+class FakeClient:
+    """Stands in for the Bot instance handed to handlers"""
+
+    def __init__(self, source_files, download_bps, upload_bps, latency=0.05, flood_rate=0.0, flood_max=5, seed=0, drop_rate=0.0):
+        self.source_files = source_files
+        self.download_link = SharedLink(download_bps)
+        self.upload_link = SharedLink(upload_bps)
+        self.latency = latency
+        self.flood_rate = flood_rate
+        self.flood_max = flood_max
+        self.drop_rate = drop_rate
+        self.random = random.Random(seed)
+        self.stats = FakeStats()
+        self.mention = "[FakeBot](tg://user?id=1)"
+        self.username = "fake_bot"
+        self.uptime = time.time()
+        self.messages = {}
+
+    async def _api(self, method, chat_id=None):
+        query = raw_query(method, chat_id)
+        return await rate_limiter.call(partial(self.invoke, query), query)
+
+    async def invoke(self, query):
+        """The session's side of Bot.invoke: one round trip, FloodWaits injected here"""
+        self.stats.count(query.QUALNAME.split(".", 1)[1])
+        await asyncio.sleep(self.latency)
+        if self.flood_rate and self.random.random() < self.flood_rate:
+            self.stats.flood_waits += 1
+            raise FloodWait(value=self.random.randint(1, self.flood_max))
+
+    def make_user(self, user_id):
+        return SimpleNamespace(
+            id=user_id, first_name=f"user{user_id}", username=f"user{user_id}",
+            mention=f"[user{user_id}](tg://user?id={user_id})",
+        )
+
+    def make_media_message(self, user, media_type, file_name):
+        source = self.source_files[media_type]
+        media = SimpleNamespace(
+            file_id=f"{media_type}-{next(_message_ids)}",
+            file_unique_id=f"u{next(_message_ids)}",
+            file_name=file_name,
+            file_size=os.path.getsize(source),
+            mime_type="video/x-matroska" if media_type != "audio" else "audio/mpeg",
+            thumbs=None,
+            _source=source,
+        )
+        message = FakeMessage(self, user.id, user=user, media=media, media_type=media_type)
+        self.messages[(message.chat.id, message.id)] = message
+        return message
+
+    def make_command(self, user, text, reply_to=None):
+        message = FakeMessage(self, user.id, user=user, text=text, reply_to=reply_to)
+        self.messages[(message.chat.id, message.id)] = message
+        return message
+
+    async def _transfer(self, link, src, dst, size, progress, progress_args):
+        done = 0
+        while done < size:
+            step = min(CHUNK_SIZE, size - done)
+            await link.consume(step)
+            done += step
+            if progress:
+                result = progress(done, size, *progress_args)
+                if inspect.isawaitable(result):
+                    await result
+        if dst:
+            await asyncio.to_thread(shutil.copyfile, src, dst)
+
+    async def download_media(self, message, file_name=None, progress=None, progress_args=()):
+        await self.invoke(raw_query("download_media"))
+        if isinstance(message, str):
+            return None  # Thumbnails are not simulated
+        media = message.document or message.video or message.audio
+        file_name = file_name or os.path.join("downloads", media.file_name)
+        os.makedirs(os.path.dirname(file_name) or ".", exist_ok=True)
+        await self._transfer(self.download_link, media._source, file_name, media.file_size, progress, progress_args)
+        return file_name
+
+    async def stream_media(self, message, limit=0, offset=0):
+        """Like pyrogram's, a dropped connection just ends the stream early"""
+        await self.invoke(raw_query("stream_media"))
+        media = message.document or message.video or message.audio
+        with open(media._source, "rb") as f:
+            f.seek(offset * CHUNK_SIZE)
+            while chunk := f.read(CHUNK_SIZE):
+                if self.drop_rate and self.random.random() < self.drop_rate:
+                    self.stats.dropped_streams += 1
+                    return
+                await self.download_link.consume(len(chunk))
+                yield chunk
+
+    async def _send_media(self, method, chat_id, path, progress=None, progress_args=(), **kwargs):
+        await self._api(method, chat_id)
+        size = os.path.getsize(path)
+        await self._transfer(self.upload_link, path, None, size, progress, progress_args)
+        return FakeMessage(self, chat_id)
+
+    async def send_document(self, chat_id, document, **kwargs):
+        return await self._send_media("send_document", chat_id, document, **kwargs)
+
+    async def send_video(self, chat_id, video, **kwargs):
+        return await self._send_media("send_video", chat_id, video, **kwargs)
+
+    async def send_audio(self, chat_id, audio, **kwargs):
+        return await self._send_media("send_audio", chat_id, audio, **kwargs)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await self._api("send_message", chat_id)
+        message = FakeMessage(self, chat_id, text=text)
+        self.messages[(chat_id, message.id)] = message
+        return message
+
+    async def send_photo(self, chat_id, photo, **kwargs):
+        await self._api("send_photo", chat_id)
+        return FakeMessage(self, chat_id)
+
+    async def copy_message(self, chat_id, from_chat_id, message_id, **kwargs):
+        await self._api("copy_message", chat_id)
+        return FakeMessage(self, chat_id)
+
+    async def get_messages(self, chat_id, message_ids):
+        await self._api("get_messages", chat_id)
+        if isinstance(message_ids, list):
+            return [self.messages.get((chat_id, message_id)) for message_id in message_ids]
+        return self.messages.get((chat_id, message_ids))
+
+    async def get_users(self, user_ids):
+        await self._api("get_users")
+        return self.make_user(int(user_ids))
+
+    async def get_chat_member(self, chat_id, user_id):
+        await self._api("get_chat_member", chat_id)
+        return SimpleNamespace(status="member")
+
+    async def get_me(self):
+        return self.make_user(1)
@@ -0,0 +1,275 @@
+"""In-memory stand-in for the Motor collections the bot uses.
+
+Only the operations the plugins actually call are implemented.
+"""
+import copy
+import itertools
+from types import SimpleNamespace
+from pymongo.errors import DuplicateKeyError
+
+_ids = itertools.count(1)
+
+
+def _get(doc, path):
+    for key in path.split("."):
+        if not isinstance(doc, dict) or key not in doc:
+            return None
+        doc = doc[key]
+    return doc
+
+
+def _set(doc, path, value):
+    keys = path.split(".")
+    for key in keys[:-1]:
+        doc = doc.setdefault(key, {})
+    doc[keys[-1]] = value
+
+
+def _matches(doc, query):
+    for path, cond in query.items():
+        if path == "$or":
+            if not any(_matches(doc, sub) for sub in cond):
+                return False
+            continue
+        value = _get(doc, path)
+        if isinstance(cond, dict) and cond and all(k.startswith("$") for k in cond):
+            for op, arg in cond.items():
+                if op == "$gte" and not (value is not None and value >= arg):
+                    return False
+                if op == "$gt" and not (value is not None and value > arg):
+                    return False
+                if op == "$lte" and not (value is not None and value <= arg):
+                    return False
+                if op == "$lt" and not (value is not None and value < arg):
+                    return False
+                if op == "$in" and value not in arg:
+                    return False
+                if op == "$ne" and value == arg:
+                    return False
+                if op == "$exists" and (value is not None) != arg:
+                    return False
+        elif value != cond:
+            return False
+    return True
+
+
+def _apply_update(doc, update):
+    for path, value in update.get("$set", {}).items():
+        _set(doc, path, copy.deepcopy(value))
+    for path, value in update.get("$inc", {}).items():
+        _set(doc, path, (_get(doc, path) or 0) + value)
+    for path, value in update.get("$push", {}).items():
+        items = value["$each"] if isinstance(value, dict) and "$each" in value else [value]
+        current = _get(doc, path)
+        if current is None:
+            current = []
+            _set(doc, path, current)
+        current.extend(copy.deepcopy(items))
+    for path in update.get("$unset", {}):
+        keys = path.split(".")
+        parent = _get(doc, ".".join(keys[:-1])) if len(keys) > 1 else doc
+        if isinstance(parent, dict):
+            parent.pop(keys[-1], None)
+
+
+class MemoryCursor:
+    def __init__(self, docs):
+        self._docs = docs
+        self._skip = 0
+        self._limit = 0
+
+    def sort(self, key, direction=1):
+        if isinstance(key, list):
+            for name, order in reversed(key):
+                self._docs.sort(key=lambda d: (_get(d, name) is None, _get(d, name)), reverse=order < 0)
+        else:
+            self._docs.sort(key=lambda d: (_get(d, key) is None, _get(d, key)), reverse=direction < 0)
+        return self
+
+    def skip(self, count):
+        self._skip = count
+        return self
+
+    def limit(self, count):
+        self._limit = count
+        return self
+
+    def _window(self):
+        docs = self._docs[self._skip:]
+        return docs[:self._limit] if self._limit else docs
+
+    def __iter__(self):
+        return iter(self._window())
+
+    def __aiter__(self):
+        self._iter = iter(self._window())
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._iter)
+        except StopIteration:
+            raise StopAsyncIteration
+
+    async def to_list(self, length=None):
+        docs = self._window()
+        return docs[:length] if length else docs
+
+
+class MemoryCollection:
+    def __init__(self, name):
+        self.name = name
+        self.docs = {}
+        self.ops = 0
+
+    def _project(self, doc, projection):
+        if not projection:
+            return copy.deepcopy(doc)
+        keep = {key for key, on in projection.items() if on}
+        return {k: copy.deepcopy(v) for k, v in doc.items() if k in keep or k == "_id"}
+
+    def _select(self, query):
+        return [d for d in self.docs.values() if _matches(d, query or {})]
+
+    def _find_one(self, query=None, projection=None, sort=None):
+        self.ops += 1
+        docs = self._select(query)
+        if sort:
+            docs = MemoryCursor(docs).sort(sort)._docs
+        return self._project(docs[0], projection) if docs else None
+
+    def _find(self, query=None, projection=None):
+        self.ops += 1
+        return MemoryCursor([self._project(d, projection) for d in self._select(query)])
+
+    def _insert_one(self, doc):
+        self.ops += 1
+        doc.setdefault("_id", next(_ids))
+        if doc["_id"] in self.docs:
+            raise DuplicateKeyError(f"duplicate key {doc['_id']}")
+        self.docs[doc["_id"]] = copy.deepcopy(doc)
+        return SimpleNamespace(inserted_id=doc["_id"])
+
+    def _insert_many(self, docs, ordered=True):
+        self.ops += 1
+        for doc in docs:
+            doc.setdefault("_id", next(_ids))
+            self.docs[doc["_id"]] = copy.deepcopy(doc)
+        return SimpleNamespace(inserted_ids=[d["_id"] for d in docs])
+
+    def _update(self, query, update, upsert, many):
+        self.ops += 1
+        matched = self._select(query)
+        if not many:
+            matched = matched[:1]
+        for doc in matched:
+            _apply_update(doc, update)
+        if not matched and upsert:
+            doc = {k: v for k, v in query.items() if not k.startswith("$") and not isinstance(v, dict)}
+            _apply_update(doc, update)
+            doc.setdefault("_id", next(_ids))
+            self.docs[doc["_id"]] = doc
+        return SimpleNamespace(matched_count=len(matched), modified_count=len(matched))
+
+    def _update_one(self, query, update, upsert=False):
+        return self._update(query, update, upsert, many=False)
+
+    def _update_many(self, query, update, upsert=False):
+        return self._update(query, update, upsert, many=True)
+
+    def _find_one_and_update(self, query, update, upsert=False, sort=None, return_document=False, projection=None):
+        before = self._find_one(query, sort=sort)
+        self._update({"_id": before["_id"]} if before else query, update, upsert, many=False)
+        if not return_document:
+            return before
+        return self._find_one({"_id": before["_id"]} if before else query, projection)
+
+    def _find_one_and_delete(self, query, sort=None, projection=None):
+        doc = self._find_one(query, projection, sort=sort)
+        if doc:
+            self._delete({"_id": doc["_id"]}, many=False)
+        return doc
+
+    def _delete(self, query, many):
+        self.ops += 1
+        matched = self._select(query)
+        if not many:
+            matched = matched[:1]
+        for doc in matched:
+            del self.docs[doc["_id"]]
+        return SimpleNamespace(deleted_count=len(matched))
+
+    def _delete_one(self, query):
+        return self._delete(query, many=False)
+
+    def _delete_many(self, query):
+        return self._delete(query, many=True)
+
+    def _count_documents(self, query):
+        self.ops += 1
+        return len(self._select(query))
+
+    def _create_index(self, *args, **kwargs):
+        return "index"
+
+    # Motor style coroutine API
+    async def find_one(self, *args, **kwargs):
+        return self._find_one(*args, **kwargs)
+
+    def find(self, *args, **kwargs):
+        return self._find(*args, **kwargs)
+
+    async def insert_one(self, *args, **kwargs):
+        return self._insert_one(*args, **kwargs)
+
+    async def insert_many(self, *args, **kwargs):
+        return self._insert_many(*args, **kwargs)
+
+    async def update_one(self, *args, **kwargs):
+        return self._update_one(*args, **kwargs)
+
+    async def update_many(self, *args, **kwargs):
+        return self._update_many(*args, **kwargs)
+
+    async def find_one_and_update(self, *args, **kwargs):
+        return self._find_one_and_update(*args, **kwargs)
+
+    async def find_one_and_delete(self, *args, **kwargs):
+        return self._find_one_and_delete(*args, **kwargs)
+
+    async def delete_one(self, *args, **kwargs):
+        return self._delete_one(*args, **kwargs)
+
+    async def delete_many(self, *args, **kwargs):
+        return self._delete_many(*args, **kwargs)
+
+    async def count_documents(self, *args, **kwargs):
+        return self._count_documents(*args, **kwargs)
+
+    async def create_index(self, *args, **kwargs):
+        return self._create_index(*args, **kwargs)
+
+
+class MemoryDatabase:
+    def __init__(self):
+        self.collections = {}
+
+    def __getitem__(self, name):
+        if name not in self.collections:
+            self.collections[name] = MemoryCollection(name)
+        return self.collections[name]
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+    async def create_collection(self, name, **kwargs):
+        return self[name]
+
+    async def command(self, *args, **kwargs):
+        return {"ok": 1}
+
+    @property
+    def total_ops(self):
+        return sum(col.ops for col in self.collections.values())
@@ -0,0 +1,196 @@
+"""Micro-benchmarks for the per-file filename hot paths.
+
+Times extract_season_episode, extract_quality, apply_format_template,
+extract_episode_number, check_anti_nsfw and format_caption over a corpus of
+release names, and records every output in a snapshot so a parser or filter
+change can be checked against the current behaviour.
+
+    python -m benchmarks.filename_bench --count 50000 --snapshot before.json
+    python -m benchmarks.filename_bench --count 50000 --check before.json
+
+A real corpus (one filename per line) can be passed with --corpus.
+"""
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+GROUPS = ["SubsPlease", "Erai-raws", "HorribleSubs", "EMBER", "Judas", "ASW", "Anime Time", "Tsundere-Raws", "YTS", "RARBG"]
+SHOWS = [
+    "Overflow", "One Piece", "Jujutsu Kaisen", "Sousou no Frieren", "Dandadan", "Kimetsu no Yaiba",
+    "Shingeki no Kyojin", "Spy x Family", "Assassination Classroom", "Code Geass", "Boku no Hero Academia",
+    "The Last of Us", "Breaking Bad", "House of the Dragon", "Severance", "Mushoku Tensei", "Oshi no Ko",
+    "Blue Lock", "Chainsaw Man", "Vinland Saga", "Re Zero kara Hajimeru Isekai Seikatsu", "86 Eighty Six",
+]
+QUALITIES = ["480p", "720p", "1080p", "2160p", "4K", "1440p", "HDRip", "HDTV", "WEB-DL", "BluRay", ""]
+CODECS = ["x264", "x265", "HEVC", "HEVC 10bit", "AV1", "AVC", ""]
+AUDIO = ["AAC", "FLAC", "Dual Audio", "Multi-Subs", "DDP5.1", "Opus", ""]
+EXTENSIONS = [".mkv", ".mp4", ".avi", ".mp3", ".flac"]
+EPISODE_STYLES = [
+    "S{s:02d}E{e:02d}", "S{s}E{e}", "S{s:02d}EP{e:02d}", "S{s:02d} E{e:02d}", "S{s:02d}-EP{e:02d}",
+    "Season {s} Episode {e}", "[S{s:02d}][E{e:02d}]", "- {e:02d}", "- {e:03d}", "E{e:02d}", "EP {e}",
+    "Episode {e}", "Ep - {e:02d}", "S{s:02d}E{e:02d}-E{e2:02d}", "{e:02d}-{e2:02d}", "S{s:02d}E{e:02d}v2",
+]
+
+
+def generate_corpus(count, seed):
+    """Deterministic anime/TV release names with brackets, CRCs and ranges"""
+    rng = random.Random(seed)
+    names = []
+    for _ in range(count):
+        s, e = rng.randint(1, 12), rng.randint(1, 1100 if rng.random() < 0.1 else 26)
+        episode = rng.choice(EPISODE_STYLES).format(s=s, e=e, e2=e + 1)
+        tags = [t for t in (rng.choice(QUALITIES), rng.choice(CODECS), rng.choice(AUDIO)) if t]
+        show = rng.choice(SHOWS)
+        if rng.random() < 0.5:
+            show = show.replace(" ", rng.choice([".", "_", " "]))
+        crc = f" [{rng.randrange(16 ** 8):08X}]" if rng.random() < 0.6 else ""
+        if rng.random() < 0.7:
+            name = f"[{rng.choice(GROUPS)}] {show} {episode} " + "".join(f"[{t}]" for t in tags) + crc
+        else:
+            name = f"{show}.{episode}." + ".".join(tags) + f"-{rng.choice(GROUPS)}"
+        names.append(name.replace(" ", rng.choice([" ", ".", "_"])) if rng.random() < 0.2 else name)
+        names[-1] += rng.choice(EXTENSIONS)
+    return names
+
+
+class _Message:
+    """Minimal message for check_anti_nsfw, which replies on a match"""
+
+    async def reply_text(self, *args, **kwargs):
+        return None
+
+
+def load_functions():
+    os.environ.setdefault("DB_URL", "mongodb://127.0.0.1:27017")
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    from plugins.file_rename import extract_season_episode, extract_quality, apply_format_template, format_caption
+    from plugins.sequence import extract_episode_number
+    from plugins.antinsfw import check_anti_nsfw
+
+    message = _Message()
+
+    def nsfw(name):
+        # _Message never suspends, so the coroutine finishes on the first send
+        coro = check_anti_nsfw(name, message)
+        try:
+            coro.send(None)
+        except StopIteration as stop:
+            return stop.value
+        raise RuntimeError("check_anti_nsfw suspended")
+
+    template = "Overflow [S{season}E{episode}] - [Dual] {quality} Season Episode QUALITY"
+    caption = "📕Name ➠ : {filename}\n\n🔗 Size ➠ : {filesize}\n\n⏰ Duration ➠ : {duration}"
+    return {
+        "extract_season_episode": extract_season_episode,
+        "extract_quality": extract_quality,
+        "apply_format_template": lambda n: apply_format_template(template, *extract_season_episode(n), extract_quality(n)),
+        "extract_episode_number": extract_episode_number,
+        "check_anti_nsfw": nsfw,
+        "format_caption": lambda n: format_caption(caption, n, len(n) * 1_048_576, "00:23:40"),
+    }
+
+
+def bench(func, corpus, repeats):
+    """Best-of-`repeats` ns/call, plus transient and retained memory per call"""
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter_ns()
+        for name in corpus:
+            func(name)
+        elapsed = time.perf_counter_ns() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    before = tracemalloc.take_snapshot()
+    for name in corpus:
+        func(name)
+    _, peak = tracemalloc.get_traced_memory()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    retained = sum(stat.count_diff for stat in after.compare_to(before, "filename"))
+    return dict(ns_per_call=best / len(corpus), peak_bytes=peak, retained_blocks=retained)
+
+
+def _plain(value):
+    """JSON-safe form of a function output (tuples become lists, inf a string)"""
+    if isinstance(value, tuple):
+        return [_plain(v) for v in value]
+    if isinstance(value, float) and value == float("inf"):
+        return "inf"
+    return value
+
+
+def snapshot(functions, corpus):
+    return {
+        name: {fname: _plain(func(name)) for fname, func in functions.items()}
+        for name in corpus
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--count", type=int, default=20000)
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--corpus", help="file with one filename per line instead of the generated corpus")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--only", action="append", help="benchmark only this function (repeatable)")
+    parser.add_argument("--with-logging", action="store_true", help="keep the hot-path log calls enabled")
+    parser.add_argument("--snapshot", help="write the outputs for every filename to this JSON file")
+    parser.add_argument("--check", help="compare outputs against a snapshot written earlier")
+    args = parser.parse_args()
+
+    if args.corpus:
+        with open(args.corpus, encoding="utf-8") as f:
+            corpus = [line.rstrip("\n") for line in f if line.strip()]
+    else:
+        corpus = generate_corpus(args.count, args.seed)
+
+    functions = load_functions()
+    if args.with_logging:
+        # Same pipeline as the bot, hot-path lines are sampled unless LOG_DEBUG is set
+        from config import Config
+        from helper.log import setup_logging
+        setup_logging(Config.LOG_LEVEL, Config.LOG_DEBUG, Config.LOG_SAMPLE_RATE, stream=sys.stderr)
+    else:
+        logging.disable(logging.CRITICAL)
+
+    print(f"{len(corpus)} filenames\n")
+    print(f"{'function':<24} {'ns/call':>10} {'peak B':>10} {'retained':>9}")
+    for fname, func in functions.items():
+        if args.only and fname not in args.only:
+            continue
+        r = bench(func, corpus, args.repeats)
+        print(f"{fname:<24} {r['ns_per_call']:>10.0f} {r['peak_bytes']:>10} {r['retained_blocks']:>9}")
+
+    if args.snapshot or args.check:
+        current = snapshot(functions, corpus)
+    if args.snapshot:
+        with open(args.snapshot, "w", encoding="utf-8") as f:
+            json.dump(current, f, ensure_ascii=False, indent=0)
+        print(f"\nsnapshot written to {args.snapshot}")
+    if args.check:
+        with open(args.check, encoding="utf-8") as f:
+            expected = json.load(f)
+        diffs = [
+            (name, fname, expected[name][fname], outputs[fname])
+            for name, outputs in current.items() if name in expected
+            for fname in outputs if fname in expected[name] and expected[name][fname] != outputs[fname]
+        ]
+        missing = len([name for name in current if name not in expected])
+        for name, fname, old, new in diffs[:20]:
+            print(f"  {fname}({name!r}): {old!r} -> {new!r}")
+        print(f"\n{len(diffs)} changed outputs, {missing} filenames not in snapshot")
+        sys.exit(1 if diffs else 0)
+
+
+if __name__ == "__main__":
+    main()
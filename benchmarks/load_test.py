@@ -0,0 +1,408 @@
+"""End-to-end load benchmark for the rename, sequence and broadcast handlers.
+
+Drives the real plugin handlers with an in-process FakeClient (simulated
+bandwidth, latency and FloodWaits) against either a local mongod or an
+in-memory Mongo stand-in. Nothing talks to Telegram.
+
+    python -m benchmarks.load_test --scenario rename --jobs 50 --concurrency 50
+    python -m benchmarks.load_test --scenario all --jobs 500 --mongo mongodb://127.0.0.1:27017
+    python -m benchmarks.load_test --scenario fairness --jobs 40 --dispatch-workers 8
+
+Run from the repository root. ffmpeg is used to generate the synthetic media
+when it is on PATH, otherwise random bytes are used.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import random
+import asyncio
+import argparse
+import resource
+import tempfile
+import datetime
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def parse_size(value):
+    units = {"k": 1024, "m": 1024 ** 2, "g": 1024 ** 3}
+    value = value.strip().lower().rstrip("b")
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(0, -(-len(ordered) * pct // 100) - 1)]
+
+
+def generate_media(workdir, size):
+    """Create one synthetic file per media type of roughly `size` bytes"""
+    ffmpeg = shutil.which("ffmpeg")
+    files = {}
+    specs = {
+        "video": ("sample.mkv", ["-f", "lavfi", "-i", "testsrc2=size=1280x720:rate=25",
+                                 "-f", "lavfi", "-i", "sine=frequency=440",
+                                 "-c:v", "libx264", "-preset", "ultrafast", "-c:a", "aac"]),
+        "document": ("sample.mp4", ["-f", "lavfi", "-i", "testsrc=size=640x360:rate=25",
+                                    "-f", "lavfi", "-i", "sine=frequency=220",
+                                    "-c:v", "libx264", "-preset", "ultrafast", "-c:a", "aac"]),
+        "audio": ("sample.mp3", ["-f", "lavfi", "-i", "sine=frequency=330", "-c:a", "libmp3lame"]),
+    }
+    for media_type, (name, args) in specs.items():
+        path = os.path.join(workdir, name)
+        if ffmpeg:
+            bitrate = 128_000 if media_type == "audio" else 4_000_000
+            seconds = max(1, size * 8 // bitrate)
+            cmd = [ffmpeg, "-y", "-loglevel", "error", *args, "-t", str(seconds),
+                   "-b:" + ("a" if media_type == "audio" else "v"), str(bitrate), "-fs", str(size), path]
+            if subprocess.run(cmd).returncode == 0:
+                files[media_type] = path
+                continue
+        with open(path, "wb") as f:
+            f.write(os.urandom(size))
+        files[media_type] = path
+    return files
+
+
+class ResourceSampler:
+    """Samples scratch disk usage and RSS while the benchmark runs"""
+
+    def __init__(self, paths, interval=0.05):
+        self.paths = paths
+        self.interval = interval
+        self.peak_disk = 0
+        self.peak_rss = 0
+
+    @staticmethod
+    def rss():
+        try:
+            with open("/proc/self/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def disk(self):
+        total = 0
+        for path in self.paths:
+            if not os.path.isdir(path):
+                continue
+            # Jobs work in directories of their own
+            for root, _, files in os.walk(path):
+                for name in files:
+                    try:
+                        total += os.stat(os.path.join(root, name)).st_size
+                    except OSError:
+                        pass
+        return total
+
+    async def run(self):
+        while True:
+            self.peak_disk = max(self.peak_disk, self.disk())
+            self.peak_rss = max(self.peak_rss, self.rss())
+            await asyncio.sleep(self.interval)
+
+
+def setup_environment(args):
+    """Point the bot config at the benchmark database before importing it"""
+    os.environ["DB_URL"] = args.mongo or "mongodb://127.0.0.1:27017"
+    os.environ["DB_NAME"] = args.db_name
+    os.environ.setdefault("LOG_CHANNEL", "-1001")
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+
+
+def patch_memory_db():
+    """Swap every collection the plugins use for in-memory ones"""
+    from benchmarks.fake_mongo import MemoryDatabase
+    from helper.database import codeflixbots
+    from helper.trace import trace_store
+    from helper.job_queue import job_queue
+    from helper.journal import journal
+    from helper.assets import assets
+    import plugins.sequence as sequence
+
+    db = MemoryDatabase()
+    codeflixbots.codeflixbots = db
+    codeflixbots.col = db["user"]
+    codeflixbots.sequences = sequence.sequence_collection = db["active_sequences"]
+    codeflixbots.sequence_users = sequence.users_collection = db["users_sequence"]
+    trace_store.col = db["job_traces"]
+    job_queue.jobs, job_queue.locks, job_queue.workers = db["rename_jobs"], db["job_locks"], db["workers"]
+    journal.col = db["job_journal"]
+    assets.col = db["media_assets"]
+    return db
+
+
+async def seed_users(count, premium=True, format_template="Bench [S{season}E{episode}] {quality}"):
+    from helper.database import codeflixbots
+    expiry = (datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(days=30)).isoformat()
+    for user_id in range(1, count + 1):
+        user = codeflixbots.new_user(10_000 + user_id)
+        user["format_template"] = format_template
+        user["premium"] = dict(is_premium=premium, expiry_date=expiry, added_on=None, duration="30d")
+        _id = user.pop("_id")
+        await codeflixbots.col.update_one({"_id": _id}, {"$set": user}, upsert=True)
+
+
+def release_name(rng, index):
+    show = rng.choice(["Overflow", "One Piece", "Jujutsu Kaisen", "Frieren", "Dandadan"])
+    quality = rng.choice(["480p", "720p", "1080p", "2160p"])
+    return f"[SubsPlease] {show} - S01E{index % 99 + 1:02d} [{quality}] [{rng.randrange(16 ** 8):08X}].mkv"
+
+
+async def count_failures(kind, message_ids, raised):
+    """Jobs that raised, or whose trace did not finish as done.
+
+    Handlers reply with the error instead of raising, their traces are
+    the only place most failures show up.
+    """
+    from helper.trace import trace_store
+    await trace_store.flush()
+    done = set()
+    async for trace in trace_store.col.find({"kind": kind, "message_id": {"$in": list(message_ids)}}):
+        if trace["status"] == "done":
+            done.add(trace["message_id"])
+    return len(raised | (set(message_ids) - done))
+
+
+async def run_rename(client, args, rng):
+    from plugins.file_rename import auto_rename_files
+    latencies = []
+    message_ids, raised = [], set()
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def one(index):
+        user = client.make_user(10_000 + index % args.users + 1)
+        media_type = rng.choice(["document", "video", "audio"])
+        message = client.make_media_message(user, media_type, release_name(rng, index))
+        message_ids.append(message.id)
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                job = await auto_rename_files(client, message)
+                if isinstance(job, asyncio.Task):
+                    # The handler returns once the job is started
+                    await asyncio.wait([job])
+            except Exception:
+                raised.add(message.id)
+            latencies.append(time.perf_counter() - start)
+
+    await asyncio.gather(*(one(i) for i in range(args.jobs)))
+    return latencies, await count_failures("rename", message_ids, raised)
+
+
+async def run_fairness(client, args, rng):
+    """User A forwards --jobs files, user B sends one right after.
+
+    Updates go through --dispatch-workers handler workers like Pyrogram's
+    dispatcher. B's file must be admitted by the fair queue before any of
+    A's beyond the ones A already had running, however few workers there
+    are. It counts as one failure otherwise.
+    """
+    from plugins.file_rename import auto_rename_files
+    from helper.fair_scheduler import rename_scheduler
+    user_a, user_b = client.make_user(10_001), client.make_user(10_002)
+    admitted = []
+    dispatch = rename_scheduler._dispatch
+
+    def recording_dispatch():
+        waiting = [entry[2] for entry in rename_scheduler._waiting]
+        dispatch()
+        still = {id(entry[2]) for entry in rename_scheduler._waiting}
+        admitted.extend(ticket.user_id for ticket in sorted(waiting, key=lambda t: t.finish) if id(ticket) not in still)
+
+    updates = asyncio.Queue()
+    for index in range(args.jobs):
+        updates.put_nowait(client.make_media_message(user_a, "document", release_name(rng, index)))
+    updates.put_nowait(client.make_media_message(user_b, "document", release_name(rng, 0)))
+    latencies, jobs = [], []
+
+    async def worker():
+        while not updates.empty():
+            message = updates.get_nowait()
+            start = time.perf_counter()
+            job = await auto_rename_files(client, message)
+            if isinstance(job, asyncio.Task):
+                jobs.append(job)
+                job.add_done_callback(lambda _, start=start: latencies.append(time.perf_counter() - start))
+
+    rename_scheduler._dispatch = recording_dispatch
+    try:
+        await asyncio.gather(*(worker() for _ in range(args.dispatch_workers)))
+        if jobs:
+            await asyncio.wait(jobs)
+    finally:
+        rename_scheduler._dispatch = dispatch
+    a_first = admitted.index(user_b.id) if user_b.id in admitted else len(admitted)
+    print(f"user B admitted after {a_first} of user A's {args.jobs} files ({args.dispatch_workers} dispatcher workers)")
+    return latencies, int(a_first > rename_scheduler.per_user)
+
+
+async def run_sequence(client, args, rng):
+    from pyrogram import StopPropagation
+    import plugins.sequence as sequence
+    latencies = []
+    message_ids, raised = [], set()
+    sessions = max(1, args.jobs // args.files_per_sequence)
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def one(index):
+        user = client.make_user(10_000 + index % args.users + 1)
+        end = client.make_command(user, "/endsequence")
+        message_ids.append(end.id)
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                await sequence.start_sequence(client, client.make_command(user, "/startsequence"))
+                for n in rng.sample(range(args.files_per_sequence), args.files_per_sequence):
+                    message = client.make_media_message(user, "document", release_name(rng, n))
+                    try:
+                        await sequence.sequence_file_handler(client, message)
+                    except StopPropagation:
+                        pass
+                await sequence.end_sequence(client, end)
+            except Exception:
+                raised.add(end.id)
+            latencies.append(time.perf_counter() - start)
+
+    await asyncio.gather(*(one(i) for i in range(sessions)))
+    return latencies, await count_failures("sequence", message_ids, raised)
+
+
+async def run_broadcast(client, args, rng):
+    from plugins.admin_panel import broadcast_handler
+    admin = client.make_user(1)
+    source = client.make_command(admin, "hello everyone")
+    command = client.make_command(admin, "/broadcast", reply_to=source)
+    start = time.perf_counter()
+    failures = 0
+    try:
+        await broadcast_handler(client, command)
+    except Exception:
+        failures += 1
+    return [time.perf_counter() - start], failures
+
+
+SCENARIOS = {"rename": run_rename, "sequence": run_sequence, "broadcast": run_broadcast, "fairness": run_fairness}
+
+
+async def main(args):
+    setup_environment(args)
+    workdir = tempfile.mkdtemp(prefix="rename-bench-")
+    media = generate_media(workdir, parse_size(args.file_size))
+    os.chdir(workdir)
+
+    from config import Config
+    from helper.log import setup_logging
+    setup_logging(Config.LOG_LEVEL, Config.LOG_DEBUG, Config.LOG_SAMPLE_RATE)
+
+    from benchmarks.fake_client import FakeClient
+    from helper.database import codeflixbots
+    from helper.trace import trace_store
+    from helper.adaptive_limit import transfer_limit, delivery_limit
+
+    memory_db = None
+    if args.mongo:
+        await codeflixbots._client.drop_database(args.db_name)
+    else:
+        memory_db = patch_memory_db()
+    await seed_users(args.users)
+
+    client = FakeClient(
+        media,
+        download_bps=args.download_mbps * 1024 * 1024 / 8,
+        upload_bps=args.upload_mbps * 1024 * 1024 / 8,
+        latency=args.latency_ms / 1000,
+        flood_rate=args.flood_rate,
+        seed=args.seed,
+        drop_rate=args.drop_rate,
+    )
+    rng = random.Random(args.seed)
+    sampler = ResourceSampler([os.path.join(workdir, "downloads"), os.path.join(workdir, "metadata")])
+    sampler_task = asyncio.create_task(sampler.run())
+
+    results = {}
+    scenarios = list(SCENARIOS) if args.scenario == "all" else [args.scenario]
+    for name in scenarios:
+        start = time.perf_counter()
+        latencies, failures = await SCENARIOS[name](client, args, rng)
+        elapsed = time.perf_counter() - start
+        results[name] = dict(
+            jobs=len(latencies),
+            failures=failures,
+            elapsed=round(elapsed, 3),
+            throughput=round(len(latencies) / elapsed, 3) if elapsed else 0,
+            p50=round(percentile(latencies, 50), 3),
+            p95=round(percentile(latencies, 95), 3),
+            p99=round(percentile(latencies, 99), 3),
+        )
+
+    sampler_task.cancel()
+    await trace_store.flush()
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    summary = dict(
+        config=vars(args),
+        scenarios=results,
+        peak_disk=sampler.peak_disk,
+        peak_rss=sampler.peak_rss,
+        peak_child_rss=children.ru_maxrss * 1024,
+        downloaded=client.download_link.transferred,
+        uploaded=client.upload_link.transferred,
+        api_calls=client.stats.calls,
+        flood_waits=client.stats.flood_waits,
+        dropped_streams=client.stats.dropped_streams,
+        db_ops=memory_db.total_ops if memory_db else None,
+        transfer_limit=dict(transfer_limit.stats(), decisions=list(transfer_limit.decisions)),
+        delivery_limit=dict(delivery_limit.stats(), decisions=list(delivery_limit.decisions)),
+    )
+
+    print(f"\n{'scenario':<10} {'jobs':>6} {'fail':>5} {'jobs/s':>8} {'p50 s':>8} {'p95 s':>8} {'p99 s':>8}")
+    for name, r in results.items():
+        print(f"{name:<10} {r['jobs']:>6} {r['failures']:>5} {r['throughput']:>8} {r['p50']:>8} {r['p95']:>8} {r['p99']:>8}")
+    print(f"\npeak disk {summary['peak_disk'] / 2 ** 20:.1f} MiB | peak rss {summary['peak_rss'] / 2 ** 20:.1f} MiB"
+          f" | ffmpeg rss {summary['peak_child_rss'] / 2 ** 20:.1f} MiB | flood waits {summary['flood_waits']}"
+          f" | dropped streams {summary['dropped_streams']}")
+    print(f"transfer limit {summary['transfer_limit']['limit']} ({summary['transfer_limit']['last']})"
+          f" | delivery limit {summary['delivery_limit']['limit']} ({summary['delivery_limit']['last']})")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(summary, f, indent=2, default=str)
+    shutil.rmtree(workdir, ignore_errors=True)
+
+
+def cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenario", choices=[*SCENARIOS, "all"], default="rename")
+    parser.add_argument("--jobs", type=int, default=50, help="rename jobs, or total files for sequences")
+    parser.add_argument("--concurrency", type=int, default=50, help="handlers running at once")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--files-per-sequence", type=int, default=25)
+    parser.add_argument("--dispatch-workers", type=int, default=8, help="handler workers for the fairness scenario")
+    parser.add_argument("--file-size", default="20MB")
+    parser.add_argument("--download-mbps", type=float, default=200.0)
+    parser.add_argument("--upload-mbps", type=float, default=100.0)
+    parser.add_argument("--latency-ms", type=float, default=60.0)
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="probability of a FloodWait per API call")
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="probability of a download stream dropping per chunk")
+    parser.add_argument("--mongo", help="URL of a local mongod, in-memory stand-in when omitted")
+    parser.add_argument("--db-name", default="rename_bench")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="write the full report to this file")
+    args = parser.parse_args()
+    if args.json:
+        args.json = os.path.abspath(args.json)
+    asyncio.run(main(args))
+
+
+if __name__ == "__main__":
+    cli()
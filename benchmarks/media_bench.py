@@ -0,0 +1,227 @@
+"""Media pipeline benchmark: add_metadata, get_file_duration and process_thumbnail.
+
+Generates media with ffmpeg's lavfi sources in every container the bot
+meets (MKV, MKV with font attachments in the header, MP4 with the moov at
+the end and at the front, MP3) at each size, then times every processing
+stage, its peak RSS (the bot and its ffmpeg children) and the bytes it
+writes. add_metadata runs once with the in-place taggers and once forced
+through the ffmpeg remux.
+
+    python -m benchmarks.media_bench --json baseline.json
+    python -m benchmarks.media_bench --sizes 10MB,100MB --containers mkv,mp4 --workdir /var/tmp/media --keep
+
+Run from the repository root, ffmpeg must be on PATH. The defaults
+(10MB, 500MB and 2GB per container) need about 13 GB of scratch space,
+use --keep with a fixed --workdir to generate the media only once.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import argparse
+import tempfile
+import threading
+import subprocess
+
+from benchmarks.load_test import ROOT, parse_size, patch_memory_db, seed_users
+
+VIDEO = ["-f", "lavfi", "-i", "testsrc2=size=1280x720:rate=25", "-f", "lavfi", "-i", "sine=frequency=440",
+         "-c:v", "libx264", "-preset", "ultrafast", "-b:v", "4M", "-c:a", "aac"]
+# clip arguments, extra arguments when looping the clip up to size
+CONTAINERS = {
+    "mkv": ("mkv", VIDEO, []),
+    "mkv-fonts": ("mkv", VIDEO + ["-attach", "{font}", "-metadata:s:t", "mimetype=application/x-truetype-font"], []),
+    "mp4": ("mp4", VIDEO, []),
+    "mp4-faststart": ("mp4", VIDEO, ["-movflags", "+faststart"]),
+    "mp3": ("mp3", ["-f", "lavfi", "-i", "sine=frequency=330", "-c:a", "libmp3lame", "-b:a", "320k"], []),
+}
+CLIP_SECONDS = 20
+FONT_SIZE = 4 * 1024 * 1024
+USER_ID = 10_001
+
+
+def generate(ffmpeg, workdir, container, size):
+    """Media of `size` bytes: a short clip, stream-copied in a loop until it is big enough"""
+    ext, clip_args, grow_args = CONTAINERS[container]
+    path = os.path.join(workdir, f"{container}-{size}.{ext}")
+    if os.path.exists(path):
+        return path
+    font = os.path.join(workdir, "font.ttf")
+    if not os.path.exists(font):
+        with open(font, "wb") as f:
+            f.write(os.urandom(FONT_SIZE))
+    clip = os.path.join(workdir, f"{container}-clip.{ext}")
+    if not os.path.exists(clip):
+        args = [arg.format(font=font) for arg in clip_args]
+        subprocess.run([ffmpeg, "-y", "-loglevel", "error", *args, "-t", str(CLIP_SECONDS), clip], check=True)
+    subprocess.run([
+        ffmpeg, "-y", "-loglevel", "error", "-stream_loop", "-1", "-i", clip,
+        "-map", "0", "-c", "copy", *grow_args, "-fs", str(size), path,
+    ], check=True)
+    return path
+
+
+def _proc_rss(pid):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def _children():
+    pid = os.getpid()
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            return [int(child) for child in f.read().split()]
+    except OSError:
+        return []
+
+
+def _wchar():
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                if line.startswith("wchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def _disk_used(path):
+    stat = os.statvfs(path)
+    return (stat.f_blocks - stat.f_bfree) * stat.f_frsize
+
+
+class Stage:
+    """Wall time, peak RSS (own and children) and bytes written during one stage.
+
+    RSS is sampled from a thread: get_file_duration and process_thumbnail
+    block the event loop, an asyncio sampler would not see them.
+    """
+
+    def __init__(self, workdir, interval=0.01):
+        self.workdir = workdir
+        self.interval = interval
+        self.peak_rss = 0
+        self.peak_child_rss = 0
+        self._done = threading.Event()
+
+    def _sample(self):
+        while not self._done.is_set():
+            self.peak_rss = max(self.peak_rss, _proc_rss(os.getpid()))
+            self.peak_child_rss = max(self.peak_child_rss, sum(_proc_rss(child) for child in _children()))
+            self._done.wait(self.interval)
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        self._disk, self._wchar = _disk_used(self.workdir), _wchar()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds = time.perf_counter() - self._start
+        self.written = _wchar() - self._wchar
+        # Catches ffmpeg's output too, links and reflinks add next to nothing
+        self.disk = max(0, _disk_used(self.workdir) - self._disk)
+        self._done.set()
+        self._thread.join()
+
+    def result(self, **extra):
+        return dict(
+            seconds=round(self.seconds, 4), peak_rss=self.peak_rss, peak_child_rss=self.peak_child_rss,
+            written=self.written, disk=self.disk, **extra,
+        )
+
+
+async def run_file(workdir, path, mode):
+    from config import Config
+    from plugins.file_rename import add_metadata, get_file_duration, process_thumbnail, cleanup_files
+
+    Config.INPLACE_TAGS = mode == "inplace"
+    audio = path.endswith(".mp3")
+    output = os.path.join(workdir, "out" + os.path.splitext(path)[1])
+    thumb = None if audio else os.path.join(workdir, "thumb.jpg")
+    stages = {}
+
+    with Stage(workdir) as stage:
+        duration = get_file_duration(path)
+    stages["duration"] = stage.result(value=duration)
+
+    with Stage(workdir) as stage:
+        result, probe = await add_metadata(path, output, USER_ID, thumb, audio=audio)
+    stages["metadata"] = stage.result(ffmpeg=result is not None, probe=probe.source if probe else None)
+
+    if thumb and os.path.exists(thumb):
+        with Stage(workdir) as stage:
+            processed = await process_thumbnail(thumb)
+        stages["thumbnail"] = stage.result(ok=processed is not None)
+
+    await cleanup_files(output, thumb)
+    return stages
+
+
+async def main(args):
+    os.environ.setdefault("DB_URL", "mongodb://127.0.0.1:27017")
+    os.environ.setdefault("LOG_CHANNEL", "-1001")
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    ffmpeg = shutil.which("ffmpeg")
+    if not ffmpeg:
+        sys.exit("ffmpeg is not on PATH")
+
+    patch_memory_db()
+    await seed_users(1)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="media-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    sizes = [parse_size(size) for size in args.sizes.split(",")]
+    results = []
+    print(f"{'container':<14} {'size':>8} {'mode':<8} {'stage':<9} {'seconds':>8} {'rss MiB':>8} {'ffmpeg MiB':>10} {'written MiB':>11} {'disk MiB':>9}")
+    try:
+        for container in args.containers.split(","):
+            for size in sizes:
+                path = generate(ffmpeg, workdir, container, size)
+                for mode in args.modes.split(","):
+                    for repeat in range(args.repeats):
+                        stages = await run_file(workdir, path, mode)
+                        results.append(dict(container=container, size=os.path.getsize(path), mode=mode, repeat=repeat, stages=stages))
+                        for name, r in stages.items():
+                            print(f"{container:<14} {os.path.getsize(path) / 2 ** 20:>7.0f}M {mode:<8} {name:<9} {r['seconds']:>8.3f}"
+                                  f" {r['peak_rss'] / 2 ** 20:>8.1f} {r['peak_child_rss'] / 2 ** 20:>10.1f}"
+                                  f" {r['written'] / 2 ** 20:>11.2f} {r['disk'] / 2 ** 20:>9.2f}")
+                if not args.keep:
+                    os.remove(path)
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(dict(config=vars(args), results=results), f, indent=2)
+
+
+def cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="10MB,500MB,2GB", help="comma separated file sizes")
+    parser.add_argument("--containers", default=",".join(CONTAINERS), help=f"comma separated, from {', '.join(CONTAINERS)}")
+    parser.add_argument("--modes", default="inplace,remux", help="inplace (INPLACE_TAGS=True) and/or remux")
+    parser.add_argument("--repeats", type=int, default=1)
+    parser.add_argument("--workdir", help="where to generate media, a temporary directory by default")
+    parser.add_argument("--keep", action="store_true", help="keep the generated media for the next run")
+    parser.add_argument("--json", help="write the full report to this file")
+    args = parser.parse_args()
+    if args.json:
+        args.json = os.path.abspath(args.json)
+    asyncio.run(main(args))
+
+
+if __name__ == "__main__":
+    cli()
@@ -1,77 +1,123 @@
-import aiohttp, asyncio, warnings, pytz
-from datetime import datetime, timedelta
-from pytz import timezone
-from pyrogram import Client, __version__
-from pyrogram.raw.all import layer
+import time
+BOOT_TIME = time.perf_counter()
+
+import asyncio, logging, os
+from datetime import timedelta
+from functools import partial
+from pathlib import PurePath
+from pyrogram import Client
+from pyrogram.session import Session
 from config import Config
-from aiohttp import web
-from route import web_server
+from helper.log import setup_logging
+from helper.database import codeflixbots
+from helper.trace import trace_store
+from helper.job_queue import job_queue, Worker
+from helper.cancel import cancel_registry
+from helper.assets import assets
+from helper.fair_scheduler import weights
+from helper.loop_watchdog import loop_watchdog
+from helper.rate_limit import rate_limiter
+from helper import transfer
 import pyrogram.utils
 import pyromod
 from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-import os
-from flask import Flask, jsonify
-import time
 
+setup_logging(Config.LOG_LEVEL, Config.LOG_DEBUG, Config.LOG_SAMPLE_RATE)
 pyrogram.utils.MIN_CHANNEL_ID = -1009147483647
 
-# Create Flask app
-flask_app = Flask(__name__)
-
-@flask_app.route('/uptime', methods=['GET'])
-def uptime():
-    return jsonify({"status": "ok"}), 200
-
-def run_flask():
-    flask_app.run(host="0.0.0.0", port=int(os.environ.get("FLASK_PORT", 5000)))
-
+logger = logging.getLogger(__name__)
 
 # Setting SUPPORT_CHAT directly here
 SUPPORT_CHAT = int(os.environ.get("SUPPORT_CHAT", "-1002607710343"))
 
 PORT = Config.PORT
 
+IMPORT_TIME = time.perf_counter() - BOOT_TIME
+
 class Bot(Client):
 
     def __init__(self):
+        self.is_worker = Config.BOT_MODE == "worker"
         super().__init__(
-            name="codeflixbots",
+            # Workers need their own session and never receive updates
+            name=f"codeflixbots-worker-{Config.WORKER_ID}" if self.is_worker else "codeflixbots",
             api_id=Config.API_ID,
             api_hash=Config.API_HASH,
             bot_token=Config.BOT_TOKEN,
             workers=200,
-            plugins={"root": "plugins"},
-            sleep_threshold=15,
+            plugins=None if self.is_worker else {"root": "plugins"},
+            no_updates=self.is_worker,
+            # Media sessions still use it, API calls go through the rate limiter (see invoke)
+            sleep_threshold=Config.FLOOD_SLEEP_THRESHOLD,
         )
         # Initialize the bot's start time for uptime calculation
         self.start_time = time.time()
 
+    async def _timed(self, timings, name, coro):
+        start = time.perf_counter()
+        try:
+            return await coro
+        finally:
+            timings[name] = time.perf_counter() - start
+
     async def start(self, *args, **kwargs):
-        await super().start(*args, **kwargs)
-        me = await self.get_me()
+        timings = {"imports": IMPORT_TIME}
+
+        # Telegram login (which also loads the plugins) and the DB handshake overlap
+        await asyncio.gather(
+            self._timed(timings, "telegram", super().start(*args, **kwargs)),
+            self._timed(timings, "mongodb", codeflixbots.ping()),
+        )
+        await asyncio.gather(
+            self._timed(timings, "job_queue", job_queue.setup()),
+            self._timed(timings, "assets", assets.load()),
+            self._timed(timings, "fair_weights", weights.load()),
+        )
+        me = await self._timed(timings, "get_me", self.get_me())
         self.mention = me.mention
-        self.username = me.username  
-        self.uptime = Config.BOT_UPTIME     
-        if Config.WEBHOOK:
-            app = web.AppRunner(await web_server())
-            await app.setup()       
-            await web.TCPSite(app, "0.0.0.0", PORT).start()     
-        print(f"{me.first_name} Is Started.....✨️")
+        self.username = me.username
+        self.uptime = Config.BOT_UPTIME
+        if Config.WEBHOOK and not self.is_worker:
+            await self._timed(timings, "web_server", self.start_web_server())
+        print(f"{me.first_name} Is Started.....✨️ ({Config.BOT_MODE})")
 
+        # Periodically persist buffered job traces
+        self.trace_task = asyncio.create_task(trace_store.run())
+        self.watchdog_task = asyncio.create_task(loop_watchdog.run())
+
+        if self.is_worker:
+            import plugins.file_rename  # Registers the rename job handler
+            self.worker = Worker(job_queue, Config.WORKER_ID, Config.WORKER_CONCURRENCY, Config.WORKER_POLL_INTERVAL)
+            self.worker_task = asyncio.create_task(self.worker.run(self))
+        else:
+            # Announce the restart without holding up the startup path
+            self.announce_task = asyncio.create_task(self.announce_restart())
+            if Config.BOT_MODE == "standalone":
+                from plugins.file_rename import resume_journal
+                self.resume_task = asyncio.create_task(resume_journal(self))
+
+        timings["total"] = time.perf_counter() - BOOT_TIME
+        logger.info("Startup timings: " + " | ".join(f"{name} {secs:.2f}s" for name, secs in timings.items()))
+
+    async def start_web_server(self):
+        from aiohttp import web  # Deferred, only needed for the web service
+        from route import web_server
+
+        app = web.AppRunner(await web_server())
+        await app.setup()
+        await web.TCPSite(app, "0.0.0.0", PORT).start()
+
+    async def announce_restart(self):
         # Calculate uptime using timedelta
         uptime_seconds = int(time.time() - self.start_time)
         uptime_string = str(timedelta(seconds=uptime_seconds))
 
-        for chat_id in [Config.LOG_CHANNEL, SUPPORT_CHAT]:
+        async def send(chat_id):
             try:
-                curr = datetime.now(timezone("Asia/Kolkata"))
-                date = curr.strftime('%d %B, %Y')
-                time_str = curr.strftime('%I:%M:%S %p')
-                
                 # Send the message with the photo
-                await self.send_photo(
-                    chat_id=chat_id,
-                    photo=Config.START_PIC,
+                await assets.send_photo(
+                    partial(self.send_photo, chat_id),
+                    Config.START_PIC,
                     caption=(
                         "**Dᴀɴᴛᴇ ɪs ʀᴇsᴛᴀʀᴛᴇᴅ ᴀɢᴀɪɴ  !**\n\n"
                         f"ɪ ᴅɪᴅɴ'ᴛ sʟᴇᴘᴛ sɪɴᴄᴇ​: `{uptime_string}`"
@@ -82,8 +128,31 @@ class Bot(Client):
                         ]]
                     )
                 )
-
             except Exception as e:
                 print(f"Failed to send message in chat {chat_id}: {e}")
 
+        await asyncio.gather(*(send(chat_id) for chat_id in [Config.LOG_CHANNEL, SUPPORT_CHAT]))
+
+    async def invoke(self, query, retries=Session.MAX_RETRIES, timeout=Session.WAIT_TIMEOUT, sleep_threshold=None):
+        # Every API call is paced by the rate limiter, FloodWaits reach it instead of sleeping in the session
+        return await rate_limiter.call(partial(super().invoke, query, retries, timeout, 0), query)
+
+    async def save_file(self, path, file_id=None, file_part=0, progress=None, progress_args=()):
+        # Local files (every send_* upload) go through the resumable uploader
+        if isinstance(path, (str, PurePath)):
+            return await transfer.save_file(self, path, file_id, file_part, progress, progress_args)
+        return await super().save_file(path, file_id, file_part, progress, progress_args)
+
+    async def stop(self, *args, **kwargs):
+        # Running jobs get DRAIN_TIMEOUT seconds, the rest are journaled (standalone) or requeued (worker)
+        if self.is_worker:
+            await self.worker.drain(Config.DRAIN_TIMEOUT)
+            self.worker_task.cancel()
+        else:
+            await cancel_registry.drain(Config.DRAIN_TIMEOUT)
+        self.trace_task.cancel()
+        self.watchdog_task.cancel()
+        await trace_store.flush()
+        await super().stop(*args, **kwargs)
+
 Bot().run()
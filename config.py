@@ -1,4 +1,4 @@
-import re, os, time
+import re, os, time, socket
 from os import environ, getenv
 id_pattern = re.compile(r'^.\d+$') 
 
@@ -23,9 +23,77 @@ class Config(object):
     BOT_OWNER = int(os.environ.get("BOT_OWNER", "7518139247"))
     DUMP_CHANNEL = int(os.environ.get("DUMP_CHANNEL", "-1002667013291"))
     
-    # wes response configuration     
+    # wes response configuration
     WEBHOOK = bool(os.environ.get("WEBHOOK", "True"))
 
+    # scale-out config: standalone | coordinator (takes updates, queues jobs) | worker (runs queued jobs)
+    BOT_MODE = os.environ.get("BOT_MODE", "standalone").lower()
+    WORKER_ID = os.environ.get("WORKER_ID", f"{socket.gethostname()}-{os.getpid()}")
+    WORKER_CONCURRENCY = int(os.environ.get("WORKER_CONCURRENCY", "4"))
+    WORKER_POLL_INTERVAL = float(os.environ.get("WORKER_POLL_INTERVAL", "2"))
+    JOB_LEASE_SECONDS = int(os.environ.get("JOB_LEASE_SECONDS", "90"))
+    JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", "3"))
+    JOB_LOCK_TTL = int(os.environ.get("JOB_LOCK_TTL", "3600"))
+    JOB_FAILED_TTL = int(os.environ.get("JOB_FAILED_TTL", "604800"))
+    # rename stage pools, PIPELINE_QUEUE files may wait between two stages; 0 processors = FFmpeg slots
+    PIPELINE_DOWNLOADERS = int(os.environ.get("PIPELINE_DOWNLOADERS", "4"))
+    PIPELINE_PROCESSORS = int(os.environ.get("PIPELINE_PROCESSORS", "0"))
+    PIPELINE_UPLOADERS = int(os.environ.get("PIPELINE_UPLOADERS", "4"))
+    PIPELINE_QUEUE = int(os.environ.get("PIPELINE_QUEUE", "2"))
+    # fair queuing between users: weight per tier, jobs per user at once, bytes counted as one unit of cost;
+    # 0 rename slots = room for every pipeline stage and queue
+    FAIR_TIER_WEIGHTS = os.environ.get("FAIR_TIER_WEIGHTS", "free:1,premium:2")
+    FAIR_USER_MAX = int(os.environ.get("FAIR_USER_MAX", "2"))
+    FAIR_COST_UNIT = int(os.environ.get("FAIR_COST_UNIT", 64 * 1024 * 1024))
+    FAIR_RENAME_SLOTS = int(os.environ.get("FAIR_RENAME_SLOTS", "0"))
+    FAIR_SEQUENCE_SLOTS = int(os.environ.get("FAIR_SEQUENCE_SLOTS", "8"))
+    # seconds running jobs get to finish on /restart or SIGTERM before they are journaled/requeued
+    DRAIN_TIMEOUT = int(os.environ.get("DRAIN_TIMEOUT", "60"))
+
+    # ffmpeg executor config, 0 means derive from the CPU count
+    FFMPEG_MAX_PROCS = int(os.environ.get("FFMPEG_MAX_PROCS", "0"))
+    FFMPEG_DISK_SLOTS = int(os.environ.get("FFMPEG_DISK_SLOTS", "4"))
+    FFMPEG_THREADS = int(os.environ.get("FFMPEG_THREADS", "0"))
+    FFMPEG_TIMEOUT = int(os.environ.get("FFMPEG_TIMEOUT", "1800"))
+    FFMPEG_NICE = int(os.environ.get("FFMPEG_NICE", "10"))
+    FFMPEG_STDERR_LINES = int(os.environ.get("FFMPEG_STDERR_LINES", "40"))
+    # Patch MKV/MP4 tags in place instead of remuxing when they fit
+    INPLACE_TAGS = os.environ.get("INPLACE_TAGS", "True").lower() == "true"
+
+    # transfers resume from the last committed chunk/part, TRANSFER_RETRIES attempts per transfer
+    TRANSFER_RETRIES = int(os.environ.get("TRANSFER_RETRIES", "5"))
+    TRANSFER_RETRY_DELAY = float(os.environ.get("TRANSFER_RETRY_DELAY", "2"))
+    UPLOAD_REUSE_SECONDS = int(os.environ.get("UPLOAD_REUSE_SECONDS", "3600"))
+    # concurrent transfers/sequence deliveries, adjusted within [MIN, MAX] every AIMD_INTERVAL seconds
+    TRANSFER_CONCURRENCY = int(os.environ.get("TRANSFER_CONCURRENCY", "8"))
+    TRANSFER_CONCURRENCY_MIN = int(os.environ.get("TRANSFER_CONCURRENCY_MIN", "2"))
+    TRANSFER_CONCURRENCY_MAX = int(os.environ.get("TRANSFER_CONCURRENCY_MAX", "64"))
+    DELIVERY_CONCURRENCY = int(os.environ.get("DELIVERY_CONCURRENCY", "4"))
+    DELIVERY_CONCURRENCY_MAX = int(os.environ.get("DELIVERY_CONCURRENCY_MAX", "32"))
+    AIMD_INTERVAL = float(os.environ.get("AIMD_INTERVAL", "5"))
+
+    # sequence mode: seconds a burst of added files is collected before one write and summary edit
+    SEQUENCE_ACK_INTERVAL = float(os.environ.get("SEQUENCE_ACK_INTERVAL", "2"))
+
+    # outgoing API pacing: messages/s for the whole bot, per private chat, per minute per group or channel
+    API_GLOBAL_RATE = float(os.environ.get("API_GLOBAL_RATE", "30"))
+    API_PRIVATE_CHAT_RATE = float(os.environ.get("API_PRIVATE_CHAT_RATE", "1"))
+    API_GROUP_PER_MINUTE = float(os.environ.get("API_GROUP_PER_MINUTE", "20"))
+    # FloodWaits up to this many seconds are waited out and retried, longer ones raise
+    FLOOD_SLEEP_THRESHOLD = int(os.environ.get("FLOOD_SLEEP_THRESHOLD", "15"))
+
+    # logging config, LOG_DEBUG turns on DEBUG and disables hot-path sampling
+    LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+    LOG_DEBUG = os.environ.get("LOG_DEBUG", "False").lower() == "true"
+    LOG_SAMPLE_RATE = float(os.environ.get("LOG_SAMPLE_RATE", "1"))
+    # event loop stalls longer than this (seconds) are logged with the blocking call site
+    LOOP_LAG_THRESHOLD = float(os.environ.get("LOOP_LAG_THRESHOLD", "0.2"))
+
+    # job trace config
+    TRACE_COLLECTION_SIZE = int(os.environ.get("TRACE_COLLECTION_SIZE", 64 * 1024 * 1024))
+    TRACE_BUFFER_SIZE = int(os.environ.get("TRACE_BUFFER_SIZE", "50"))
+    TRACE_FLUSH_INTERVAL = int(os.environ.get("TRACE_FLUSH_INTERVAL", "15"))
+
 
 class Txt(object):
     # part of text configuration
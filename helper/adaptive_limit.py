@@ -0,0 +1,137 @@
+import time, asyncio, logging
+from collections import deque
+from contextlib import asynccontextmanager
+from pyrogram.errors import FloodWait
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+
+class AdaptiveLimit:
+    """Concurrency limit steered by AIMD from what its users report.
+
+    Every `interval` seconds the window is judged: FloodWaits, an error
+    rate above `max_error_rate`, or throughput falling after the last
+    increase cut the limit by `decrease`; otherwise, if the limit was
+    actually reached, it grows by one. Throughput is whatever unit callers
+    `add` (bytes for transfers, messages for deliveries).
+    """
+
+    def __init__(self, name, initial, minimum, maximum, interval, decrease=0.5, max_error_rate=0.05):
+        self.name = name
+        self.limit = float(max(minimum, min(initial, maximum)))
+        self.minimum = minimum
+        self.maximum = maximum
+        self.interval = interval
+        self.decrease = decrease
+        self.max_error_rate = max_error_rate
+        self.in_flight = 0
+        self._waiters = deque()
+        self.decisions = deque(maxlen=20)
+        self.throughput = 0.0
+        self._last_action = None
+        self._reset_window()
+
+    def _reset_window(self):
+        self._window_start = time.monotonic()
+        self._units = 0
+        self._completed = 0
+        self._errors = 0
+        self._flood_waits = 0
+        self._peak = self.in_flight
+
+    @asynccontextmanager
+    async def slot(self):
+        """Hold one of the `limit` concurrent slots"""
+        while self.in_flight >= int(self.limit):
+            self._peak = max(self._peak, self.in_flight + len(self._waiters) + 1)
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+        self.in_flight += 1
+        self._peak = max(self._peak, self.in_flight)
+        try:
+            yield self
+            self._completed += 1
+        finally:
+            self.in_flight -= 1
+            self._adjust()
+            self._wake()
+
+    def add(self, units):
+        """Count finished work (bytes, messages) towards throughput"""
+        self._units += units
+        self._adjust()
+
+    def record_error(self, error):
+        """Count a failed attempt, callers report each one here (`slot` does not)"""
+        if isinstance(error, FloodWait):
+            self._flood_waits += 1
+        else:
+            self._errors += 1
+        self._adjust()
+
+    def _wake(self):
+        free = int(self.limit) - self.in_flight
+        for waiter in list(self._waiters)[:max(free, 0)]:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def _adjust(self):
+        now = time.monotonic()
+        elapsed = now - self._window_start
+        if elapsed < self.interval:
+            return
+        if elapsed > 3 * self.interval and not self.in_flight and self._peak < int(self.limit):
+            # Idle stretch, nothing to judge
+            self._reset_window()
+            return
+        throughput = self._units / elapsed
+        attempts = self._completed + self._errors
+        saturated = self._peak >= int(self.limit)
+        old = self.limit
+        if self._flood_waits:
+            action = "flood_wait"
+        elif attempts and self._errors / attempts > self.max_error_rate:
+            action = "errors"
+        elif saturated and self._last_action == "increase" and throughput < self.throughput * 0.8:
+            # More concurrency made things slower: slow DC or a full link
+            action = "throughput_drop"
+        elif saturated:
+            action = "increase"
+        else:
+            action = "hold"
+
+        if action == "increase":
+            self.limit = min(self.maximum, self.limit + 1)
+        elif action != "hold":
+            self.limit = max(self.minimum, self.limit * self.decrease)
+        if self.limit != old:
+            logger.info(f"{self.name} limit {old:.0f} -> {self.limit:.0f} ({action}, {throughput:.0f}/s)")
+        self.decisions.append(dict(
+            at=time.time(), action=action, limit=int(self.limit), throughput=round(throughput),
+            flood_waits=self._flood_waits, errors=self._errors, completed=self._completed,
+        ))
+        self.throughput = throughput
+        self._last_action = action
+        self._reset_window()
+        self._wake()
+
+    def stats(self):
+        return dict(
+            limit=int(self.limit), in_flight=self.in_flight, waiting=len(self._waiters),
+            throughput=round(self.throughput), last=self.decisions[-1]["action"] if self.decisions else None,
+        )
+
+
+transfer_limit = AdaptiveLimit(
+    "transfers", Config.TRANSFER_CONCURRENCY, Config.TRANSFER_CONCURRENCY_MIN,
+    Config.TRANSFER_CONCURRENCY_MAX, Config.AIMD_INTERVAL,
+)
+delivery_limit = AdaptiveLimit(
+    "deliveries", Config.DELIVERY_CONCURRENCY, 1, Config.DELIVERY_CONCURRENCY_MAX, Config.AIMD_INTERVAL,
+)
@@ -0,0 +1,63 @@
+import asyncio, logging
+from pyrogram.errors import BadRequest
+from .database import codeflixbots
+from .trace import note_cache_hit
+from .memstat import track
+
+logger = logging.getLogger(__name__)
+
+
+class AssetRegistry:
+    """Telegram file_ids of the bot's stock images, keyed by their URL.
+
+    Sending a photo by URL makes Telegram fetch it again every time. The
+    first send of each URL stores the resulting file_id in MongoDB, every
+    later send (and every later run) reuses it.
+    """
+
+    def __init__(self, col):
+        self.col = col
+        self._file_ids = {}
+        self._locks = {}
+
+    async def load(self):
+        """Pull every stored file_id into memory, one query at startup"""
+        async for doc in self.col.find({}):
+            self._file_ids[doc["_id"]] = doc["file_id"]
+        logger.info(f"Loaded {len(self._file_ids)} media assets")
+
+    async def send_photo(self, send, url, **kwargs):
+        """Send `url` through `send` (e.g. message.reply_photo) by its file_id when known"""
+        file_id = self._file_ids.get(url)
+        if file_id:
+            try:
+                sent = await send(photo=file_id, **kwargs)
+                note_cache_hit()
+                return sent
+            except (BadRequest, ValueError) as e:
+                # Stale file_id, e.g. the bot token changed
+                logger.warning(f"Stored file_id for {url} rejected, uploading again: {e}")
+                await self.forget(url)
+
+        # One upload per URL, concurrent senders wait for it and reuse the file_id
+        async with self._locks.setdefault(url, asyncio.Lock()):
+            file_id = self._file_ids.get(url)
+            if file_id:
+                sent = await send(photo=file_id, **kwargs)
+                note_cache_hit()
+                return sent
+            sent = await send(photo=url, **kwargs)
+            if sent and sent.photo:
+                self._file_ids[url] = sent.photo.file_id
+                await self.col.update_one(
+                    {"_id": url}, {"$set": {"file_id": sent.photo.file_id}}, upsert=True
+                )
+            return sent
+
+    async def forget(self, url):
+        self._file_ids.pop(url, None)
+        await self.col.delete_one({"_id": url})
+
+
+assets = AssetRegistry(codeflixbots.codeflixbots.media_assets)
+track("asset file_ids", lambda: assets._file_ids)
@@ -0,0 +1,92 @@
+"""Native tag writing for audio files.
+
+MP3 (ID3v2), FLAC and Ogg (Vorbis comments) and M4A (MP4 atoms) are tagged
+through mutagen on a reflinked or hardlinked copy of the download, without
+an ffmpeg process and without copying the audio data.
+"""
+import logging
+from .container_tags import clone_file
+from .media_executor import MediaProbe
+
+logger = logging.getLogger(__name__)
+
+
+def _formats():
+    # Deferred, only needed once an audio file comes in
+    from mutagen.mp3 import MP3
+    from mutagen.flac import FLAC
+    from mutagen.oggvorbis import OggVorbis
+    from mutagen.oggopus import OggOpus
+    from mutagen.mp4 import MP4
+    return MP3, FLAC, OggVorbis, OggOpus, MP4
+
+
+def _mp4_has_video(path):
+    """Whether an MP4 mutagen accepted is really a video, i.e. has a track with a vide handler"""
+    from mutagen.mp4 import Atoms
+    with open(path, "rb") as f:
+        moov = Atoms(f).path(b"moov")[-1]
+        for hdlr in moov.findall(b"hdlr", True):
+            ok, data = hdlr.read(f)
+            if ok and data[8:12] == b"vide":
+                return True
+    return False
+
+
+def _set_tags(audio, metadata):
+    from mutagen.id3 import ID3, TIT2, TPE1, TXXX
+    from mutagen.mp4 import MP4
+
+    if audio.tags is None:
+        audio.add_tags()
+    if isinstance(audio, MP4):
+        # Same atoms the MP4 muxer writes, it has none for author
+        audio.tags["\xa9nam"] = [metadata["title"]]
+        audio.tags["\xa9ART"] = [metadata["artist"]]
+    elif isinstance(audio.tags, ID3):
+        # ffmpeg keeps keys without an ID3 frame of their own in TXXX
+        audio.tags.setall("TIT2", [TIT2(encoding=3, text=[metadata["title"]])])
+        audio.tags.setall("TPE1", [TPE1(encoding=3, text=[metadata["artist"]])])
+        audio.tags.setall("TXXX:author", [TXXX(encoding=3, desc="author", text=[metadata["author"]])])
+    else:
+        audio.tags["TITLE"] = [metadata["title"]]
+        audio.tags["ARTIST"] = [metadata["artist"]]
+        audio.tags["AUTHOR"] = [metadata["author"]]
+
+
+def tag_audio(src, dst, metadata):
+    """Write dst as src with new tags.
+
+    Returns a MediaProbe, or None when src is not a supported audio format,
+    in which case dst is left absent.
+    """
+    import mutagen
+
+    metadata = {key: str(value) for key, value in metadata.items()}
+    try:
+        audio = mutagen.File(src)
+    except mutagen.MutagenError as e:
+        logger.warning(f"Could not parse {src} for audio tagging: {e}")
+        return None
+    formats = _formats()
+    if not isinstance(audio, formats):
+        return None
+    # An .mp4 video sent as audio still needs its thumbnail and stream titles from the container path
+    if isinstance(audio, formats[-1]) and _mp4_has_video(src):
+        return None
+    if not clone_file(src, dst):
+        return None
+
+    # dst may share its inode with src, so a failure past here is not retried
+    try:
+        audio = mutagen.File(dst)
+        _set_tags(audio, metadata)
+        audio.save()
+    except mutagen.MutagenError as e:
+        raise RuntimeError(f"Failed to tag audio: {e}")
+
+    probe = MediaProbe(source="native")
+    probe.duration = audio.info.length
+    codec = type(audio).__name__.lower().replace("ogg", "")
+    probe.streams.append(dict(index=0, type="audio", codec=codec, attached=False))
+    return probe
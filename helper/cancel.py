@@ -0,0 +1,116 @@
+import asyncio, logging
+from functools import partial
+from .memstat import track
+
+logger = logging.getLogger(__name__)
+
+
+class CancelRegistry:
+    """Running jobs by the status message that carries their cancel button.
+
+    Jobs run in a task of their own (see `run` and `spawn`), so cancelling
+    one unwinds its transfer or ffmpeg process without touching the
+    dispatcher or the worker slot that started it.
+    """
+
+    def __init__(self):
+        self._jobs = {}
+        self._tasks = set()
+        self._handed_off = set()
+        self.cancelled = 0
+        self.draining = False
+
+    async def run(self, coro):
+        """Run `coro` as its own task, returning None if it was cancelled"""
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        try:
+            await asyncio.wait([task])
+        except asyncio.CancelledError:
+            # The caller itself is going away, take the job with it
+            task.cancel()
+            raise
+        return None if task.cancelled() else task.result()
+
+    def spawn(self, coro, name=None):
+        """Start `coro` as a job task and return it without waiting.
+
+        For jobs started from update handlers: a job waiting for its turn
+        must not hold one of the dispatcher's workers. Drain still covers it.
+        """
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        task.add_done_callback(partial(self._log_failure, name or coro.__qualname__))
+        return task
+
+    @staticmethod
+    def _log_failure(name, task):
+        if not task.cancelled() and task.exception():
+            logger.error(f"Job {name} failed: {task.exception()!r}")
+
+    async def drain(self, timeout):
+        """Wait up to `timeout` for running jobs, then cancel the rest.
+
+        Jobs see `draining` set when cancelled and journal themselves
+        instead of reporting a cancellation. Returns how many were cut off.
+        """
+        self.draining = True
+        if not self._tasks:
+            return 0
+        logger.info(f"Draining {len(self._tasks)} running jobs, {timeout}s deadline")
+        _, pending = await asyncio.wait(set(self._tasks), timeout=timeout)
+        for task in pending:
+            task.cancel()
+        if pending:
+            # Let their cleanup (journal, locks, status messages) finish
+            await asyncio.wait(pending)
+            logger.warning(f"Interrupted {len(pending)} jobs at the drain deadline")
+        return len(pending)
+
+    def register(self, chat_id, message_id, user_id):
+        """Called from inside the job once its status message exists"""
+        self._jobs[(chat_id, message_id)] = (asyncio.current_task(), user_id)
+
+    def unregister(self, chat_id, message_id):
+        self._jobs.pop((chat_id, message_id), None)
+
+    def cancel(self, chat_id, message_id, user_id=None):
+        """Cancel a job, only its owner may when `user_id` is given"""
+        job = self._jobs.get((chat_id, message_id))
+        if job is None or (user_id is not None and job[1] != user_id):
+            return False
+        task, _ = job
+        if task.done():
+            return False
+        self.cancelled += 1
+        logger.info(f"Cancelling job {chat_id}:{message_id}")
+        return task.cancel()
+
+    def cancel_task(self, task):
+        """Cancel a job by its task, for cancellations arriving through the job queue"""
+        if task.done():
+            return False
+        self.cancelled += 1
+        return task.cancel()
+
+    def hand_off(self, task):
+        """Stop a job another process has taken over, it keeps its lock like a drained one"""
+        if task.done():
+            return False
+        self._handed_off.add(task)
+        task.add_done_callback(self._handed_off.discard)
+        return task.cancel()
+
+    def interrupted(self):
+        """Whether the current job is being cut off by a drain or a hand-off, not a cancel"""
+        return self.draining or asyncio.current_task() in self._handed_off
+
+    def __len__(self):
+        return len(self._jobs)
+
+
+cancel_registry = CancelRegistry()
+track("cancel_registry jobs", lambda: cancel_registry._jobs)
+track("cancel_registry tasks", lambda: cancel_registry._tasks)
@@ -0,0 +1,531 @@
+"""In-place tag writer for Matroska and MP4.
+
+Only the header elements that carry the tags are rewritten, on a reflinked
+or hardlinked copy of the download, so tagging a multi-GB file touches a
+few kilobytes. Every edit is planned before anything is written; when the
+new tags do not fit in the existing element plus its padding, nothing is
+touched and the caller falls back to the ffmpeg remux.
+"""
+import os, zlib, errno, fcntl, struct, logging
+from .media_executor import MediaProbe
+
+logger = logging.getLogger(__name__)
+
+FICLONE = 0x40049409
+MAX_HEADER = 64 * 1024 * 1024  # Never load more than this to rewrite tags
+
+
+class TagsDontFit(Exception):
+    pass
+
+
+def clone_file(src, dst):
+    """Make dst share src's data without copying it, returns how or None"""
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        with open(src, "rb") as s, open(dst, "wb") as d:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        return "reflink"
+    except OSError:
+        if os.path.exists(dst):
+            os.remove(dst)
+    try:
+        # The download is thrown away after upload, sharing its inode is fine
+        os.link(src, dst)
+        return "hardlink"
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+            logger.warning(f"Could not link {src}: {e}")
+        return None
+
+
+def _apply(path, patches, truncate=None):
+    fd = os.open(path, os.O_RDWR)
+    try:
+        for offset, data in patches:
+            os.pwrite(fd, data, offset)
+        if truncate is not None:
+            os.ftruncate(fd, truncate)
+    finally:
+        os.close(fd)
+
+
+# --- Matroska ---------------------------------------------------------------
+
+EBML = 0x1A45DFA3
+SEGMENT = 0x18538067
+SEEK_HEAD, SEEK, SEEK_ID, SEEK_POSITION = 0x114D9B74, 0x4DBB, 0x53AB, 0x53AC
+INFO, TITLE, TIMESTAMP_SCALE, DURATION = 0x1549A966, 0x7BA9, 0x2AD7B1, 0x4489
+TRACKS, TRACK_ENTRY, TRACK_TYPE, CODEC_ID, NAME = 0x1654AE6B, 0xAE, 0x83, 0x86, 0x536E
+VIDEO, PIXEL_WIDTH, PIXEL_HEIGHT = 0xE0, 0xB0, 0xBA
+TAGS, TAG, TARGETS, SIMPLE_TAG, TAG_NAME, TAG_STRING = 0x1254C367, 0x7373, 0x63C0, 0x67C8, 0x45A3, 0x4487
+TARGET_UIDS = {0x63C5, 0x63C9, 0x63C4, 0x63C6}
+CLUSTER, VOID, CRC32 = 0x1F43B675, 0xEC, 0xBF
+TRACK_KINDS = {1: "video", 2: "audio", 0x11: "subtitle"}
+
+
+def _read_vint(buf, pos, marker=False):
+    first = buf[pos]
+    length = 1
+    while length <= 8 and not first & (0x80 >> (length - 1)):
+        length += 1
+    if length > 8:
+        raise ValueError("invalid EBML vint")
+    value = first if marker else first & ((0x80 >> (length - 1)) - 1)
+    for byte in buf[pos + 1:pos + length]:
+        value = value << 8 | byte
+    return value, length
+
+
+def _size(value, length=None):
+    if length and value >= (1 << 7 * length) - 1:
+        length = None  # Outgrew the original field, take the smallest that fits
+    length = length or next(n for n in range(1, 9) if value < (1 << 7 * n) - 1)
+    return (value | 1 << 7 * length).to_bytes(length, "big")
+
+
+def _element(eid, data, size_length=None):
+    return eid.to_bytes((eid.bit_length() + 7) // 8, "big") + _size(len(data), size_length) + data
+
+
+def _children(data):
+    """Flat [id, body] list of a master element's children"""
+    items, pos = [], 0
+    while pos < len(data):
+        eid, n = _read_vint(data, pos, marker=True)
+        size, m = _read_vint(data, pos + n)
+        start = pos + n + m
+        items.append([eid, data[start:start + size]])
+        pos = start + size
+    return items
+
+
+def _master(items):
+    body = b"".join(_element(eid, data) for eid, data in items if eid != CRC32)
+    if items and items[0][0] == CRC32:
+        # mkvmerge checksums level 1 elements, keep the checksum valid
+        body = _element(CRC32, struct.pack("<I", zlib.crc32(body))) + body
+    return body
+
+
+def _set_child(items, eid, data):
+    for item in items:
+        if item[0] == eid:
+            item[1] = data
+            return
+    items.append([eid, data])
+
+
+def _uint(data):
+    return int.from_bytes(data, "big")
+
+
+def _read_header(f, offset):
+    f.seek(offset)
+    head = f.read(12)
+    if len(head) < 2:
+        return None
+    eid, n = _read_vint(head, 0, marker=True)
+    size, m = _read_vint(head, n)
+    return eid, n + m, size
+
+
+def _void(length):
+    """Void element of exactly `length` (>= 2) bytes"""
+    size_length = next(n for n in range(1, 9) if length - 1 - n < (1 << 7 * n) - 1)
+    return _element(VOID, bytes(length - 1 - size_length), size_length)
+
+
+def _fit(elements, span):
+    """Concatenate [id, body] elements and pad them to exactly `span` bytes"""
+    encoded = [_element(eid, body) for eid, body in elements]
+    rest = span - sum(map(len, encoded))
+    if rest == 1 and encoded:
+        # A Void needs two bytes, give the last element a wider size field instead
+        eid, body = elements[-1]
+        encoded[-1] = _element(eid, body, len(_size(len(body))) + 1)
+        rest = 0
+    if rest < 0:
+        raise TagsDontFit()
+    return b"".join(encoded) + (_void(rest) if rest else b"")
+
+
+def _edit_info(body, metadata, probe):
+    items = _children(body)
+    info = dict(items)
+    scale = _uint(info.get(TIMESTAMP_SCALE, b"")) or 1_000_000
+    if DURATION in info:
+        fmt = ">f" if len(info[DURATION]) == 4 else ">d"
+        probe.duration = struct.unpack(fmt, info[DURATION])[0] * scale / 1e9
+    _set_child(items, TITLE, metadata["title"].encode())
+    return _master(items)
+
+
+def _edit_tracks(body, metadata, probe):
+    items = _children(body)
+    for index, entry in enumerate(item for item in items if item[0] == TRACK_ENTRY):
+        fields = _children(entry[1])
+        values = dict(fields)
+        kind = TRACK_KINDS.get(_uint(values.get(TRACK_TYPE, b"")), "data")
+        stream = dict(index=index, type=kind, codec=values.get(CODEC_ID, b"").decode(errors="replace"), attached=False)
+        if VIDEO in values:
+            video = dict(_children(values[VIDEO]))
+            if PIXEL_WIDTH in video and PIXEL_HEIGHT in video:
+                stream.update(width=_uint(video[PIXEL_WIDTH]), height=_uint(video[PIXEL_HEIGHT]))
+        probe.streams.append(stream)
+        title = {"video": metadata["video_title"], "audio": metadata["audio_title"], "subtitle": metadata["subtitle"]}.get(kind)
+        if title is not None:
+            _set_child(fields, NAME, title.encode())
+            entry[1] = _master(fields)
+    return _master(items)
+
+
+def _edit_tags(body, metadata):
+    items = _children(body)
+    # The global Tag is the one whose Targets has no UIDs
+    tag = next((item for item in items if item[0] == TAG and not any(
+        eid in TARGET_UIDS for eid, _ in _children(dict(_children(item[1])).get(TARGETS, b""))
+    )), None)
+    if tag is None:
+        tag = [TAG, _element(TARGETS, b"")]
+        items.append(tag)
+    fields = _children(tag[1])
+    # TITLE lives in Info, but keep a global TITLE tag in step when there is one
+    values = {"TITLE": metadata["title"], "ARTIST": metadata["artist"], "AUTHOR": metadata["author"]}
+    wanted = {"ARTIST", "AUTHOR"}
+    for field in fields:
+        if field[0] != SIMPLE_TAG:
+            continue
+        simple = _children(field[1])
+        name = dict(simple).get(TAG_NAME, b"").decode(errors="replace").upper()
+        if name in values:
+            _set_child(simple, TAG_STRING, values[name].encode())
+            field[1] = _master(simple)
+            wanted.discard(name)
+    for name in sorted(wanted):
+        fields.append([SIMPLE_TAG, _master([[TAG_NAME, name.encode()], [TAG_STRING, values[name].encode()]])])
+    tag[1] = _master(fields)
+    return _master(items)
+
+
+def _seek_entries(body):
+    """(SeekID, position) pairs of a SeekHead body"""
+    entries = []
+    for eid, data in _children(body):
+        if eid == SEEK:
+            entry = dict(_children(data))
+            entries.append((_uint(entry.get(SEEK_ID, b"")), _uint(entry.get(SEEK_POSITION, b""))))
+    return entries
+
+
+def _seek_head(entries):
+    return _master([
+        [SEEK, _master([[SEEK_ID, eid.to_bytes((eid.bit_length() + 7) // 8, "big")],
+                        [SEEK_POSITION, position.to_bytes(max(1, (position.bit_length() + 7) // 8), "big")]])]
+        for eid, position in entries
+    ])
+
+
+def _mkv_plan(f, file_size, metadata):
+    header = _read_header(f, 0)
+    if not header or header[0] != EBML:
+        return None
+    segment_offset = header[1] + header[2]
+    segment = _read_header(f, segment_offset)
+    if not segment or segment[0] != SEGMENT:
+        return None
+    data_start = segment_offset + segment[1]
+    data_end = min(data_start + segment[2], file_size)
+
+    # The header region is every level 1 element before the first cluster. It
+    # gets rewritten as a whole so Info and Tracks can grow into any Void in it,
+    # clusters never move so Cues stay valid.
+    region, pos = [], data_start
+    while pos < data_end:
+        head = _read_header(f, pos)
+        if not head or head[0] == CLUSTER:
+            break
+        region.append((head[0], pos - data_start, head[1], head[2]))
+        pos += head[1] + head[2]
+    region_end = pos
+    if region_end - data_start > MAX_HEADER:
+        raise TagsDontFit()
+    kinds = [eid for eid, *_ in region]
+    if INFO not in kinds or TRACKS not in kinds or kinds.count(SEEK_HEAD) > 1:
+        return None
+
+    f.seek(data_start)
+    raw = f.read(region_end - data_start)
+    elements = [
+        [eid, raw[offset + header_length:offset + header_length + size], offset]
+        for eid, offset, header_length, size in region if eid != VOID
+    ]
+    seek_head = next((e for e in elements if e[0] == SEEK_HEAD), None)
+    entries = _seek_entries(seek_head[1]) if seek_head else []
+
+    # Elements the SeekHead points at past the clusters, Tags usually lives there
+    outside = {}
+    for eid, position in entries:
+        if data_start + position >= region_end:
+            head = _read_header(f, data_start + position)
+            if head and head[0] == eid:
+                outside.setdefault(eid, (data_start + position, head[1], head[2]))
+    if SEEK_HEAD in outside:
+        # A second SeekHead could point into the region, leave those files to ffmpeg
+        return None
+
+    probe = MediaProbe(source="inplace")
+    patches, truncate = [], None
+    for element in elements:
+        if element[0] == INFO:
+            element[1] = _edit_info(element[1], metadata, probe)
+        elif element[0] == TRACKS:
+            element[1] = _edit_tracks(element[1], metadata, probe)
+        elif element[0] == TAGS:
+            element[1] = _edit_tags(element[1], metadata)
+
+    if TAGS in outside and TAGS not in kinds:
+        offset, header_length, size = outside[TAGS]
+        if size > MAX_HEADER:
+            raise TagsDontFit()
+        f.seek(offset + header_length)
+        tags = _edit_tags(f.read(size), metadata)
+        end = offset + header_length + size
+        following = _read_header(f, end) if end < data_end else None
+        if following and following[0] == VOID:
+            end += following[1] + following[2]
+        if end >= file_size and data_end == file_size:
+            # Last element of the file, it can simply grow
+            element = _element(TAGS, tags)
+            truncate = offset + len(element)
+            if segment[2] != (1 << 7 * (segment[1] - 4)) - 1:
+                patches.append((segment_offset + 4, _size(truncate - data_start, segment[1] - 4)))
+            patches.append((offset, element))
+        else:
+            patches.append((offset, _fit([[TAGS, tags]], end - offset)))
+    elif TAGS not in kinds:
+        # No Tags anywhere, add one to the region where a linear scan finds it
+        elements.append([TAGS, _edit_tags(b"", metadata), None])
+
+    if seek_head and TAGS not in kinds and TAGS not in outside:
+        entries.append((TAGS, None))
+
+    def layout():
+        """Lay the region out again, the SeekHead size depends on the positions it holds"""
+        for _ in range(4):
+            moved, position = {}, 0
+            for eid, body, old in elements:
+                moved[old] = position
+                position += len(_element(eid, body))
+            if not seek_head:
+                break
+            body = _seek_head([
+                (eid, moved.get(old, old)) for eid, old in entries
+                # Entries into the region that point at no element (a Void) are dropped
+                if old is None or old in moved or data_start + old >= region_end
+            ])
+            if body == seek_head[1]:
+                break
+            seek_head[1] = body
+        return position
+
+    tags = next((e for e in elements if e[0] == TAGS), None)
+    if layout() > region_end - data_start and tags and seek_head and data_end == file_size:
+        # Out of padding, move Tags past the clusters like mkvpropedit does
+        elements.remove(tags)
+        entries[:] = [(eid, file_size - data_start if eid == TAGS else old) for eid, old in entries]
+        element = _element(TAGS, tags[1])
+        patches.append((file_size, element))
+        if segment[2] != (1 << 7 * (segment[1] - 4)) - 1:
+            patches.append((segment_offset + 4, _size(file_size + len(element) - data_start, segment[1] - 4)))
+        layout()
+    patches.append((data_start, _fit([e[:2] for e in elements], region_end - data_start)))
+    return probe, patches, truncate
+
+
+# --- MP4 --------------------------------------------------------------------
+
+SUBTITLE_HANDLERS = {b"sbtl", b"subt", b"text", b"clcp"}
+
+
+def _box(kind, body):
+    if len(body) + 8 > 0xFFFFFFFF:
+        return struct.pack(">I4sQ", 1, kind, len(body) + 16) + body
+    return struct.pack(">I4s", len(body) + 8, kind) + body
+
+
+def _boxes(data):
+    items, pos = [], 0
+    while pos + 8 <= len(data):
+        size, kind = struct.unpack_from(">I4s", data, pos)
+        header = 8
+        if size == 1:
+            size, header = struct.unpack_from(">Q", data, pos + 8)[0], 16
+        elif size == 0:
+            size = len(data) - pos
+        if size < header:
+            raise ValueError("invalid MP4 box")
+        items.append([kind, data[pos + header:pos + size]])
+        pos += size
+    return items
+
+
+def _find(items, kind):
+    return next((item for item in items if item[0] == kind), None)
+
+
+def _inside(items, kind):
+    """Children of the `kind` box in items, empty when there is none"""
+    box = _find(items, kind)
+    return _boxes(box[1]) if box else []
+
+
+def _pack(items):
+    return b"".join(_box(kind, body) for kind, body in items)
+
+
+def _ilst_item(value):
+    # data box: type 1 (UTF-8), locale 0
+    return _box(b"data", struct.pack(">II", 1, 0) + value.encode())
+
+
+def _mp4_moov(moov, metadata, probe):
+    items = _boxes(moov)
+    mvhd = _find(items, b"mvhd")
+    if mvhd:
+        body = mvhd[1]
+        if body[0] == 1:
+            timescale, duration = struct.unpack_from(">IQ", body, 20)
+        else:
+            timescale, duration = struct.unpack_from(">II", body, 12)
+        if timescale:
+            probe.duration = duration / timescale
+
+    for index, trak in enumerate(item for item in items if item[0] == b"trak"):
+        children = _boxes(trak[1])
+        mdia = _inside(children, b"mdia")
+        hdlr = _find(mdia, b"hdlr")
+        handler = hdlr[1][8:12] if hdlr else b""
+        kind = {b"vide": "video", b"soun": "audio"}.get(handler, "subtitle" if handler in SUBTITLE_HANDLERS else "data")
+        stream = dict(index=index, type=kind, codec="", attached=False)
+        stsd = _find(_inside(_inside(mdia, b"minf"), b"stbl"), b"stsd")
+        if stsd and len(stsd[1]) >= 16:
+            stream["codec"] = stsd[1][12:16].decode(errors="replace")
+        tkhd = _find(children, b"tkhd")
+        if kind == "video" and tkhd:
+            width, height = struct.unpack_from(">II", tkhd[1], 88 if tkhd[1][0] == 1 else 76)
+            stream.update(width=width >> 16, height=height >> 16)
+        probe.streams.append(stream)
+
+    # moov/udta/meta/ilst. The MP4 muxer drops author and stream titles, so do we
+    udta = _find(items, b"udta")
+    if udta is None:
+        udta = [b"udta", b""]
+        items.append(udta)
+    fields = _boxes(udta[1])
+    meta = _find(fields, b"meta")
+    if meta is None:
+        hdlr = _box(b"hdlr", bytes(8) + b"mdirappl" + bytes(9))
+        meta = [b"meta", bytes(4) + hdlr]
+        fields.append(meta)
+    # ISO meta is a full box, QuickTime's is not
+    prefix = b"" if meta[1][4:8] == b"hdlr" else meta[1][:4]
+    meta_items = _boxes(meta[1][len(prefix):])
+    ilst = _find(meta_items, b"ilst")
+    if ilst is None:
+        ilst = [b"ilst", b""]
+        meta_items.append(ilst)
+    tags = _boxes(ilst[1])
+    for key, value in ((b"\xa9nam", metadata["title"]), (b"\xa9ART", metadata["artist"])):
+        tag = _find(tags, key)
+        if tag:
+            tag[1] = _ilst_item(value)
+        else:
+            tags.append([key, _ilst_item(value)])
+    ilst[1] = _pack(tags)
+    meta[1] = prefix + _pack(meta_items)
+    udta[1] = _pack(fields)
+    return _box(b"moov", _pack(items))
+
+
+def _mp4_plan(f, file_size, metadata):
+    f.seek(4)
+    if f.read(4) != b"ftyp":
+        return None
+    top, pos = [], 0
+    while pos + 8 <= file_size:
+        f.seek(pos)
+        size, kind = struct.unpack(">I4s", f.read(8))
+        header = 8
+        if size == 1:
+            size, header = struct.unpack(">Q", f.read(8))[0], 16
+        elif size == 0:
+            # Runs to EOF, nothing may be appended after it
+            size, kind = file_size - pos, None
+        if size < header:
+            return None
+        top.append((kind, pos, header, size))
+        pos += size
+
+    index = next((i for i, box in enumerate(top) if box[0] == b"moov"), None)
+    if index is None or top[index][3] > MAX_HEADER:
+        return None
+    kind, offset, header, size = top[index]
+    f.seek(offset + header)
+    probe = MediaProbe(source="inplace")
+    moov = _mp4_moov(f.read(size - header), metadata, probe)
+
+    # Padding that moov may grow into
+    span = size
+    following = top[index + 1:]
+    while following and following[0][0] in (b"free", b"skip"):
+        span += following.pop(0)[3]
+    if not following:
+        # moov is last, no chunk offsets point past it
+        return probe, [(offset, moov)], offset + len(moov)
+    rest = span - len(moov)
+    if rest == 0:
+        return probe, [(offset, moov)], None
+    if rest >= 8:
+        return probe, [(offset, moov + _box(b"free", bytes(rest - 8)))], None
+    if top[-1][0] is None:
+        raise TagsDontFit()
+    if any(box[0] == b"moof" for box in top):
+        # Fragmented: fragments must follow moov, leave the reordering to ffmpeg
+        return None
+    # Move moov to the end like the ffmpeg remux does, mdat stays put so the
+    # chunk offsets stay valid, and the old moov becomes a free box
+    return probe, [(offset, struct.pack(">I4s", size, b"free")), (file_size, moov)], None
+
+
+def patch_tags(src, dst, metadata):
+    """Write dst as src with new tags without a remux.
+
+    Returns a MediaProbe for the file, or None when the container is not
+    supported or the tags do not fit, in which case dst is left absent.
+    """
+    # Same values ffmpeg would get from the -metadata f-strings
+    metadata = {key: str(value) for key, value in metadata.items()}
+    try:
+        file_size = os.path.getsize(src)
+        with open(src, "rb") as f:
+            magic = f.read(4)
+            if magic == EBML.to_bytes(4, "big"):
+                plan = _mkv_plan(f, file_size, metadata)
+            else:
+                plan = _mp4_plan(f, file_size, metadata)
+    except TagsDontFit:
+        logger.info(f"Tags do not fit in {src}, remuxing instead")
+        return None
+    except (ValueError, KeyError, IndexError, struct.error) as e:
+        logger.warning(f"Could not parse {src} for in-place tagging: {e}")
+        return None
+    if plan is None:
+        return None
+
+    probe, patches, truncate = plan
+    if not clone_file(src, dst):
+        return None
+    _apply(dst, patches, truncate)
+    return probe
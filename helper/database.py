@@ -6,15 +6,21 @@ from .utils import send_log
 
 class Database:
     def __init__(self, uri, database_name):
+        # Motor connects lazily, the real handshake happens in ping()
+        self._client = motor.motor_asyncio.AsyncIOMotorClient(uri)
+        self.codeflixbots = self._client[database_name]
+        self.col = self.codeflixbots.user
+        self.sequences = self.codeflixbots.active_sequences
+        self.sequence_users = self.codeflixbots.users_sequence
+
+    async def ping(self):
+        """Round trip to the server, raises if MongoDB is unreachable"""
         try:
-            self._client = motor.motor_asyncio.AsyncIOMotorClient(uri)
-            self._client.server_info()  # This will raise an exception if the connection fails
+            await self._client.admin.command("ping")
             logging.info("Successfully connected to MongoDB")
         except Exception as e:
             logging.error(f"Failed to connect to MongoDB: {e}")
             raise e  # Re-raise the exception after logging it
-        self.codeflixbots = self._client[database_name]
-        self.col = self.codeflixbots.user
 
     def new_user(self, id):
         return dict(
@@ -286,4 +292,24 @@ class Database:
             return False
 
 
+    # Fair queuing
+    async def get_scheduling(self, id):
+        """Tier, own weight and premium status of a user, for the fair queue"""
+        try:
+            return await self.col.find_one({"_id": int(id)}, {"tier": 1, "weight": 1, "premium.is_premium": 1})
+        except Exception as e:
+            logging.error(f"Error getting scheduling details for user {id}: {e}")
+            return None
+
+    async def set_tier(self, id, tier):
+        """Put a user in `tier`, None puts them back in free/premium by their plan"""
+        update = {"$set": {"tier": tier}} if tier else {"$unset": {"tier": ""}}
+        await self.col.update_one({"_id": int(id)}, update)
+
+    async def set_weight(self, id, weight):
+        """Give a user a weight of their own, None falls back to their tier's"""
+        update = {"$set": {"weight": weight}} if weight else {"$unset": {"weight": ""}}
+        await self.col.update_one({"_id": int(id)}, update)
+
+
 codeflixbots = Database(Config.DB_URL, Config.DB_NAME)
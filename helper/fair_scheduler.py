@@ -0,0 +1,208 @@
+"""Weighted fair queuing of rename and sequence jobs between users.
+
+Jobs are admitted in order of their virtual finish time instead of their
+arrival: a job starts at the later of the scheduler's virtual time and
+the finish of its user's previous job, and finishes `cost / weight`
+later. A user who forwards 300 files stacks their finish times far
+ahead, the next user's single file lands before all but the first few
+of them. Cost is the file size in FAIR_COST_UNIT steps, so short jobs
+are not stuck behind big ones, while a big job's finish time stays put
+and newer jobs eventually queue behind it.
+
+Weights come from the user's tier (FAIR_TIER_WEIGHTS, changed with
+/setweight <tier>) or a weight of their own (/setweight <user_id>).
+Besides its share, every user is held to FAIR_USER_MAX jobs at once.
+"""
+import heapq, asyncio, logging, itertools
+from contextlib import asynccontextmanager
+from config import Config
+from .database import codeflixbots
+from .pipeline import rename_pipeline
+from .memstat import track
+
+logger = logging.getLogger(__name__)
+
+_order = itertools.count()
+
+
+def parse_weights(text):
+    """'free:1,premium:2' -> {'free': 1.0, 'premium': 2.0}"""
+    weights = {}
+    for item in filter(None, (part.strip() for part in text.split(","))):
+        tier, _, weight = item.partition(":")
+        weights[tier.strip().lower()] = float(weight)
+    return weights
+
+
+class TierWeights:
+    """Weight of each tier, kept in MongoDB so admin changes survive restarts"""
+
+    def __init__(self, col, defaults):
+        self.col = col
+        self.tiers = dict(defaults)
+
+    async def load(self):
+        """Stored tier weights over the configured defaults, one query at startup"""
+        async for doc in self.col.find({}):
+            self.tiers[doc["_id"]] = doc["weight"]
+        logger.info(f"Loaded fair queuing weights: {self.tiers}")
+
+    async def set(self, tier, weight):
+        self.tiers[tier] = weight
+        await self.col.update_one({"_id": tier}, {"$set": {"weight": weight}}, upsert=True)
+
+    def tier_of(self, user):
+        if user.get("tier"):
+            return user["tier"]
+        return "premium" if (user.get("premium") or {}).get("is_premium") else "free"
+
+    async def of(self, user_id):
+        """(tier, weight) of a user, their own weight wins over their tier's"""
+        user = await codeflixbots.get_scheduling(user_id) or {}
+        tier = self.tier_of(user)
+        weight = user.get("weight") or self.tiers.get(tier) or self.tiers.get("free", 1.0)
+        return tier, weight
+
+
+class Ticket:
+    """One job's place in a FairScheduler, from arrival until it is closed"""
+
+    def __init__(self, scheduler, user_id, weight, cost):
+        self.scheduler = scheduler
+        self.user_id = user_id
+        self.weight = weight
+        self.cost = cost
+        self.start = self.finish = 0.0
+        self.admitted = False
+        self.closed = False
+        self.waited = 0.0
+        self._future = None
+
+    async def admit(self, on_wait=None):
+        """Wait for the job's turn, `on_wait` is awaited first if it has to wait"""
+        scheduler = self.scheduler
+        loop = asyncio.get_running_loop()
+        self._future = loop.create_future()
+        scheduler._arrive(self)
+        if self.admitted:
+            return
+        if on_wait:
+            await on_wait()
+        start = loop.time()
+        try:
+            await self._future
+        except BaseException:
+            # Cancelled while queued, or just as its turn came
+            self.close()
+            raise
+        finally:
+            self.waited = round(loop.time() - start, 3)
+
+    def close(self):
+        """Give back the job's slot, or its place in the queue if it never got one"""
+        if not self.closed:
+            self.closed = True
+            self.scheduler._leave(self)
+
+
+class FairScheduler:
+    def __init__(self, name, slots, per_user, cost_unit):
+        self.name = name
+        self.slots = slots
+        self.per_user = per_user
+        self.cost_unit = cost_unit
+        self.vtime = 0.0
+        self.finish = {}
+        self.running = {}
+        self.admitted = 0
+        self._waiting = []
+        self._arrivals = 0
+
+    def cost(self, size=0):
+        return max(1.0, size / self.cost_unit) if self.cost_unit else 1.0
+
+    def ticket(self, user_id, weight, size=0):
+        return Ticket(self, user_id, weight, self.cost(size))
+
+    @asynccontextmanager
+    async def slot(self, user_id, weight, size=0, on_wait=None):
+        ticket = self.ticket(user_id, weight, size)
+        try:
+            await ticket.admit(on_wait)
+            yield ticket
+        finally:
+            ticket.close()
+
+    def saturated(self):
+        """Users already running as many jobs as they may"""
+        return [user_id for user_id, count in self.running.items() if count >= self.per_user]
+
+    def _arrive(self, ticket):
+        self._arrivals += 1
+        if self._arrivals % 1000 == 0:
+            # Finish times behind the virtual time no longer change anything
+            for user_id in [u for u, finish in self.finish.items() if finish <= self.vtime and u not in self.running]:
+                del self.finish[user_id]
+        ticket.start = max(self.vtime, self.finish.get(ticket.user_id, 0.0))
+        ticket.finish = self.finish[ticket.user_id] = ticket.start + ticket.cost / ticket.weight
+        heapq.heappush(self._waiting, (ticket.finish, next(_order), ticket))
+        self._dispatch()
+
+    def _leave(self, ticket):
+        if ticket.admitted:
+            ticket.admitted = False
+            count = self.running[ticket.user_id] - 1
+            if count:
+                self.running[ticket.user_id] = count
+            else:
+                del self.running[ticket.user_id]
+        else:
+            for index, entry in enumerate(self._waiting):
+                if entry[2] is ticket:
+                    self._waiting.pop(index)
+                    heapq.heapify(self._waiting)
+                    # Not charged for a job that never ran, unless a later one is already queued on top of it
+                    if self.finish.get(ticket.user_id) == ticket.finish:
+                        self.finish[ticket.user_id] = ticket.start
+                    break
+        self._dispatch()
+
+    def _dispatch(self):
+        held = []
+        while self._waiting and sum(self.running.values()) < self.slots:
+            entry = heapq.heappop(self._waiting)
+            ticket = entry[2]
+            if self.running.get(ticket.user_id, 0) >= self.per_user:
+                held.append(entry)
+                continue
+            ticket.admitted = True
+            self.running[ticket.user_id] = self.running.get(ticket.user_id, 0) + 1
+            self.vtime = max(self.vtime, ticket.start)
+            self.admitted += 1
+            if not ticket._future.done():
+                ticket._future.set_result(None)
+        for entry in held:
+            heapq.heappush(self._waiting, entry)
+
+    def stats(self):
+        return dict(
+            slots=self.slots,
+            running=sum(self.running.values()),
+            waiting=len(self._waiting),
+            users=len(self.running),
+            saturated=len(self.saturated()),
+            admitted=self.admitted,
+        )
+
+
+weights = TierWeights(codeflixbots.codeflixbots.fair_tiers, parse_weights(Config.FAIR_TIER_WEIGHTS))
+# Enough slots to keep every stage busy, the pipeline takes it from there
+rename_scheduler = FairScheduler(
+    "renames",
+    Config.FAIR_RENAME_SLOTS or sum(stage.workers + stage.queue_size for stage in rename_pipeline.stages.values()),
+    Config.FAIR_USER_MAX,
+    Config.FAIR_COST_UNIT,
+)
+# A whole /endsequence run per ticket, its cost is its file count
+sequence_scheduler = FairScheduler("sequences", Config.FAIR_SEQUENCE_SLOTS, 1, 1)
+track("fair queue finish times", lambda: rename_scheduler.finish)
@@ -0,0 +1,289 @@
+import asyncio, datetime, logging
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from config import Config
+from .database import codeflixbots
+from .cancel import cancel_registry
+from .fair_scheduler import rename_scheduler
+
+logger = logging.getLogger(__name__)
+
+
+def utcnow():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+class JobQueue:
+    """Mongo-backed job queue shared by the coordinator and the workers.
+
+    A claimed job holds a lease that its worker keeps extending with
+    heartbeats; jobs whose lease runs out are handed to another worker.
+    """
+
+    def __init__(self, db, lease_seconds, max_attempts, failed_ttl):
+        self.jobs = db.rename_jobs
+        self.locks = db.job_locks
+        self.workers = db.workers
+        self.lease = datetime.timedelta(seconds=lease_seconds)
+        self.max_attempts = max_attempts
+        self.failed_ttl = failed_ttl
+        self.handlers = {}
+        self._ready = False
+
+    async def setup(self):
+        if self._ready:
+            return
+        await self.jobs.create_index([("status", ASCENDING), ("created_at", ASCENDING)])
+        await self.locks.create_index("expires_at", expireAfterSeconds=0)
+        # Only failed jobs carry failed_at, kept around for a look before they go
+        await self.jobs.create_index("failed_at", expireAfterSeconds=self.failed_ttl)
+        self._ready = True
+
+    def register(self, kind, handler):
+        """Register the coroutine run by workers for jobs of `kind`"""
+        self.handlers[kind] = handler
+
+    async def enqueue(self, kind, **fields):
+        job = dict(kind=kind, status="queued", attempts=0, created_at=utcnow(), lease_until=None, worker=None, **fields)
+        result = await self.jobs.insert_one(job)
+        return result.inserted_id
+
+    async def claim(self, worker_id, skip_users=()):
+        """Take the oldest queued job, or one whose lease has expired.
+
+        Queued jobs of `skip_users` (already running their share here) are
+        left for other workers or later.
+        """
+        now = utcnow()
+        queued = {"status": "queued", "user_id": {"$nin": list(skip_users)}} if skip_users else {"status": "queued"}
+        return await self.jobs.find_one_and_update(
+            {"$or": [
+                queued,
+                {"status": "running", "lease_until": {"$lt": now}, "attempts": {"$lt": self.max_attempts}},
+            ]},
+            {"$set": {"status": "running", "worker": worker_id, "lease_until": now + self.lease},
+             "$inc": {"attempts": 1}},
+            sort=[("created_at", ASCENDING)],
+            return_document=ReturnDocument.AFTER,
+        )
+
+    async def expire(self):
+        """Fail the jobs whose lease ran out on their last attempt and return them.
+
+        A job that keeps taking its worker down with it is not handed out
+        again. Each one is taken by a single caller, which reports it to
+        the user, its lock is released here.
+        """
+        expired = []
+        while True:
+            now = utcnow()
+            job = await self.jobs.find_one_and_update(
+                {"status": "running", "lease_until": {"$lt": now}, "attempts": {"$gte": self.max_attempts}},
+                {"$set": {"status": "failed", "worker": None, "lease_until": None, "failed_at": now,
+                          "error": "lease expired on the last attempt"}},
+            )
+            if job is None:
+                return expired
+            if job.get("lock"):
+                await self.release_lock(job["lock"], job["lock_owner"])
+            expired.append(job)
+
+    async def heartbeat(self, job_id, worker_id):
+        """Extend the lease, False when the job is no longer this worker's"""
+        result = await self.jobs.update_one(
+            {"_id": job_id, "worker": worker_id},
+            {"$set": {"lease_until": utcnow() + self.lease}},
+        )
+        return result.modified_count > 0
+
+    async def complete(self, job_id):
+        await self.jobs.delete_one({"_id": job_id})
+
+    async def fail(self, job, error):
+        """Requeue a failed job until it runs out of attempts"""
+        status = "failed" if job["attempts"] >= self.max_attempts else "queued"
+        update = {"status": status, "worker": None, "lease_until": None, "error": str(error)}
+        if status == "failed":
+            update["failed_at"] = utcnow()
+        await self.jobs.update_one({"_id": job["_id"]}, {"$set": update})
+        if status == "failed" and job.get("lock"):
+            await self.release_lock(job["lock"], job["lock_owner"])
+
+    async def requeue(self, job):
+        """Hand back a job cut off by a drain, without spending one of its attempts"""
+        await self.jobs.update_one(
+            {"_id": job["_id"]},
+            {"$set": {"status": "queued", "worker": None, "lease_until": None}, "$inc": {"attempts": -1}},
+        )
+
+    async def request_cancel(self, chat_id, status_id, user_id):
+        """Cancel a job by its status message.
+
+        A queued job is removed and returned, so the caller can release its
+        lock. A running job is flagged for its worker, which returns True.
+        """
+        query = {"chat_id": chat_id, "status_id": status_id, "user_id": user_id}
+        job = await self.jobs.find_one_and_delete({**query, "status": "queued"})
+        if job:
+            return job
+        result = await self.jobs.update_one({**query, "status": "running"}, {"$set": {"cancel": True}})
+        return result.modified_count > 0
+
+    async def cancel_requested(self, job_ids):
+        """IDs among `job_ids` whose cancellation has been requested"""
+        cursor = self.jobs.find({"_id": {"$in": list(job_ids)}, "cancel": True}, {"_id": 1})
+        return [job["_id"] async for job in cursor]
+
+    async def backlog(self):
+        """Gauge for autoscaling: queued/running jobs and live workers"""
+        alive_since = utcnow() - 2 * self.lease
+        return dict(
+            queued=await self.jobs.count_documents({"status": "queued"}),
+            running=await self.jobs.count_documents({"status": "running"}),
+            failed=await self.jobs.count_documents({"status": "failed"}),
+            workers=await self.workers.count_documents({"seen_at": {"$gte": alive_since}}),
+        )
+
+    # Distributed lock, replaces the per-process renaming_operations dict
+    async def acquire_lock(self, key, owner, ttl):
+        expires_at = utcnow() + datetime.timedelta(seconds=ttl)
+        try:
+            await self.locks.insert_one({"_id": key, "owner": owner, "expires_at": expires_at})
+            return True
+        except DuplicateKeyError:
+            # The TTL monitor only runs once a minute, take over expired locks ourselves.
+            # The same owner may take its lock again, e.g. a job resumed after a restart.
+            taken = await self.locks.find_one_and_update(
+                {"_id": key, "$or": [{"expires_at": {"$lt": utcnow()}}, {"owner": owner}]},
+                {"$set": {"owner": owner, "expires_at": expires_at}},
+            )
+            return taken is not None
+
+    async def release_lock(self, key, owner):
+        await self.locks.delete_one({"_id": key, "owner": owner})
+
+
+class Worker:
+    """Claims jobs from the queue and runs them with this process' client"""
+
+    def __init__(self, queue, worker_id, concurrency, poll_interval):
+        self.queue = queue
+        self.worker_id = worker_id
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.running = {}
+        self.interrupted = set()
+        self.lost = set()
+        self.draining = False
+        self._slots = []
+
+    async def _heartbeat(self, job):
+        while True:
+            await asyncio.sleep(self.queue.lease.total_seconds() / 3)
+            if not await self.queue.heartbeat(job["_id"], self.worker_id):
+                # The lease ran out and another worker owns the job now
+                logger.warning(f"Lost the lease on job {job['_id']}, stopping it here")
+                self.lost.add(job["_id"])
+                task = self.running.get(job["_id"])
+                if task:
+                    cancel_registry.hand_off(task)
+                return
+
+    async def _run_job(self, client, job):
+        handler = self.queue.handlers.get(job["kind"])
+        if handler is None:
+            return await self.queue.fail(job, f"no handler for {job['kind']}")
+        beat = asyncio.create_task(self._heartbeat(job))
+        # Own task, so a cancellation request only ever hits the job
+        task = self.running[job["_id"]] = asyncio.create_task(handler(client, job))
+        try:
+            await asyncio.wait([task])
+            if job["_id"] in self.lost:
+                # Its new owner completes or fails it
+                return
+            if job["_id"] in self.interrupted:
+                logger.info(f"Job {job['_id']} interrupted by drain, requeued")
+                return await self.queue.requeue(job)
+            if not task.cancelled() and task.exception():
+                raise task.exception()
+            await self.queue.complete(job["_id"])
+        except Exception as e:
+            logger.error(f"Job {job['_id']} failed on {self.worker_id}: {e}")
+            await self.queue.fail(job, e)
+        finally:
+            beat.cancel()
+            self.running.pop(job["_id"], None)
+            self.lost.discard(job["_id"])
+
+    async def _expire(self, client):
+        """Tell the owners of jobs failed by lease expiry, their worker is gone"""
+        for job in await self.queue.expire():
+            logger.error(f"Job {job['_id']} failed: lease expired on the last attempt")
+            if job.get("status_id"):
+                try:
+                    await client.edit_message_text(
+                        job["chat_id"], job["status_id"], "Error: the worker processing this file stopped responding"
+                    )
+                except Exception as e:
+                    logger.warning(f"Error reporting expired job {job['_id']}: {e}")
+
+    async def _slot(self, client):
+        while not self.draining:
+            try:
+                await self._expire(client)
+                job = await self.queue.claim(self.worker_id, rename_scheduler.saturated())
+            except Exception as e:
+                logger.error(f"Error claiming job: {e}")
+                job = None
+            if job is None:
+                await asyncio.sleep(self.poll_interval)
+                continue
+            await self._run_job(client, job)
+
+    async def drain(self, timeout):
+        """Stop claiming, give running jobs `timeout` seconds, requeue the rest"""
+        self.draining = True
+        cancel_registry.draining = True
+        if self.running:
+            logger.info(f"Worker {self.worker_id} draining {len(self.running)} jobs, {timeout}s deadline")
+            _, pending = await asyncio.wait(set(self.running.values()), timeout=timeout)
+            for job_id, task in list(self.running.items()):
+                if task in pending:
+                    self.interrupted.add(job_id)
+                    task.cancel()
+        # Slots finish their current job (or requeue) and stop
+        slots = [slot for slot in self._slots if not slot.done()]
+        if slots:
+            await asyncio.wait(slots)
+
+    async def _watch_cancels(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            if not self.running:
+                continue
+            try:
+                for job_id in await self.queue.cancel_requested(self.running):
+                    task = self.running.get(job_id)
+                    if task:
+                        logger.info(f"Cancelling job {job_id} on request")
+                        cancel_registry.cancel_task(task)
+            except Exception as e:
+                logger.error(f"Error checking cancellations: {e}")
+
+    async def _announce(self):
+        while True:
+            await self.queue.workers.update_one(
+                {"_id": self.worker_id}, {"$set": {"seen_at": utcnow()}}, upsert=True
+            )
+            await asyncio.sleep(self.queue.lease.total_seconds() / 3)
+
+    async def run(self, client):
+        await self.queue.setup()
+        logger.info(f"Worker {self.worker_id} running {self.concurrency} job slots")
+        self._slots = [asyncio.create_task(self._slot(client)) for _ in range(self.concurrency)]
+        await asyncio.gather(self._announce(), self._watch_cancels(), *self._slots)
+
+
+job_queue = JobQueue(
+    codeflixbots.codeflixbots, Config.JOB_LEASE_SECONDS, Config.JOB_MAX_ATTEMPTS, Config.JOB_FAILED_TTL
+)
@@ -0,0 +1,50 @@
+import logging, datetime
+from pymongo import ReturnDocument
+from config import Config
+from .database import codeflixbots
+
+logger = logging.getLogger(__name__)
+
+
+class JobJournal:
+    """Rename jobs this process has taken on, until they end.
+
+    Entries have the same fields as queued rename jobs (chat_id, message_id,
+    status_id, lock, lock_owner) so run_rename_job can pick them up. Whatever
+    is still here at startup was interrupted by a restart or a crash.
+    """
+
+    def __init__(self, col, max_attempts):
+        self.col = col
+        self.max_attempts = max_attempts
+
+    async def record(self, job):
+        """Add or refresh a job, keyed by its lock owner"""
+        await self.col.update_one(
+            {"_id": job["lock_owner"]},
+            {"$set": job, "$setOnInsert": {"recorded_at": datetime.datetime.now(datetime.timezone.utc), "attempts": 0}},
+            upsert=True,
+        )
+
+    async def remove(self, lock_owner):
+        await self.col.delete_one({"_id": lock_owner})
+
+    async def recover(self):
+        """Entries to resume, each resume counts as an attempt. Returns (resumable, given_up)"""
+        resumable, given_up = [], []
+        async for entry in self.col.find({}, {"_id": 1}):
+            entry = await self.col.find_one_and_update(
+                {"_id": entry["_id"]}, {"$inc": {"attempts": 1}}, return_document=ReturnDocument.AFTER
+            )
+            if entry is None:
+                continue
+            if entry["attempts"] > self.max_attempts:
+                # Probably what brought the bot down, don't loop on it
+                await self.remove(entry["_id"])
+                given_up.append(entry)
+            else:
+                resumable.append(entry)
+        return resumable, given_up
+
+
+journal = JobJournal(codeflixbots.codeflixbots.job_journal, Config.JOB_MAX_ATTEMPTS)
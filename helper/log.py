@@ -0,0 +1,115 @@
+"""Logging setup: records are queued on the caller and written by a thread.
+
+Handlers used to write to stdout straight from the event loop, so a slow
+terminal or log collector stalled every job. `setup_logging` puts a
+QueueHandler on the root logger and a QueueListener thread behind it.
+
+Records carry the fields set with `log_context` (job, user, ...) for the
+task they were logged from. Hot-path messages logged with
+`extra={"sample": key}` are rate limited per key unless LOG_DEBUG is on.
+"""
+import sys, time, queue, atexit, logging, contextvars
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, QueueListener
+
+FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s%(context)s"
+
+_context = contextvars.ContextVar("log_context", default={})
+_listener = None
+
+
+@contextmanager
+def log_context(**fields):
+    """Attach `fields` to every record logged from this task until exit"""
+    token = _context.set({**_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+def bind_log_context(**fields):
+    """Attach `fields` to every record logged for the rest of the current task"""
+    _context.set({**_context.get(), **fields})
+
+
+class ContextFilter(logging.Filter):
+    """Renders the current log context into `record.context`"""
+
+    def filter(self, record):
+        fields = _context.get()
+        record.context = " [" + " ".join(f"{k}={v}" for k, v in fields.items()) + "]" if fields else ""
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Lets through at most `rate` records per second per sample key.
+
+    Dropped records are counted and the count is appended to the next one
+    let through, so the volume stays visible.
+    """
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+        self._buckets = {}
+
+    def filter(self, record):
+        key = getattr(record, "sample", None)
+        if key is None or record.levelno >= logging.ERROR:
+            return True
+        now = time.monotonic()
+        tokens, last, dropped = self._buckets.get(key, (self.rate, now, 0))
+        tokens = min(self.rate, tokens + (now - last) * self.rate)
+        if tokens < 1:
+            self._buckets[key] = (tokens, now, dropped + 1)
+            return False
+        if dropped:
+            record.msg = f"{record.getMessage()} (+{dropped} similar suppressed)"
+            record.args = None
+        self._buckets[key] = (tokens - 1, now, 0)
+        return True
+
+
+def setup_logging(level="INFO", debug=False, sample_rate=1.0, stream=None):
+    """Route all logging through a background writer thread, idempotent"""
+    global _listener
+    if _listener is not None:
+        return
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(logging.Formatter(FORMAT, "%Y-%m-%d %H:%M:%S"))
+
+    handler = QueueHandler(queue.SimpleQueue())
+    handler.addFilter(ContextFilter())
+    if not debug:
+        handler.addFilter(SamplingFilter(sample_rate))
+
+    root = logging.getLogger()
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+    root.addHandler(handler)
+    root.setLevel(logging.DEBUG if debug else level)
+
+    _listener = QueueListener(handler.queue, output, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    """Flush what is queued and stop the writer thread.
+
+    Anything logged afterwards (e.g. during interpreter shutdown) is
+    written directly again.
+    """
+    global _listener
+    if _listener is None:
+        return
+    listener, _listener = _listener, None
+    listener.stop()
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        if isinstance(handler, QueueHandler):
+            root.removeHandler(handler)
+            for output in listener.handlers:
+                output.filters = handler.filters
+                root.addHandler(output)
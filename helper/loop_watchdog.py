@@ -0,0 +1,92 @@
+"""Event loop lag, and what was blocking it.
+
+A synchronous call in any handler (hachoir, Pillow, a blocking copy) holds
+up every other handler. `LoopWatchdog.run` sleeps in short steps on the
+loop and measures how late it wakes up. A helper thread watches the same
+heartbeat: once the loop has been silent for LOOP_LAG_THRESHOLD seconds
+it grabs the loop thread's stack, so the stall is blamed on the frame
+that was actually running instead of whoever ran next.
+"""
+import os, sys, time, asyncio, logging, threading, traceback
+from config import Config
+from .memstat import track
+
+logger = logging.getLogger(__name__)
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def call_site(stack):
+    """Innermost frame of our own code in `stack`, else the innermost frame"""
+    for frame in reversed(stack):
+        if frame.filename.startswith(ROOT) and "site-packages" not in frame.filename:
+            break
+    else:
+        frame = stack[-1]
+    path = os.path.relpath(frame.filename, ROOT) if frame.filename.startswith(ROOT) else frame.filename
+    return f"{path}:{frame.lineno} in {frame.name}"
+
+
+class LoopWatchdog:
+    """Lag measurements of the running loop, grouped by the call site that blocked it"""
+
+    def __init__(self, threshold, interval=None):
+        self.threshold = threshold
+        self.interval = interval or threshold / 2
+        self.stalls = 0
+        self.worst = 0.0
+        self.offenders = {}
+        self._beat = time.monotonic()
+        self._captured = None
+        self._loop_thread = None
+        self._running = False
+
+    async def run(self):
+        self._loop_thread = threading.get_ident()
+        self._running = True
+        threading.Thread(target=self._watch, name="loop-watchdog", daemon=True).start()
+        try:
+            while True:
+                beat = self._beat = time.monotonic()
+                await asyncio.sleep(self.interval)
+                lag = time.monotonic() - beat - self.interval
+                if lag >= self.threshold:
+                    self._record(beat, lag)
+        finally:
+            self._running = False
+
+    def _watch(self):
+        while self._running:
+            time.sleep(self.interval / 2)
+            beat = self._beat
+            if time.monotonic() - beat < self.threshold or (self._captured and self._captured[0] == beat):
+                continue
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is not None:
+                self._captured = (beat, traceback.extract_stack(frame))
+
+    def _record(self, beat, lag):
+        captured, self._captured = self._captured, None
+        if captured and captured[0] == beat:
+            stack = captured[1]
+            site = call_site(stack)
+        else:
+            # Over before the thread looked, or many short callbacks back to back
+            stack, site = None, "unknown (no stack captured)"
+        self.stalls += 1
+        self.worst = max(self.worst, lag)
+        offender = self.offenders.setdefault(site, dict(count=0, total=0.0, worst=0.0, stack=None))
+        offender["count"] += 1
+        offender["total"] += lag
+        offender["worst"] = max(offender["worst"], lag)
+        if stack:
+            offender["stack"] = "".join(traceback.format_list(stack[-8:]))
+        logger.warning(f"Event loop blocked for {lag:.2f}s at {site}", extra={"sample": "loop_lag"})
+
+    def top(self, count=5):
+        """Worst call sites by total time blocked"""
+        return sorted(self.offenders.items(), key=lambda item: -item[1]["total"])[:count]
+
+
+loop_watchdog = LoopWatchdog(Config.LOOP_LAG_THRESHOLD)
+track("loop stall sites", lambda: loop_watchdog.offenders)
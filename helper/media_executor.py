@@ -0,0 +1,172 @@
+import os, re, time, shutil, asyncio, logging
+from collections import deque
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+
+class MediaResult:
+    """Outcome of one ffmpeg run, with the time it waited for a slot"""
+
+    def __init__(self, returncode, stderr_head, stderr_tail, queue_wait, run_time, timed_out=False):
+        self.returncode = returncode
+        self.stderr_head = stderr_head
+        self.stderr_tail = stderr_tail
+        self.queue_wait = queue_wait
+        self.run_time = run_time
+        self.timed_out = timed_out
+
+    @property
+    def stderr(self):
+        # Head and tail only, the middle of a long log is rarely the useful part
+        gap = ["..."] if self.stderr_tail else []
+        return "\n".join(self.stderr_head + gap + self.stderr_tail)
+
+
+class MediaProbe:
+    """Duration and stream info of a media file.
+
+    Filled from ffmpeg's input dump on stderr through `feed`, or directly by
+    the in-place tag writers, `source` says which.
+    """
+
+    DURATION = re.compile(r"^\s*Duration: (\d+):(\d\d):(\d\d(?:\.\d+)?)")
+    STREAM = re.compile(r"^\s*Stream #0:(\d+)\S*: (\w+): (\w+)(.*)")
+    SIZE = re.compile(r", (\d{2,5})x(\d{2,5})")
+
+    def __init__(self, source="ffmpeg"):
+        self.source = source
+        self.duration = None
+        self.streams = []
+        self._done = False
+
+    def feed(self, line):
+        # Only the input section, the output section repeats the streams
+        if self._done:
+            return
+        if line.startswith(("Output #", "Stream mapping")):
+            self._done = True
+            return
+        match = self.DURATION.match(line)
+        if match:
+            hours, minutes, seconds = match.groups()
+            self.duration = int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+            return
+        match = self.STREAM.match(line)
+        if match:
+            index, kind, codec, rest = match.groups()
+            stream = dict(index=int(index), type=kind.lower(), codec=codec, attached="(attached pic)" in rest)
+            size = self.SIZE.search(rest)
+            if kind == "Video" and size:
+                stream.update(width=int(size.group(1)), height=int(size.group(2)))
+            self.streams.append(stream)
+
+    @property
+    def video(self):
+        """First real video stream, skipping embedded cover art"""
+        return next((s for s in self.streams if s["type"] == "video" and not s["attached"]), None)
+
+
+class MediaExecutor:
+    """Runs ffmpeg subprocesses with a concurrency cap and low CPU/IO priority"""
+
+    def __init__(self, max_procs, threads, timeout, niceness, stderr_lines):
+        self.max_procs = max_procs
+        self.threads = threads
+        self.timeout = timeout
+        self.niceness = niceness
+        self.stderr_lines = stderr_lines
+        self.ionice = shutil.which("ionice")
+        self.nice = shutil.which("nice")
+        self._slots = asyncio.Semaphore(max_procs)
+        self.waiting = 0
+        self.running = 0
+        self.completed = 0
+        self.killed = 0
+
+    async def _read_stderr(self, stream, head, tail, on_line):
+        while True:
+            line = await stream.readline()
+            if not line:
+                break
+            line = line.decode(errors="replace").rstrip()
+            if on_line:
+                on_line(line)
+            if len(head) < self.stderr_lines:
+                head.append(line)
+            else:
+                tail.append(line)
+
+    async def run(self, cmd, timeout=None, on_stderr=None):
+        """Run `cmd` once a slot is free, killing it after `timeout` seconds.
+
+        `on_stderr` is called with every stderr line as it arrives, only a
+        bounded head and tail of the output are kept.
+        """
+        # Wrappers rather than preexec_fn, which can deadlock a forked child of a threaded process
+        if self.nice and self.niceness:
+            cmd = [self.nice, "-n", str(self.niceness), *cmd]
+        if self.ionice:
+            cmd = [self.ionice, "-c", "2", "-n", "7", *cmd]
+        queued_at = time.perf_counter()
+        self.waiting += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.waiting -= 1
+        started_at = time.perf_counter()
+        self.running += 1
+        head, tail = [], deque(maxlen=self.stderr_lines)
+        timed_out = False
+        process = None
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *cmd,
+                stdin=asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.PIPE,
+            )
+            try:
+                await asyncio.wait_for(
+                    asyncio.gather(self._read_stderr(process.stderr, head, tail, on_stderr), process.wait()),
+                    timeout or self.timeout,
+                )
+            except asyncio.TimeoutError:
+                timed_out = True
+                logger.warning(f"FFmpeg exceeded {timeout or self.timeout}s, killing pid {process.pid}")
+        finally:
+            if process is not None and process.returncode is None:
+                # Timed out or the job was cancelled, do not leave a runaway process behind
+                self.killed += 1
+                process.kill()
+                await process.wait()
+            self.running -= 1
+            self.completed += 1
+            self._slots.release()
+        return MediaResult(
+            process.returncode, head, list(tail),
+            queue_wait=started_at - queued_at,
+            run_time=time.perf_counter() - started_at,
+            timed_out=timed_out,
+        )
+
+    def stats(self):
+        return dict(
+            max_procs=self.max_procs, running=self.running, waiting=self.waiting,
+            completed=self.completed, killed=self.killed,
+        )
+
+
+def _default_procs():
+    # Remuxing is mostly disk bound, so never go past the disk slots even on big machines
+    return max(1, min(os.cpu_count() or 1, Config.FFMPEG_DISK_SLOTS))
+
+
+_procs = Config.FFMPEG_MAX_PROCS or _default_procs()
+media_executor = MediaExecutor(
+    max_procs=_procs,
+    threads=Config.FFMPEG_THREADS or max(1, (os.cpu_count() or 1) // _procs),
+    timeout=Config.FFMPEG_TIMEOUT,
+    niceness=Config.FFMPEG_NICE,
+    stderr_lines=Config.FFMPEG_STDERR_LINES,
+)
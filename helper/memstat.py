@@ -0,0 +1,117 @@
+"""Where the bot's memory goes: RSS, tracemalloc sites and internal caches.
+
+Modules that keep state between jobs `track` it here under a name, /memstat
+reports the entry count and deep size of each. tracemalloc only runs
+between the first /memstat and `/memstat stop`, it slows every
+allocation down.
+"""
+import os, sys, time, resource, tracemalloc
+from collections import deque
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FRAMES = 1
+
+_tracked = {}
+
+
+def track(name, get):
+    """Report what `get()` returns (a dict, list, set, ...) as cache `name`"""
+    _tracked[name] = get
+
+
+def rss():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def deep_size(obj, limit=200000):
+    """sys.getsizeof of `obj` and everything it holds, stops after `limit` objects"""
+    seen, size, todo = set(), 0, deque([obj])
+    while todo and len(seen) < limit:
+        item = todo.popleft()
+        if id(item) in seen or isinstance(item, type):
+            continue
+        seen.add(id(item))
+        size += sys.getsizeof(item, 0)
+        if isinstance(item, dict):
+            todo.extend(item.keys())
+            todo.extend(item.values())
+        elif isinstance(item, (list, tuple, set, frozenset, deque)):
+            todo.extend(item)
+        elif hasattr(item, "__dict__") and not callable(item):
+            todo.append(vars(item))
+    return size
+
+
+def cache_stats(client=None):
+    """(name, entries, bytes) of every tracked cache, plus Pyrogram's own"""
+    caches = [(name, get()) for name, get in _tracked.items()]
+    if client is not None:
+        caches.append(("pyrogram message_cache", client.message_cache.store))
+    stats = []
+    for name, cache in caches:
+        try:
+            size = deep_size(cache)
+        except RuntimeError:
+            # Run off the loop, the cache changed size under the walk
+            size = deep_size(cache)
+        stats.append((name, len(cache), size))
+    conn = getattr(getattr(client, "storage", None), "conn", None)
+    if conn is not None:
+        # Peers live in the session's SQLite database, not on the heap
+        peers = conn.execute("SELECT COUNT(*) FROM peers").fetchone()[0]
+        pages = conn.execute("PRAGMA page_count").fetchone()[0] * conn.execute("PRAGMA page_size").fetchone()[0]
+        stats.append(("pyrogram peers (sqlite)", peers, pages))
+    return sorted(stats, key=lambda stat: -stat[2])
+
+
+def _site(stat):
+    frame = stat.traceback[0]
+    path = os.path.relpath(frame.filename, ROOT) if frame.filename.startswith(ROOT) else frame.filename
+    return f"{path}:{frame.lineno}"
+
+
+class MemoryTracker:
+    """tracemalloc snapshots, each one compared to the one before"""
+
+    def __init__(self):
+        self.previous = None
+        self.previous_at = None
+
+    def snapshot(self, count=10):
+        """Top allocation sites and the biggest changes since the last call.
+
+        Returns None on the first call, which only starts tracing.
+        """
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(FRAMES)
+            self.previous = None
+            return None
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ))
+        top = [(_site(stat), stat.size, stat.count) for stat in snapshot.statistics("lineno")[:count]]
+        diff = None
+        if self.previous is not None:
+            changes = snapshot.compare_to(self.previous, "lineno")
+            diff = dict(
+                seconds=time.monotonic() - self.previous_at,
+                sites=[(_site(stat), stat.size_diff, stat.count_diff) for stat in changes[:count] if stat.size_diff],
+            )
+        self.previous, self.previous_at = snapshot, time.monotonic()
+        current, peak = tracemalloc.get_traced_memory()
+        return dict(traced=current, peak=peak, top=top, diff=diff)
+
+    def stop(self):
+        tracemalloc.stop()
+        self.previous = None
+
+
+memory_tracker = MemoryTracker()
@@ -0,0 +1,102 @@
+"""Stage pools for rename jobs: downloaders, processors, uploaders.
+
+Each job still runs start to finish in its own task (cancel buttons, the
+journal and traces rely on that), it just has to hold a worker slot of a
+stage while in it. That task is detached from the update handler that
+started it (`CancelRegistry.spawn`), so a job waiting for a stage never
+holds one of the dispatcher's workers. Between two stages sits a bounded queue: a job that
+finished downloading reserves a place in the processing queue before it
+gives up its download slot, so when processing falls behind, downloads
+stop too instead of piling files up on disk. With several files in
+flight, one file's upload overlaps the next one's download.
+"""
+import time, asyncio, logging
+from contextlib import asynccontextmanager
+from config import Config
+from .media_executor import media_executor
+
+logger = logging.getLogger(__name__)
+
+
+class Stage:
+    def __init__(self, name, workers, queue_size):
+        self.name = name
+        self.workers = workers
+        self.queue_size = queue_size
+        self._workers = asyncio.Semaphore(workers)
+        self._queue = asyncio.Semaphore(queue_size)
+        self.active = 0
+        self.queued = 0
+        self.waiting = 0
+
+    def stats(self):
+        return dict(workers=self.workers, active=self.active, queued=self.queued, waiting=self.waiting)
+
+
+class PipelineJob:
+    """One job's way through the stages, in order"""
+
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+        self.queued_in = None
+        self.waited = {}
+
+    @asynccontextmanager
+    async def stage(self, name, on_wait=None):
+        """Hold a worker slot of stage `name`, `on_wait` is awaited first if none is free"""
+        stage = self.pipeline.stages[name]
+        start = time.monotonic()
+        if stage._workers.locked() and on_wait:
+            await on_wait()
+        stage.waiting += 1
+        try:
+            await stage._workers.acquire()
+        finally:
+            stage.waiting -= 1
+        stage.active += 1
+        self._leave_queue()
+        self.waited[name] = round(time.monotonic() - start, 3)
+        try:
+            yield
+            following = self.pipeline.next(name)
+            if following:
+                # Backpressure: keep this slot until the next stage has room in its queue
+                await following._queue.acquire()
+                following.queued += 1
+                self.queued_in = following
+        finally:
+            stage.active -= 1
+            stage._workers.release()
+
+    def _leave_queue(self):
+        if self.queued_in:
+            self.queued_in.queued -= 1
+            self.queued_in._queue.release()
+            self.queued_in = None
+
+    def close(self):
+        """Give up a queue place the job still holds, e.g. it failed between stages"""
+        self._leave_queue()
+
+
+class Pipeline:
+    def __init__(self, stages):
+        self.stages = {stage.name: stage for stage in stages}
+        self._order = [stage.name for stage in stages]
+
+    def next(self, name):
+        index = self._order.index(name) + 1
+        return self.stages[self._order[index]] if index < len(self._order) else None
+
+    def job(self):
+        return PipelineJob(self)
+
+    def stats(self):
+        return {name: stage.stats() for name, stage in self.stages.items()}
+
+
+rename_pipeline = Pipeline([
+    Stage("download", Config.PIPELINE_DOWNLOADERS, Config.PIPELINE_QUEUE),
+    Stage("process", Config.PIPELINE_PROCESSORS or media_executor.max_procs, Config.PIPELINE_QUEUE),
+    Stage("upload", Config.PIPELINE_UPLOADERS, Config.PIPELINE_QUEUE),
+])
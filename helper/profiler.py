@@ -0,0 +1,95 @@
+"""Sampling profiler for a running bot.
+
+A thread walks every other thread's stack (the event loop, asyncio.to_thread
+workers, the log writer) every SAMPLE_INTERVAL. Nothing is hooked into the
+profiled code, so jobs keep running at close to full speed while it runs.
+"""
+import os, sys, time, asyncio, threading
+from collections import Counter
+
+SAMPLE_INTERVAL = 0.005
+MAX_SECONDS = 300
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# A thread whose innermost frame is in one of these is waiting, not working
+IDLE_FILES = ("threading.py", "selectors.py", "queue.py", "thread.py")
+
+
+def _label(code):
+    path = code.co_filename
+    path = os.path.relpath(path, ROOT) if path.startswith(ROOT) else os.path.basename(path)
+    return f"{code.co_name} ({path}:{code.co_firstlineno})"
+
+
+class Profile:
+    """Samples of one profiling window"""
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.samples = 0
+        self.stacks = Counter()
+        self.idle = Counter()
+        self.busy = Counter()
+
+    def collapsed(self):
+        """One `thread;outer;...;inner count` line per stack, the input flamegraph.pl expects"""
+        return "\n".join(f"{stack} {count}" for stack, count in self.stacks.most_common()) + "\n"
+
+    def summary(self, count=30):
+        """Threads by busy share and the functions with the most samples"""
+        own, total = Counter(), Counter()
+        for stack, hits in self.stacks.items():
+            frames = stack.split(";")[1:]
+            own[frames[-1]] += hits
+            for frame in set(frames):
+                total[frame] += hits
+        busy = sum(self.busy.values()) or 1
+        lines = [f"{self.samples} samples over {self.seconds}s, every {SAMPLE_INTERVAL * 1000:.0f} ms", "", "Threads (busy % of samples):"]
+        for thread in sorted(set(self.busy) | set(self.idle), key=lambda name: -self.busy[name]):
+            lines.append(f"  {thread}: {100 * self.busy[thread] / max(self.samples, 1):.1f}% busy")
+        lines += ["", f"{'self':>7} {'total':>7}  function (% of busy samples)"]
+        for frame, hits in own.most_common(count):
+            lines.append(f"{100 * hits / busy:6.1f}% {100 * total[frame] / busy:6.1f}%  {frame}")
+        return "\n".join(lines) + "\n"
+
+
+class SamplingProfiler:
+    """Runs one profile at a time"""
+
+    def __init__(self):
+        self.running = False
+
+    async def profile(self, seconds):
+        if self.running:
+            raise RuntimeError("A profile is already running")
+        self.running = True
+        try:
+            return await asyncio.to_thread(self._sample, min(seconds, MAX_SECONDS))
+        finally:
+            self.running = False
+
+    def _sample(self, seconds):
+        profile = Profile(seconds)
+        me = threading.get_ident()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                thread = names.get(ident, str(ident))
+                if frame.f_code.co_filename.endswith(IDLE_FILES):
+                    profile.idle[thread] += 1
+                    continue
+                frames = []
+                while frame is not None:
+                    frames.append(_label(frame.f_code))
+                    frame = frame.f_back
+                profile.busy[thread] += 1
+                profile.stacks[";".join([thread] + frames[::-1])] += 1
+            profile.samples += 1
+            time.sleep(SAMPLE_INTERVAL)
+        return profile
+
+
+profiler = SamplingProfiler()
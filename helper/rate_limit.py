@@ -0,0 +1,255 @@
+"""Pacing of every outgoing Telegram API call.
+
+Bot.invoke hands each call to `rate_limiter`, which takes a token from:
+- the bucket of the chat it targets (Telegram allows about one message per
+  second in a private chat and 20 per minute in a group or channel),
+- the global message bucket (about 30 per second for the whole bot),
+- a bucket of its own for methods listed in METHOD_LIMITS.
+Messages are sends, edits and forwards. Other calls only take the method
+bucket.
+
+A FloodWait puts the bucket it was meant for (the chat's, else the
+method's) on cooldown, so every call to that chat waits instead of
+collecting FloodWaits of its own, then the call is retried. Waits longer
+than FLOOD_SLEEP_THRESHOLD are raised to the caller, as Pyrogram's
+sleep_threshold did.
+
+Waiting calls are served by priority: HIGH (callback answers) first, LOW
+(broadcasts) last. Calls made under `droppable()` (progress bars) raise
+RateLimited instead of waiting at all.
+"""
+import time, heapq, asyncio, logging, itertools, contextvars
+from contextlib import contextmanager
+from pyrogram import raw
+from pyrogram.errors import FloodWait
+from config import Config
+from .memstat import track
+
+logger = logging.getLogger(__name__)
+
+HIGH, NORMAL, LOW = 0, 1, 2
+
+MESSAGE_METHODS = {
+    "messages.SendMessage", "messages.SendMedia", "messages.SendMultiMedia",
+    "messages.ForwardMessages", "messages.EditMessage",
+}
+# (per second, burst)
+METHOD_LIMITS = {
+    "channels.GetParticipant": (20, 20),
+    "users.GetUsers": (20, 20),
+}
+METHOD_PRIORITY = {
+    "messages.SetBotCallbackAnswer": HIGH,
+}
+
+_priority = contextvars.ContextVar("api_priority", default=NORMAL)
+_droppable = contextvars.ContextVar("api_droppable", default=False)
+_order = itertools.count()
+
+
+class RateLimited(Exception):
+    """A droppable call would have had to wait"""
+
+
+@contextmanager
+def api_priority(level):
+    """Run the API calls made inside at `level`"""
+    token = _priority.set(level)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+@contextmanager
+def droppable():
+    """API calls made inside raise RateLimited rather than wait, for updates that can be skipped"""
+    token = _droppable.set(True)
+    try:
+        yield
+    finally:
+        _droppable.reset(token)
+
+
+class TokenBucket:
+    """`rate` tokens per second up to `capacity`, waiters served by priority"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.cooldown_until = 0.0
+        self._waiters = []
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return now
+
+    def delay(self):
+        """Seconds until a token can be taken"""
+        now = self._refill()
+        wait = max(0.0, self.cooldown_until - now)
+        if self.rate and self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) / self.rate)
+        return wait
+
+    def ready(self):
+        return not self._waiters and self.delay() <= 0
+
+    def _take(self):
+        if self.rate:
+            self.tokens -= 1
+
+    def try_acquire(self):
+        """Take a token if one is free right now, without waiting"""
+        if not self.ready():
+            return False
+        self._take()
+        return True
+
+    def _wake_head(self):
+        if self._waiters and not self._waiters[0][2].done():
+            self._waiters[0][2].set_result(None)
+
+    async def acquire(self, priority=NORMAL):
+        if self.ready():
+            return self._take()
+        entry = [priority, next(_order), asyncio.get_running_loop().create_future()]
+        heapq.heappush(self._waiters, entry)
+        try:
+            while True:
+                if self._waiters[0] is entry:
+                    # Only the head sleeps, the rest wait to become the head
+                    delay = self.delay()
+                    if delay <= 0:
+                        heapq.heappop(self._waiters)
+                        self._take()
+                        return
+                    await asyncio.sleep(delay)
+                else:
+                    await entry[2]
+                    entry[2] = asyncio.get_running_loop().create_future()
+        except BaseException:
+            if entry in self._waiters:
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+            raise
+        finally:
+            self._wake_head()
+
+    def cooldown(self, seconds):
+        self.cooldown_until = max(self.cooldown_until, time.monotonic() + seconds)
+
+    def cooling(self):
+        return self.cooldown_until > time.monotonic()
+
+    async def wait_cooldown(self):
+        while self.cooling():
+            await asyncio.sleep(self.cooldown_until - time.monotonic())
+
+    @property
+    def idle(self):
+        return not self._waiters and self.delay() <= 0 and self.tokens >= self.capacity
+
+
+def _peer_key(query):
+    peer = getattr(query, "peer", None) or getattr(query, "to_peer", None)
+    if isinstance(peer, raw.types.InputPeerUser):
+        return ("user", peer.user_id)
+    if isinstance(peer, raw.types.InputPeerChat):
+        return ("chat", peer.chat_id)
+    if isinstance(peer, raw.types.InputPeerChannel):
+        return ("chat", peer.channel_id)
+    return None
+
+
+class RateLimiter:
+    def __init__(self, global_rate, private_rate, group_per_minute, flood_threshold):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.private_rate = private_rate
+        self.group_rate = group_per_minute / 60
+        self.flood_threshold = flood_threshold
+        self.chats = {}
+        self.methods = {}
+        self.flood_waits = 0
+        self.dropped = 0
+        self._created = 0
+
+    def _chat_bucket(self, key):
+        bucket = self.chats.get(key)
+        if bucket is None:
+            self._created += 1
+            if self._created % 1000 == 0:
+                # Full, unused buckets carry no state
+                for old in [k for k, b in self.chats.items() if b.idle]:
+                    del self.chats[old]
+            if key[0] == "user":
+                bucket = TokenBucket(self.private_rate, 3)
+            else:
+                bucket = TokenBucket(self.group_rate, 3)
+            self.chats[key] = bucket
+        return bucket
+
+    def _method_bucket(self, method):
+        bucket = self.methods.get(method)
+        if bucket is None:
+            # Unlimited unless listed, still there to carry a FloodWait cooldown
+            rate, capacity = METHOD_LIMITS.get(method, (0, 1))
+            bucket = self.methods[method] = TokenBucket(rate, capacity)
+        return bucket
+
+    async def call(self, invoke, query):
+        """Run `invoke()` (the actual API call for `query`) once the buckets allow it"""
+        inner = getattr(query, "query", query)
+        method = ".".join(inner.QUALNAME.split(".")[1:])
+        peer = _peer_key(inner)
+        chat = self._chat_bucket(peer) if peer else None
+        buckets = [self._method_bucket(method)]
+        if method in MESSAGE_METHODS:
+            buckets += [chat, self.global_bucket] if chat else [self.global_bucket]
+        # Other calls to a chat only honour its cooldown, they do not use up its messages
+        cooldown_only = chat if chat and chat not in buckets else None
+        target = chat or buckets[0]
+        priority = METHOD_PRIORITY.get(method, _priority.get())
+
+        while True:
+            if _droppable.get():
+                # Checked before any is taken, a dropped call must not use up tokens
+                if not all(bucket.ready() for bucket in buckets) or (cooldown_only and cooldown_only.cooling()):
+                    self.dropped += 1
+                    raise RateLimited(method)
+                for bucket in buckets:
+                    bucket.try_acquire()
+            else:
+                if cooldown_only:
+                    await cooldown_only.wait_cooldown()
+                for bucket in buckets:
+                    await bucket.acquire(priority)
+            try:
+                return await invoke()
+            except FloodWait as e:
+                self.flood_waits += 1
+                target.cooldown(e.value)
+                logger.warning(f"FloodWait of {e.value}s on {method} ({peer or 'no chat'}), cooling down", extra={"sample": "flood_wait"})
+                if e.value > self.flood_threshold or _droppable.get():
+                    raise
+
+    def stats(self):
+        now = time.monotonic()
+        buckets = [self.global_bucket, *self.chats.values(), *self.methods.values()]
+        return dict(
+            waiting=sum(len(bucket._waiters) for bucket in buckets),
+            cooling=sum(1 for bucket in buckets if bucket.cooldown_until > now),
+            flood_waits=self.flood_waits,
+            dropped=self.dropped,
+        )
+
+
+rate_limiter = RateLimiter(
+    Config.API_GLOBAL_RATE, Config.API_PRIVATE_CHAT_RATE, Config.API_GROUP_PER_MINUTE, Config.FLOOD_SLEEP_THRESHOLD,
+)
+track("rate limit chat buckets", lambda: rate_limiter.chats)
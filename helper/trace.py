@@ -0,0 +1,166 @@
+import math, time, asyncio, logging, contextvars
+from contextlib import contextmanager
+from pymongo import DESCENDING
+from pymongo.errors import CollectionInvalid
+from config import Config
+from .database import codeflixbots
+from .memstat import track
+
+logger = logging.getLogger(__name__)
+
+_current = contextvars.ContextVar("job_trace", default=None)
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, math.ceil(pct / 100 * len(ordered)) - 1)
+    return ordered[index]
+
+
+class JobTrace:
+    """Compact stage timing record of a single rename or sequence job"""
+
+    def __init__(self, kind, user_id, message_id, **fields):
+        self.doc = dict(
+            kind=kind,
+            user_id=user_id,
+            message_id=message_id,
+            started_at=time.time(),
+            ended_at=None,
+            status="running",
+            stages=[],
+            cache_hits=0,
+            retries=0,
+            **fields
+        )
+        self._finished = False
+
+    @contextmanager
+    def stage(self, name, **fields):
+        """Time a stage of the job, `fields` (e.g. bytes) are stored with it"""
+        entry = dict(name=name, start=time.time(), **fields)
+        try:
+            yield entry
+        finally:
+            entry["end"] = time.time()
+            entry["duration"] = round(entry["end"] - entry["start"], 4)
+            self.doc["stages"].append(entry)
+
+    def set(self, **fields):
+        self.doc.update(fields)
+
+    def bind(self):
+        """Make this the trace of the current task, for `note_cache_hit` in helpers"""
+        _current.set(self)
+
+    def cache_hit(self, count=1):
+        self.doc["cache_hits"] += count
+
+    def retry(self, count=1):
+        self.doc["retries"] += count
+
+    def finish(self, status="done"):
+        """Close the trace and hand it to the buffered store"""
+        if self._finished:
+            return
+        self._finished = True
+        self.doc["ended_at"] = time.time()
+        self.doc["duration"] = round(self.doc["ended_at"] - self.doc["started_at"], 4)
+        self.doc["status"] = status
+        trace_store.add(self.doc)
+
+
+def note_cache_hit(count=1):
+    """Count a cache hit on the current task's trace, if it has one"""
+    trace = _current.get()
+    if trace is not None:
+        trace.cache_hit(count)
+
+
+class TraceStore:
+    """Buffers finished job traces and writes them to a capped collection"""
+
+    def __init__(self, collection_name, size_bytes, buffer_size, flush_interval):
+        self.collection_name = collection_name
+        self.size_bytes = size_bytes
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.col = codeflixbots.codeflixbots[collection_name]
+        self._buffer = []
+        self._ready = False
+        self._lock = asyncio.Lock()
+
+    async def _ensure_collection(self):
+        if self._ready:
+            return
+        try:
+            await codeflixbots.codeflixbots.create_collection(
+                self.collection_name, capped=True, size=self.size_bytes
+            )
+        except CollectionInvalid:
+            pass  # Already exists
+        await self.col.create_index("message_id")
+        await self.col.create_index([("started_at", DESCENDING)])
+        self._ready = True
+
+    def add(self, doc):
+        self._buffer.append(doc)
+        if len(self._buffer) >= self.buffer_size:
+            asyncio.get_running_loop().create_task(self.flush())
+
+    async def flush(self):
+        """Write all buffered traces in one insert_many"""
+        async with self._lock:
+            if not self._buffer:
+                return
+            docs, self._buffer = self._buffer, []
+            try:
+                await self._ensure_collection()
+                await self.col.insert_many(docs, ordered=False)
+            except Exception as e:
+                logger.error(f"Error writing {len(docs)} job traces: {e}")
+
+    async def run(self):
+        """Periodically flush the buffer, started from Bot.start"""
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def get(self, message_id):
+        """Most recent trace recorded for a message ID"""
+        await self.flush()
+        return await self.col.find_one(
+            {"message_id": int(message_id)}, sort=[("started_at", DESCENDING)]
+        )
+
+    async def stage_percentiles(self, minutes):
+        """Job count per status and p50/p95 duration per stage over the last `minutes`"""
+        await self.flush()
+        since = time.time() - minutes * 60
+        durations = {}
+        statuses = {}
+        cursor = self.col.find({"started_at": {"$gte": since}}, {"stages": 1, "duration": 1, "status": 1})
+        async for trace in cursor:
+            status = trace.get("status") or "running"
+            statuses[status] = statuses.get(status, 0) + 1
+            if trace.get("duration") is not None:
+                durations.setdefault("total", []).append(trace["duration"])
+            for stage in trace.get("stages", []):
+                durations.setdefault(stage["name"], []).append(stage["duration"])
+        stats = {
+            name: dict(count=len(values), p50=percentile(values, 50), p95=percentile(values, 95))
+            for name, values in durations.items()
+        }
+        return statuses, stats
+
+
+trace_store = TraceStore(
+    "job_traces",
+    Config.TRACE_COLLECTION_SIZE,
+    Config.TRACE_BUFFER_SIZE,
+    Config.TRACE_FLUSH_INTERVAL,
+)
+track("unflushed job traces", lambda: trace_store._buffer)
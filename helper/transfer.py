@@ -0,0 +1,269 @@
+"""Downloads and uploads that pick up where they stopped.
+
+Pyrogram's get_file and save_file log transport errors and carry on: a
+download that dies at 95% comes back as a short file, and an upload with a
+lost part only fails once the message is sent. Here every transfer tracks
+what has been committed (bytes written, parts acknowledged) and retries
+the rest with backoff until TRANSFER_RETRIES is used up.
+
+How many transfers run at once is up to `transfer_limit`, which is fed
+the bytes moved and the errors seen here.
+"""
+import os, math, time, random, asyncio, inspect, logging
+from hashlib import md5
+from pyrogram import raw, StopTransmission
+from pyrogram.errors import FloodWait, InternalServerError, ServiceUnavailable, FileReferenceExpired
+from pyrogram.session import Session
+from config import Config
+from .adaptive_limit import transfer_limit
+from .trace import note_cache_hit
+from .memstat import track
+
+logger = logging.getLogger(__name__)
+
+DOWNLOAD_CHUNK = 1024 * 1024  # what get_file/stream_media offsets count in
+UPLOAD_PART = 512 * 1024
+BIG_FILE = 10 * 1024 * 1024
+
+TRANSIENT_ERRORS = (
+    FloodWait, InternalServerError, ServiceUnavailable, FileReferenceExpired,
+    ConnectionError, TimeoutError, asyncio.TimeoutError,
+)
+
+
+class TransferStalled(Exception):
+    """The transfer ended before all bytes or parts were committed"""
+
+
+class RetryBudget:
+    """Backoff between attempts of one transfer, gives up after `retries`"""
+
+    def __init__(self, retries=None, base_delay=None, max_delay=60, on_retry=None):
+        self.retries = Config.TRANSFER_RETRIES if retries is None else retries
+        self.base_delay = Config.TRANSFER_RETRY_DELAY if base_delay is None else base_delay
+        self.max_delay = max_delay
+        self.on_retry = on_retry
+        self.used = 0
+
+    async def wait(self, error):
+        """Sleep before the next attempt, re-raises `error` once the budget is spent"""
+        if self.used >= self.retries:
+            raise error
+        self.used += 1
+        if isinstance(error, FloodWait):
+            delay = error.value
+        else:
+            delay = min(self.max_delay, self.base_delay * 2 ** (self.used - 1)) * random.uniform(0.5, 1)
+        logger.warning(f"Transfer attempt {self.used}/{self.retries} failed ({error!r}), retrying in {delay:.1f}s")
+        if self.on_retry:
+            self.on_retry()
+        await asyncio.sleep(delay)
+
+
+async def _report(progress, current, total, progress_args):
+    if progress:
+        result = progress(current, total, *progress_args)
+        if inspect.isawaitable(result):
+            await result
+
+
+async def download(client, message, file_path, file_size, progress=None, progress_args=(), budget=None):
+    """Download the media of `message` to `file_path`, resuming at the last whole chunk"""
+    budget = budget or RetryBudget()
+    temp_path = f"{file_path}.temp"
+    os.makedirs(os.path.dirname(file_path) or ".", exist_ok=True)
+    done = 0
+    async with transfer_limit.slot():
+        with open(temp_path, "wb") as f:
+            while True:
+                try:
+                    async for chunk in client.stream_media(message, offset=done // DOWNLOAD_CHUNK):
+                        f.write(chunk)
+                        done += len(chunk)
+                        transfer_limit.add(len(chunk))
+                        await _report(progress, min(done, file_size) if file_size else done, file_size, progress_args)
+                    # get_file swallows transport errors and just stops yielding
+                    if file_size and done < file_size:
+                        raise TransferStalled(f"stream ended at {done}/{file_size} bytes")
+                    break
+                except StopTransmission:
+                    raise
+                except (TransferStalled, *TRANSIENT_ERRORS) as e:
+                    transfer_limit.record_error(e)
+                    await budget.wait(e)
+                    # Only whole chunks count as committed, a fresh copy of the message renews the file reference
+                    done -= done % DOWNLOAD_CHUNK
+                    f.seek(done)
+                    f.truncate()
+                    message = await client.get_messages(message.chat.id, message.id) or message
+    os.replace(temp_path, file_path)
+    return file_path
+
+
+async def send(method, budget=None, **kwargs):
+    """Call a client send_* method, retrying transient failures.
+
+    A retry does not upload the file again, `save_file` hands back the parts
+    already on Telegram's servers.
+    """
+    budget = budget or RetryBudget()
+    async with transfer_limit.slot():
+        while True:
+            try:
+                return await method(**kwargs)
+            except StopTransmission:
+                raise
+            except (TransferStalled, *TRANSIENT_ERRORS) as e:
+                transfer_limit.record_error(e)
+                await budget.wait(e)
+
+
+class _Upload:
+    """Parts of one file acknowledged by Telegram, under a single upload file_id"""
+
+    def __init__(self, path, size, file_id):
+        self.path = path
+        self.size = size
+        self.file_id = file_id
+        self.total_parts = math.ceil(size / UPLOAD_PART)
+        self.is_big = size > BIG_FILE
+        self.done = set()
+        self.input_file = None
+        self.touched = time.monotonic()
+
+    def rpc(self, part, chunk):
+        if self.is_big:
+            return raw.functions.upload.SaveBigFilePart(
+                file_id=self.file_id, file_part=part, file_total_parts=self.total_parts, bytes=chunk
+            )
+        return raw.functions.upload.SaveFilePart(file_id=self.file_id, file_part=part, bytes=chunk)
+
+
+# (path, size, mtime) -> _Upload, so a retried send reuses the parts
+_uploads = {}
+track("resumable uploads", lambda: _uploads)
+
+
+async def save_file(client, path, file_id=None, file_part=0, progress=None, progress_args=(), budget=None):
+    """Drop-in for Client.save_file on local paths, with per-part retries"""
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if stat.st_size == 0:
+        raise ValueError("File size equals to 0 B")
+    limit_mib = 4000 if client.me.is_premium else 2000
+    if stat.st_size > limit_mib * 1024 * 1024:
+        raise ValueError(f"Can't upload files bigger than {limit_mib} MiB")
+
+    # Uploaded parts are kept by Telegram for a while, not forever
+    now = time.monotonic()
+    for old_key, old in list(_uploads.items()):
+        if now - old.touched > Config.UPLOAD_REUSE_SECONDS:
+            del _uploads[old_key]
+
+    budget = budget or RetryBudget()
+    upload = _uploads.get(key)
+    if file_id is not None:
+        # FILE_PART_X_MISSING from the send: redo that one part
+        if upload is None or upload.file_id != file_id:
+            upload = _Upload(path, stat.st_size, file_id)
+            upload.done.update(range(upload.total_parts))
+        upload.done.discard(file_part)
+        await _upload_missing(client, upload, None, (), budget)
+        return None
+    if upload and upload.input_file:
+        logger.info(f"Reusing uploaded parts of {os.path.basename(path)}")
+        note_cache_hit()
+        await _report(progress, upload.size, upload.size, progress_args)
+        return upload.input_file
+    if upload is None:
+        upload = _uploads[key] = _Upload(path, stat.st_size, client.rnd_id())
+    upload.touched = now
+
+    try:
+        await _upload_missing(client, upload, progress, progress_args, budget)
+    except TRANSIENT_ERRORS + (TransferStalled,):
+        # Out of budget, a retried send still resumes from the acknowledged parts
+        raise
+    except BaseException:
+        _uploads.pop(key, None)
+        raise
+
+    name = os.path.basename(path)
+    if upload.is_big:
+        upload.input_file = raw.types.InputFileBig(id=upload.file_id, parts=upload.total_parts, name=name)
+    else:
+        checksum = await asyncio.to_thread(_md5, path)
+        upload.input_file = raw.types.InputFile(
+            id=upload.file_id, parts=upload.total_parts, name=name, md5_checksum=checksum
+        )
+    return upload.input_file
+
+
+def _md5(path):
+    digest = md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(UPLOAD_PART), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+async def _upload_missing(client, upload, progress, progress_args, budget):
+    while True:
+        missing = [part for part in range(upload.total_parts) if part not in upload.done]
+        if not missing:
+            return
+        try:
+            await _upload_parts(client, upload, missing, progress, progress_args)
+        except TRANSIENT_ERRORS as e:
+            await budget.wait(e)
+            continue
+        if len(upload.done) < upload.total_parts:
+            await budget.wait(TransferStalled(f"{upload.total_parts - len(upload.done)} parts not acknowledged"))
+
+
+async def _upload_parts(client, upload, parts, progress, progress_args):
+    """One pass over `parts` with save_file's session pool, failed parts stay out of upload.done"""
+    pool_size, workers_count = (3, 4) if upload.is_big else (1, 1)
+    queue = asyncio.Queue()
+    for part in parts:
+        queue.put_nowait(part)
+    pool = [
+        Session(
+            client, await client.storage.dc_id(), await client.storage.auth_key(),
+            await client.storage.test_mode(), is_media=True
+        ) for _ in range(pool_size)
+    ]
+    errors = []
+
+    async def worker(session, fd):
+        while not queue.empty() and not errors:
+            part = queue.get_nowait()
+            chunk = await asyncio.to_thread(os.pread, fd, UPLOAD_PART, part * UPLOAD_PART)
+            try:
+                await session.invoke(upload.rpc(part, chunk))
+            except TRANSIENT_ERRORS as e:
+                transfer_limit.record_error(e)
+                # The part is retried on the next pass, FloodWait stops this one
+                if isinstance(e, FloodWait):
+                    errors.append(e)
+                continue
+            except Exception as e:
+                errors.append(e)
+                return
+            upload.done.add(part)
+            transfer_limit.add(len(chunk))
+            await _report(progress, min(len(upload.done) * UPLOAD_PART, upload.size), upload.size, progress_args)
+
+    started = []
+    fd = os.open(upload.path, os.O_RDONLY)
+    try:
+        for session in pool:
+            await session.start()
+            started.append(session)
+        await asyncio.gather(*(worker(session, fd) for session in started for _ in range(workers_count)))
+    finally:
+        os.close(fd)
+        for session in started:
+            await session.stop()
+    if errors:
+        raise errors[0]
@@ -4,6 +4,10 @@ from pytz import timezone
 from config import Config, Txt 
 from pyrogram.types import InlineKeyboardButton, InlineKeyboardMarkup
 import re
+from .rate_limit import droppable
+
+# Cancels the job the progress message belongs to, see plugins/file_rename.py
+CANCEL_BUTTON = InlineKeyboardMarkup([[InlineKeyboardButton("• ᴄᴀɴᴄᴇʟ •", callback_data="cancel")]])
 
 
 async def progress_for_pyrogram(current, total, ud_type, message, start):
@@ -31,11 +35,13 @@ async def progress_for_pyrogram(current, total, ud_type, message, start):
             estimated_total_time if estimated_total_time != '' else "0 s"
         )
         try:
-            await message.edit(
-                text=f"{ud_type}\n\n{tmp}",               
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("• ᴄᴀɴᴄᴇʟ •", callback_data="close")]])                                               
-            )
-        except:
+            # Skipped when the chat has no message to spare, never holds up the transfer
+            with droppable():
+                await message.edit(
+                    text=f"{ud_type}\n\n{tmp}",               
+                    reply_markup=CANCEL_BUTTON
+                )
+        except Exception:
             pass
 
 def humanbytes(size):    
@@ -1,10 +1,23 @@
 from config import Config, Txt
 from helper.database import codeflixbots
+from helper.trace import trace_store
+from helper.job_queue import job_queue
+from helper.media_executor import media_executor
+from helper.cancel import cancel_registry
+from helper.adaptive_limit import transfer_limit, delivery_limit
+from helper.loop_watchdog import loop_watchdog
+from helper.pipeline import rename_pipeline
+from helper.fair_scheduler import rename_scheduler, sequence_scheduler
+from helper.rate_limit import rate_limiter, api_priority, LOW
+from helper.profiler import profiler, MAX_SECONDS
+from helper.memstat import memory_tracker, cache_stats, rss
+from helper.log import stop_logging
 from pyrogram.types import Message
 from pyrogram import Client, filters
 from pyrogram.errors import FloodWait, InputUserDeactivated, UserIsBlocked, PeerIdInvalid
-import os, sys, time, asyncio, logging, datetime
+import io, os, sys, time, asyncio, logging, datetime
 from pyrogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+from helper.utils import humanbytes
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -18,14 +31,16 @@ async def restart_bot(b, m):
     global is_restarting
     if not is_restarting:
         is_restarting = True
-        await m.reply_text("**Restarting.....**")
+        await m.reply_text(f"**Restarting.....** running jobs get {Config.DRAIN_TIMEOUT}s to finish")
+        # Stopping waits for every handler to return, this one included, so it runs on its own
+        b.restart_task = asyncio.create_task(restart(b))
 
-        # Gracefully stop the bot's event loop
-        b.stop()
-        time.sleep(2)  # Adjust the delay duration based on your bot's shutdown time
-
-        # Restart the bot process
-        os.execl(sys.executable, sys.executable, *sys.argv)
+async def restart(b):
+    """Drain and stop the bot, then replace the process"""
+    await b.stop()
+    # exec skips atexit, flush the log queue first
+    stop_logging()
+    os.execl(sys.executable, sys.executable, *sys.argv)
 
 
 @Client.on_message(filters.private & filters.command("tutorial"))
@@ -50,7 +65,115 @@ async def get_stats(bot, message):
     st = await message.reply('**Accessing The Details.....**')    
     end_t = time.time()
     time_taken_s = (end_t - start_t) * 1000
-    await st.edit(text=f"**--Bot Status--** \n\n**⌚️ Bot Uptime :** {uptime} \n**🐌 Current Ping :** `{time_taken_s:.3f} ms` \n**👭 Total Users :** `{total_users}`")
+    ffmpeg = media_executor.stats()
+    transfers, deliveries = transfer_limit.stats(), delivery_limit.stats()
+    api = rate_limiter.stats()
+    renames, sequences = rename_scheduler.stats(), sequence_scheduler.stats()
+    pipeline = " | ".join(f"{name} {s['active']}/{s['workers']} +{s['queued']} queued" for name, s in rename_pipeline.stats().items())
+    await st.edit(text=f"**--Bot Status--** \n\n**⌚️ Bot Uptime :** {uptime} \n**🐌 Current Ping :** `{time_taken_s:.3f} ms` \n**👭 Total Users :** `{total_users}` \n**🎞 FFmpeg :** `{ffmpeg['running']}/{ffmpeg['max_procs']} running, {ffmpeg['waiting']} waiting` \n**📶 Transfers :** `{transfers['in_flight']}/{transfers['limit']} running, {transfers['waiting']} waiting, {humanbytes(transfers['throughput'])}/s ({transfers['last']})` \n**📬 Deliveries :** `{deliveries['in_flight']}/{deliveries['limit']} running, {deliveries['throughput']}/s ({deliveries['last']})` \n**🚦 API :** `{api['waiting']} waiting, {api['cooling']} cooling down, {api['flood_waits']} FloodWaits, {api['dropped']} progress edits skipped` \n**🔀 Pipeline :** `{pipeline}` \n**⚖️ Fair queue :** `renames {renames['running']}/{renames['slots']} running, {renames['waiting']} waiting, {renames['saturated']} users at their limit | sequences {sequences['running']}/{sequences['slots']} running, {sequences['waiting']} waiting` \n**✖️ Cancelled :** `{cancel_registry.cancelled}`")
+
+@Client.on_message(filters.command("jobstats") & filters.user(Config.ADMIN))
+async def job_stats(bot, message):
+    """p50/p95 per job stage over the last N minutes (default 60)"""
+    minutes = int(message.command[1]) if len(message.command) > 1 and message.command[1].isdigit() else 60
+    statuses, stats = await trace_store.stage_percentiles(minutes)
+    jobs = sum(statuses.values())
+    if not jobs:
+        return await message.reply_text(f"No job traces in the last {minutes} minutes.")
+    lines = [
+        f"**--Job Stages ({jobs} jobs, last {minutes}m)--**",
+        " | ".join(f"{status} `{count}`" for status, count in sorted(statuses.items())) + "\n",
+    ]
+    for name, stage in sorted(stats.items(), key=lambda item: -item[1]["p95"]):
+        lines.append(f"`{name:<10}` n={stage['count']} p50=`{stage['p50']:.2f}s` p95=`{stage['p95']:.2f}s`")
+    await message.reply_text("\n".join(lines))
+
+@Client.on_message(filters.command("trace") & filters.user(Config.ADMIN))
+async def job_trace(bot, message):
+    """Show the stage trace of a single job by its message ID"""
+    if len(message.command) < 2 or not message.command[1].isdigit():
+        return await message.reply_text("**Usage:** `/trace <message_id>`")
+    trace = await trace_store.get(message.command[1])
+    if not trace:
+        return await message.reply_text("No trace found for that message.")
+    lines = [
+        f"**--{trace['kind'].capitalize()} Job {trace['message_id']}--**\n",
+        f"**User :** `{trace['user_id']}`",
+        f"**Status :** `{trace['status']}` in `{trace.get('duration', 0):.2f}s`",
+        f"**Media :** `{trace.get('media_type', '-')}` | `{humanbytes(trace.get('file_size')) or '-'}`",
+        f"**Cache hits :** `{trace['cache_hits']}` | **Retries :** `{trace['retries']}`\n",
+    ]
+    for stage in sorted(trace["stages"], key=lambda item: item["start"]):
+        offset = stage["start"] - trace["started_at"]
+        extra = f" {humanbytes(stage['bytes'])}" if stage.get("bytes") else ""
+        lines.append(f"`+{offset:7.2f}s` **{stage['name']}** `{stage['duration']:.2f}s`{extra}")
+    await message.reply_text("\n".join(lines))
+
+@Client.on_message(filters.command("queue") & filters.user(Config.ADMIN))
+async def queue_stats(bot, message):
+    """Backlog of the shared rename job queue"""
+    backlog = await job_queue.backlog()
+    await message.reply_text(
+        f"**--Job Queue--** (`{Config.BOT_MODE}`)\n\n"
+        f"**Queued :** `{backlog['queued']}`\n"
+        f"**Running :** `{backlog['running']}`\n"
+        f"**Failed :** `{backlog['failed']}`\n"
+        f"**Live workers :** `{backlog['workers']}`"
+    )
+
+@Client.on_message(filters.command("looplag") & filters.user(Config.ADMIN))
+async def loop_lag(bot, message):
+    """Call sites that blocked the event loop the longest, `/looplag stack` adds their stacks"""
+    offenders = loop_watchdog.top()
+    if not offenders:
+        return await message.reply_text(f"No event loop stalls over {loop_watchdog.threshold}s so far.")
+    show_stack = len(message.command) > 1 and message.command[1] == "stack"
+    lines = [f"**--Event Loop Stalls--** (`{loop_watchdog.stalls}`, worst `{loop_watchdog.worst:.2f}s`)\n"]
+    for site, offender in offenders:
+        lines.append(f"`{site}`\nn={offender['count']} total=`{offender['total']:.2f}s` worst=`{offender['worst']:.2f}s`")
+        if show_stack and offender["stack"]:
+            lines.append(f"```\n{offender['stack'][-1500:]}```")
+    await message.reply_text("\n".join(lines))
+
+@Client.on_message(filters.command("profile") & filters.user(Config.ADMIN))
+async def profile_bot(bot, message):
+    """Sample every thread for N seconds (default 30), results go to LOG_CHANNEL"""
+    seconds = int(message.command[1]) if len(message.command) > 1 and message.command[1].isdigit() else 30
+    seconds = max(1, min(seconds, MAX_SECONDS))
+    if profiler.running:
+        return await message.reply_text("A profile is already running.")
+    status = await message.reply_text(f"**Profiling for {seconds}s...**")
+    result = await profiler.profile(seconds)
+    stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+    for name, text in ((f"profile-{stamp}.collapsed.txt", result.collapsed()), (f"profile-{stamp}.top.txt", result.summary())):
+        document = io.BytesIO(text.encode())
+        document.name = name
+        await bot.send_document(Config.LOG_CHANNEL, document, caption=f"`/profile {seconds}` by {message.from_user.mention}")
+    await status.edit_text(f"**Profile done:** {result.samples} samples, sent to the log channel.")
+
+@Client.on_message(filters.command("memstat") & filters.user(Config.ADMIN))
+async def memory_stats(bot, message):
+    """RSS, internal caches and tracemalloc sites, `/memstat stop` ends tracing"""
+    if len(message.command) > 1 and message.command[1] == "stop":
+        memory_tracker.stop()
+        return await message.reply_text("tracemalloc stopped.")
+    lines = [f"**--Memory--**\n\n**RSS :** `{humanbytes(rss())}`\n", "**Caches :**"]
+    # Walks up to 200k objects per cache, off the event loop
+    for name, entries, size in await asyncio.to_thread(cache_stats, bot):
+        lines.append(f"`{name}` {entries} entries, `{humanbytes(size) or '0 B'}`")
+    snapshot = await asyncio.to_thread(memory_tracker.snapshot)
+    if snapshot is None:
+        lines.append("\ntracemalloc started, run /memstat again for allocation sites.")
+        return await message.reply_text("\n".join(lines))
+    lines.append(f"\n**Traced :** `{humanbytes(snapshot['traced'])}` (peak `{humanbytes(snapshot['peak'])}`)\n\n**Top sites :**")
+    for site, size, count in snapshot["top"]:
+        lines.append(f"`{humanbytes(size)}` x{count} `{site}`")
+    if snapshot["diff"]:
+        lines.append(f"\n**Since last /memstat ({snapshot['diff']['seconds']:.0f}s) :**")
+        for site, size, count in snapshot["diff"]["sites"]:
+            sign = "+" if size > 0 else "-"
+            lines.append(f"`{sign}{humanbytes(abs(size))}` {count:+d} `{site}`")
+    await message.reply_text("\n".join(lines)[:4096])
 
 @Client.on_message(filters.command("broadcast") & filters.user(Config.ADMIN) & filters.reply)
 async def broadcast_handler(bot: Client, m: Message):
@@ -63,17 +186,19 @@ async def broadcast_handler(bot: Client, m: Message):
     success = 0
     start_time = time.time()
     total_users = await codeflixbots.total_users_count()
-    async for user in all_users:
-        sts = await send_msg(user['_id'], broadcast_msg)
-        if sts == 200:
-           success += 1
-        else:
-           failed += 1
-        if sts == 400:
-           await codeflixbots.delete_user(user['_id'])
-        done += 1
-        if not done % 20:
-           await sts_msg.edit(f"Broadcast In Progress: \n\nTotal Users {total_users} \nCompleted : {done} / {total_users}\nSuccess : {success}\nFailed : {failed}")
+    # Behind every user-facing call, the rate limiter paces it
+    with api_priority(LOW):
+        async for user in all_users:
+            sts = await send_msg(user['_id'], broadcast_msg)
+            if sts == 200:
+               success += 1
+            else:
+               failed += 1
+            if sts == 400:
+               await codeflixbots.delete_user(user['_id'])
+            done += 1
+            if not done % 20:
+               await sts_msg.edit(f"Broadcast In Progress: \n\nTotal Users {total_users} \nCompleted : {done} / {total_users}\nSuccess : {success}\nFailed : {failed}")
     completed_in = datetime.timedelta(seconds=int(time.time() - start_time))
     await sts_msg.edit(f"Bʀᴏᴀᴅᴄᴀꜱᴛ Cᴏᴍᴩʟᴇᴛᴇᴅ: \nCᴏᴍᴩʟᴇᴛᴇᴅ Iɴ `{completed_in}`.\n\nTotal Users {total_users}\nCompleted: {done} / {total_users}\nSuccess: {success}\nFailed: {failed}")
            
@@ -82,8 +207,9 @@ async def send_msg(user_id, message):
         await message.copy(chat_id=int(user_id))
         return 200
     except FloodWait as e:
+        # Longer than FLOOD_SLEEP_THRESHOLD, the rate limiter waited out the shorter ones
         await asyncio.sleep(e.value)
-        return send_msg(user_id, message)
+        return await send_msg(user_id, message)
     except InputUserDeactivated:
         logger.info(f"{user_id} : Deactivated")
         return 400
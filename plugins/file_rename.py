@@ -4,34 +4,30 @@ import time
 import shutil
 import asyncio
 import logging
-from datetime import datetime
-from PIL import Image
+from datetime import timedelta
+from functools import partial
 from pyrogram import Client, filters
 from pyrogram.errors import FloodWait
 from pyrogram.types import InputMediaDocument, Message
-from hachoir.metadata import extractMetadata
-from hachoir.parser import createParser
 from plugins.antinsfw import check_anti_nsfw
-from helper.utils import progress_for_pyrogram, humanbytes, convert
+from plugins.sequence import is_in_sequence_mode
+from helper.utils import progress_for_pyrogram, humanbytes, convert, CANCEL_BUTTON
 from helper.database import codeflixbots
+from helper.trace import JobTrace
+from helper.job_queue import job_queue
+from helper.cancel import cancel_registry
+from helper.journal import journal
+from helper.pipeline import rename_pipeline
+from helper.fair_scheduler import rename_scheduler, weights
+from helper.media_executor import media_executor, MediaProbe
+from helper.container_tags import patch_tags
+from helper.audio_tags import tag_audio
+from helper.log import bind_log_context
+from helper import transfer
 from config import Config
-from pymongo import MongoClient
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
 logger = logging.getLogger(__name__)
 
-# Global dictionary to track ongoing operations
-renaming_operations = {}
-
-# Database connection for checking sequence mode
-db_client = MongoClient(Config.DB_URL)
-db = db_client[Config.DB_NAME]
-sequence_collection = db["active_sequences"]
-
 # Enhanced regex patterns for season and episode extraction
 SEASON_EPISODE_PATTERNS = [
     # Standard patterns (S01E02, S01EP02)
@@ -59,9 +55,10 @@ QUALITY_PATTERNS = [
     (re.compile(r'\[(\d{3,4}[pi])\]', re.IGNORECASE), lambda m: m.group(1))  # [1080p]
 ]
 
-def is_in_sequence_mode(user_id):
-    """Check if user is in sequence mode"""
-    return sequence_collection.find_one({"user_id": user_id}) is not None
+# Seconds into a video to take the extracted thumbnail from, skips black intro frames
+THUMB_AT = 10
+# Documents with these extensions get an extracted thumbnail as well
+VIDEO_EXTENSIONS = (".mkv", ".mp4", ".avi", ".webm", ".mov", ".m4v", ".ts")
 
 def extract_season_episode(filename):
     """Extract season and episode numbers from filename"""
@@ -69,10 +66,10 @@ def extract_season_episode(filename):
         match = pattern.search(filename)
         if match:
             season = match.group(1) if season_group else None
-            episode = match.group(2) if episode_group else match.group(1)
-            logger.info(f"Extracted season: {season}, episode: {episode} from {filename}")
+            episode = match.group(2) if season_group else match.group(1)
+            logger.info(f"Extracted season: {season}, episode: {episode} from {filename}", extra={"sample": "extract"})
             return season, episode
-    logger.warning(f"No season/episode pattern matched for {filename}")
+    logger.warning(f"No season/episode pattern matched for {filename}", extra={"sample": "extract_miss"})
     return None, None
 
 def extract_quality(filename):
@@ -81,11 +78,26 @@ def extract_quality(filename):
         match = pattern.search(filename)
         if match:
             quality = extractor(match)
-            logger.info(f"Extracted quality: {quality} from {filename}")
+            logger.info(f"Extracted quality: {quality} from {filename}", extra={"sample": "extract"})
             return quality
-    logger.warning(f"No quality pattern matched for {filename}")
+    logger.warning(f"No quality pattern matched for {filename}", extra={"sample": "extract_miss"})
     return "Unknown"
 
+def apply_format_template(format_template, season, episode, quality):
+    """Replace placeholders in the user's rename template"""
+    replacements = {
+        '{season}': season or 'XX',
+        '{episode}': episode or 'XX',
+        '{quality}': quality,
+        'Season': season or 'XX',
+        'Episode': episode or 'XX',
+        'QUALITY': quality
+    }
+
+    for placeholder, value in replacements.items():
+        format_template = format_template.replace(placeholder, value)
+    return format_template
+
 async def cleanup_files(*paths):
     """Safely remove files if they exist"""
     for path in paths:
@@ -101,69 +113,162 @@ async def process_thumbnail(thumb_path):
         return None
     
     try:
-        with Image.open(thumb_path) as img:
-            img = img.convert("RGB").resize((320, 320))
-            img.save(thumb_path, "JPEG")
+        await asyncio.to_thread(resize_thumbnail, thumb_path)
         return thumb_path
     except Exception as e:
         logger.error(f"Thumbnail processing failed: {e}")
         await cleanup_files(thumb_path)
         return None
 
-async def add_metadata(input_path, output_path, user_id):
-    """Add metadata to media file using ffmpeg"""
+def resize_thumbnail(thumb_path):
+    from PIL import Image  # Deferred, only needed once a thumbnail exists
+
+    with Image.open(thumb_path) as img:
+        img = img.convert("RGB").resize((320, 320))
+        img.save(thumb_path, "JPEG")
+
+async def load_metadata(user_id):
+    """The user's metadata tags, keyed as add_metadata expects them"""
+    title, artist, author, video, audio, subtitle = await asyncio.gather(
+        codeflixbots.get_title(user_id),
+        codeflixbots.get_artist(user_id),
+        codeflixbots.get_author(user_id),
+        codeflixbots.get_video(user_id),
+        codeflixbots.get_audio(user_id),
+        codeflixbots.get_subtitle(user_id),
+    )
+    return {
+        'title': title,
+        'artist': artist,
+        'author': author,
+        'video_title': video,
+        'audio_title': audio,
+        'subtitle': subtitle
+    }
+
+async def load_settings(chat_id, user_id):
+    """Everything a rename reads from the user's settings, fetched concurrently"""
+    caption, thumb, media_preference, metadata = await asyncio.gather(
+        codeflixbots.get_caption(chat_id),
+        codeflixbots.get_thumbnail(chat_id),
+        codeflixbots.get_media_preference(user_id),
+        load_metadata(user_id),
+    )
+    return dict(caption=caption, thumb=thumb, media_preference=media_preference, metadata=metadata)
+
+async def prepare_thumbnail(client, settings, thumb_path):
+    """Download and resize the user's own thumbnail, None when they have none"""
+    thumb = (await settings)["thumb"]
+    if not thumb:
+        return None
+    return await process_thumbnail(await client.download_media(thumb, file_name=thumb_path))
+
+async def add_metadata(input_path, output_path, user_id, thumb_path=None, audio=False, metadata=None):
+    """Tag the file, rewriting only its header when the container allows it.
+
+    `audio` files go through the native audio tagger first. Otherwise ffmpeg remuxes it in one read, optionally grabbing a thumbnail
+    too. `metadata` is loaded for `user_id` unless given. Returns the
+    executor result (None when ffmpeg did not run) and a MediaProbe with
+    the duration and streams (None when ffmpeg is missing).
+    """
+    if metadata is None:
+        metadata = await load_metadata(user_id)
     ffmpeg = shutil.which('ffmpeg')
+
+    # Audio uploads are tagged natively, no process spawn and no copy
+    if audio and Config.INPLACE_TAGS:
+        probe = await asyncio.to_thread(tag_audio, input_path, output_path, metadata)
+        if probe:
+            return None, probe
+
+    # MKV/MP4 header patch, its cost does not grow with the file size
+    if Config.INPLACE_TAGS:
+        probe = await asyncio.to_thread(patch_tags, input_path, output_path, metadata)
+        if probe:
+            result = await extract_thumbnail(ffmpeg, output_path, thumb_path) if thumb_path and ffmpeg else None
+            return result, probe
+
     if not ffmpeg:
         logger.warning("FFmpeg not found in PATH, skipping metadata addition")
         # Just copy the file instead of adding metadata
         try:
             shutil.copy2(input_path, output_path)
-            return
+            return None, None
         except Exception as e:
             logger.error(f"Error copying file: {e}")
             # If copying fails, we'll just use the original file
             raise RuntimeError(f"Failed to process file: {e}")
     
-    metadata = {
-        'title': await codeflixbots.get_title(user_id),
-        'artist': await codeflixbots.get_artist(user_id),
-        'author': await codeflixbots.get_author(user_id),
-        'video_title': await codeflixbots.get_video(user_id),
-        'audio_title': await codeflixbots.get_audio(user_id),
-        'subtitle': await codeflixbots.get_subtitle(user_id)
-    }
-    
+    def build(thumb_path):
+        cmd = [ffmpeg, '-hide_banner', '-nostats', '-y']
+        if thumb_path:
+            # Only keyframes get decoded, the stream copy is unaffected
+            cmd += ['-skip_frame', 'nokey']
+        cmd += [
+            '-i', input_path,
+            '-metadata', f'title={metadata["title"]}',
+            '-metadata', f'artist={metadata["artist"]}',
+            '-metadata', f'author={metadata["author"]}',
+            '-metadata:s:v', f'title={metadata["video_title"]}',
+            '-metadata:s:a', f'title={metadata["audio_title"]}',
+            '-metadata:s:s', f'title={metadata["subtitle"]}',
+            '-map', '0',
+            '-c', 'copy',
+            '-threads', str(media_executor.threads),
+            output_path
+        ]
+        if thumb_path:
+            # Second output from the same read: first keyframe past THUMB_AT, skipping cover art
+            cmd += [
+                '-map', '0:V:0?',
+                '-vf', f"select='gte(t,{THUMB_AT})',scale=320:-2",
+                '-frames:v', '1',
+                '-q:v', '3',
+                thumb_path
+            ]
+        return cmd
+
+    probe = MediaProbe()
+    result = await media_executor.run(build(thumb_path), on_stderr=probe.feed)
+    if result.returncode != 0 and not result.timed_out and thumb_path:
+        # Do not lose the rename over a thumbnail, retry with the tagged output only
+        logger.warning(f"Thumbnail extraction failed, retrying without it: {result.stderr}")
+        await cleanup_files(thumb_path)
+        probe = MediaProbe()
+        result = await media_executor.run(build(None), on_stderr=probe.feed)
+    if result.timed_out:
+        raise RuntimeError(f"FFmpeg timed out after {result.run_time:.0f}s")
+    if result.returncode != 0:
+        raise RuntimeError(f"FFmpeg error: {result.stderr}")
+    return result, probe
+
+async def extract_thumbnail(ffmpeg, file_path, thumb_path):
+    """Grab a thumbnail with an input seek, reading only around THUMB_AT"""
     cmd = [
-        ffmpeg,
-        '-i', input_path,
-        '-metadata', f'title={metadata["title"]}',
-        '-metadata', f'artist={metadata["artist"]}',
-        '-metadata', f'author={metadata["author"]}',
-        '-metadata:s:v', f'title={metadata["video_title"]}',
-        '-metadata:s:a', f'title={metadata["audio_title"]}',
-        '-metadata:s:s', f'title={metadata["subtitle"]}',
-        '-map', '0',
-        '-c', 'copy',
-        '-loglevel', 'error',
-        output_path
+        ffmpeg, '-hide_banner', '-nostats', '-y',
+        '-ss', str(THUMB_AT), '-skip_frame', 'nokey',
+        '-i', file_path,
+        '-map', '0:V:0?',
+        '-vf', 'scale=320:-2',
+        '-frames:v', '1',
+        '-q:v', '3',
+        thumb_path
     ]
-    
-    process = await asyncio.create_subprocess_exec(
-        *cmd,
-        stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.PIPE
-    )
-    _, stderr = await process.communicate()
-    
-    if process.returncode != 0:
-        raise RuntimeError(f"FFmpeg error: {stderr.decode()}")
+    result = await media_executor.run(cmd)
+    if result.returncode != 0:
+        logger.warning(f"Thumbnail extraction failed: {result.stderr}")
+        await cleanup_files(thumb_path)
+    return result
 
 def get_file_duration(file_path):
     """Get duration of media file"""
+    from hachoir.metadata import extractMetadata  # Deferred, hachoir is slow to import
+    from hachoir.parser import createParser
+
     try:
         metadata = extractMetadata(createParser(file_path))
         if metadata is not None and metadata.has("duration"):
-            return str(datetime.timedelta(seconds=int(metadata.get("duration").seconds)))
+            return str(timedelta(seconds=int(metadata.get("duration").seconds)))
         return "00:00:00"
     except Exception as e:
         logger.error(f"Error getting duration: {e}")
@@ -185,6 +290,18 @@ def format_caption(caption_template, filename, filesize, duration):
     
     return caption
         
+def get_media_info(message):
+    """Return (file_id, file_unique_id, file_name, file_size, media_type) of a media message"""
+    if message.document:
+        media, file_name, media_type = message.document, message.document.file_name, "document"
+    elif message.video:
+        media, file_name, media_type = message.video, message.video.file_name or "video", "video"
+    elif message.audio:
+        media, file_name, media_type = message.audio, message.audio.file_name or "audio", "audio"
+    else:
+        return None
+    return media.file_id, media.file_unique_id, file_name, media.file_size, media_type
+
 # Use a higher group number to ensure it only runs if the sequence handler doesn't handle the message
 @Client.on_message(filters.private & (filters.document | filters.video | filters.audio), group=1)
 async def auto_rename_files(client, message):
@@ -202,7 +319,7 @@ async def auto_rename_files(client, message):
         )
     
     # Skip if user is in sequence mode
-    if is_in_sequence_mode(user_id):
+    if await is_in_sequence_mode(user_id):
         logger.info(f"User {user_id} is in sequence mode, skipping rename")
         return
     
@@ -212,130 +329,262 @@ async def auto_rename_files(client, message):
         return await message.reply_text("Please set a rename format using /autorename")
 
     # Get file information
-    if message.document:
-        file_id = message.document.file_id
-        file_name = message.document.file_name
-        file_size = message.document.file_size
-        media_type = "document"
-    elif message.video:
-        file_id = message.video.file_id
-        file_name = message.video.file_name or "video"
-        file_size = message.video.file_size
-        media_type = "video"
-    elif message.audio:
-        file_id = message.audio.file_id
-        file_name = message.audio.file_name or "audio"
-        file_size = message.audio.file_size
-        media_type = "audio"
-    else:
+    media_info = get_media_info(message)
+    if media_info is None:
         return await message.reply_text("Unsupported file type")
+    file_id, file_unique_id, file_name, file_size, media_type = media_info
 
     # NSFW check
     if await check_anti_nsfw(file_name, message):
         return await message.reply_text("NSFW content detected")
 
-    # Prevent duplicate processing
-    if file_id in renaming_operations:
-        if (datetime.now() - renaming_operations[file_id]).seconds < 10:
-            return
-    renaming_operations[file_id] = datetime.now()
+    # Prevent duplicate processing, across every bot process
+    lock_owner = f"{message.chat.id}:{message.id}"
+    if not await job_queue.acquire_lock(file_unique_id, lock_owner, Config.JOB_LOCK_TTL):
+        return
+
+    if Config.BOT_MODE == "coordinator":
+        # Hand the job to a worker process
+        try:
+            msg = await message.reply_text("**Queued for renaming...**", reply_markup=CANCEL_BUTTON)
+            await job_queue.enqueue(
+                "rename", user_id=user_id, chat_id=message.chat.id, message_id=message.id,
+                status_id=msg.id, lock=file_unique_id, lock_owner=lock_owner,
+            )
+        except Exception:
+            await job_queue.release_lock(file_unique_id, lock_owner)
+            raise
+        return
+
+    if cancel_registry.draining:
+        # Restarting: journal it, the next process picks it up
+        msg = await message.reply_text("**Bot is restarting, your file will be renamed right after...**", reply_markup=CANCEL_BUTTON)
+        return await journal.record(dict(
+            kind="rename", user_id=user_id, chat_id=message.chat.id, message_id=message.id,
+            status_id=msg.id, lock=file_unique_id, lock_owner=lock_owner,
+        ))
+
+    # Detached: waiting for a fair queue turn or a pipeline stage must not hold a dispatcher worker
+    return cancel_registry.spawn(
+        process_rename(client, message, format_template, lock_owner=lock_owner), name=lock_owner,
+    )
+
+@Client.on_callback_query(filters.regex(r"^cancel$"))
+async def cancel_rename(client, query):
+    """Cancel button on a job's status message"""
+    chat_id, status_id, user_id = query.message.chat.id, query.message.id, query.from_user.id
+    if cancel_registry.cancel(chat_id, status_id, user_id):
+        return await query.answer("Cancelling...")
+    if Config.BOT_MODE == "coordinator":
+        # The job is queued or runs on a worker
+        job = await job_queue.request_cancel(chat_id, status_id, user_id)
+        if isinstance(job, dict):
+            await job_queue.release_lock(job["lock"], job["lock_owner"])
+            cancel_registry.cancelled += 1
+            await query.message.edit("**Cancelled.**")
+            return await query.answer("Cancelled")
+        if job:
+            # Counted by the worker once it picks the flag up
+            return await query.answer("Cancelling...")
+    await query.answer("Nothing to cancel", show_alert=True)
+
+async def run_rename_job(client, job):
+    """Worker side of a queued rename job"""
+    message, msg = await client.get_messages(job["chat_id"], [job["message_id"], job["status_id"]])
+    if not message or message.empty:
+        await journal.remove(job["lock_owner"])
+        return await job_queue.release_lock(job["lock"], job["lock_owner"])
+    await process_rename(client, message, status_message=msg, lock_owner=job["lock_owner"])
+
+job_queue.register("rename", run_rename_job)
+
+async def resume_journal(client):
+    """Pick up the jobs the last restart or crash cut off (standalone mode)"""
+    resumable, given_up = await journal.recover()
+    for entry in given_up:
+        logger.warning(f"Giving up on job {entry['_id']} after {entry['attempts'] - 1} resumes")
+        await job_queue.release_lock(entry["lock"], entry["lock_owner"])
+        try:
+            await client.edit_message_text(entry["chat_id"], entry["status_id"], "**Rename failed, please send the file again.**")
+        except Exception:
+            pass
+    if resumable:
+        logger.info(f"Resuming {len(resumable)} journaled jobs")
+    await asyncio.gather(*(resume_job(client, entry) for entry in resumable))
+
+async def resume_job(client, entry):
+    try:
+        if not await job_queue.acquire_lock(entry["lock"], entry["lock_owner"], Config.JOB_LOCK_TTL):
+            # The file was sent again meanwhile and is being renamed already
+            return await journal.remove(entry["_id"])
+        await cancel_registry.run(run_rename_job(client, entry))
+    except Exception as e:
+        logger.error(f"Error resuming job {entry['_id']}: {e}")
+
+async def process_rename(client, message, format_template=None, status_message=None, lock_owner=None):
+    """Download, rename, tag and upload a single file"""
+    user_id = message.from_user.id
+    file_id, file_unique_id, file_name, file_size, media_type = get_media_info(message)
+    if format_template is None:
+        format_template = await codeflixbots.get_format_template(user_id)
 
     # Initialize paths to None for proper cleanup handling
     download_path = None
     metadata_path = None
     thumb_path = None
+    msg = None
+    settings = thumb_task = fair_ticket = None
+    pipeline_job = rename_pipeline.job()
+    # Queued jobs are tracked by the job queue, local ones by the journal
+    journaled = lock_owner is not None and Config.BOT_MODE != "worker"
+    # Runs in a task of its own, so this only tags this job's records
+    bind_log_context(job=f"{message.chat.id}:{message.id}", user=user_id)
+
+    trace = JobTrace("rename", user_id, message.id, media_type=media_type, file_size=file_size, worker=Config.WORKER_ID)
+    trace.bind()
+    status = "failed"
 
     try:
         # Extract metadata from filename
-        season, episode = extract_season_episode(file_name)
-        quality = extract_quality(file_name)
-        
-        # Replace placeholders in template
-        replacements = {
-            '{season}': season or 'XX',
-            '{episode}': episode or 'XX',
-            '{quality}': quality,
-            'Season': season or 'XX',
-            'Episode': episode or 'XX',
-            'QUALITY': quality
-        }
-        
-        for placeholder, value in replacements.items():
-            format_template = format_template.replace(placeholder, value)
+        with trace.stage("parse"):
+            season, episode = extract_season_episode(file_name)
+            quality = extract_quality(file_name)
+
+            format_template = apply_format_template(format_template, season, episode, quality)
 
         # Prepare file paths
         ext = os.path.splitext(file_name)[1] or ('.mp4' if media_type == 'video' else '.mp3')
         new_filename = f"{format_template}{ext}"
-        download_path = f"downloads/{new_filename}"
-        metadata_path = f"metadata/{new_filename}"
+        # A directory per job: two files can rename to the same name, and the
+        # tagged file may share its inode with the download
+        job_dir = f"{message.chat.id}_{message.id}"
+        download_path = f"downloads/{job_dir}/{new_filename}"
+        metadata_path = f"metadata/{job_dir}/{new_filename}"
         
         os.makedirs(os.path.dirname(download_path), exist_ok=True)
         os.makedirs(os.path.dirname(metadata_path), exist_ok=True)
 
         # Download file
-        msg = await message.reply_text("**Downloading...**")
-        try:
-            file_path = await client.download_media(
-                message,
-                file_name=download_path,
-                progress=progress_for_pyrogram,
-                progress_args=("Downloading...", msg, time.time())
-            )
-        except Exception as e:
-            await msg.edit(f"Download failed: {e}")
-            raise
+        if status_message and not status_message.empty:
+            msg = await status_message.edit("**Downloading...**", reply_markup=CANCEL_BUTTON)
+        else:
+            msg = await message.reply_text("**Downloading...**", reply_markup=CANCEL_BUTTON)
+        cancel_registry.register(message.chat.id, msg.id, user_id)
+        if journaled:
+            await journal.record(dict(
+                kind="rename", user_id=user_id, chat_id=message.chat.id, message_id=message.id,
+                status_id=msg.id, lock=file_unique_id, lock_owner=lock_owner,
+            ))
 
-        # Process metadata
-        await msg.edit("**Processing metadata...**")
-        try:
-            await add_metadata(file_path, metadata_path, user_id)
-            file_path = metadata_path
-        except Exception as e:
-            await msg.edit(f"Metadata processing failed: {e}")
-            raise
+        # Other users' files go first while this user has their share running
+        tier, weight = await weights.of(user_id)
+        fair_ticket = rename_scheduler.ticket(user_id, weight, file_size)
+        trace.set(tier=tier)
+        await fair_ticket.admit(on_wait=partial(msg.edit, "**Queued, other users' files first...**", reply_markup=CANCEL_BUTTON))
 
-        # Get duration for video/audio files
-        duration = "00:00:00"
-        if media_type in ["video", "audio"]:
-            duration = get_file_duration(file_path)
+        # Settings, and the user's thumbnail once they are known, load while the file downloads
+        async def timed_settings():
+            with trace.stage("settings"):
+                return await load_settings(message.chat.id, user_id)
 
-        # Prepare for upload
-        await msg.edit("**Preparing upload...**")
-        
-        # Get caption template and replace variables
-        caption_template = await codeflixbots.get_caption(message.chat.id)
-        if caption_template:
-            caption = format_caption(caption_template, new_filename, file_size, duration)
-        else:
-            caption = f"**{new_filename}**"
-            
-        thumb = await codeflixbots.get_thumbnail(message.chat.id)
+        async def timed_thumbnail():
+            with trace.stage("thumbnail"):
+                return await prepare_thumbnail(client, settings, f"downloads/{job_dir}/thumb.jpg")
 
-        # Handle thumbnail - initialize thumb_path explicitly
-        if thumb:
-            thumb_path = await client.download_media(thumb)
-        elif media_type == "video" and message.video.thumbs:
-            thumb_path = await client.download_media(message.video.thumbs[0].file_id)
-        
-        # Only process if thumb_path was set
-        if thumb_path:
-            thumb_path = await process_thumbnail(thumb_path)
+        settings = asyncio.create_task(timed_settings())
+        thumb_task = asyncio.create_task(timed_thumbnail())
 
-        # Get user's media preference
-        user_media_preference = await codeflixbots.get_media_preference(user_id)
-        logger.info(f"User {user_id} media preference: {user_media_preference}")
-        
-        # If no preference set, use original media type
-        if not user_media_preference:
-            user_media_preference = media_type
-            logger.info(f"No preference set, using original type: {media_type}")
-        else:
-            # Convert to lowercase for consistent comparison
-            user_media_preference = user_media_preference.lower()
-            logger.info(f"Using user's preference: {user_media_preference}")
+        async with pipeline_job.stage("download", on_wait=partial(msg.edit, "**Waiting for a download slot...**", reply_markup=CANCEL_BUTTON)):
+            try:
+                with trace.stage("download", bytes=file_size):
+                    file_path = await transfer.download(
+                        client,
+                        message,
+                        download_path,
+                        file_size,
+                        progress=progress_for_pyrogram,
+                        progress_args=("Downloading...", msg, time.time()),
+                        budget=transfer.RetryBudget(on_retry=trace.retry),
+                    )
+            except Exception as e:
+                await msg.edit(f"Download failed: {e}")
+                raise
+
+        async with pipeline_job.stage("process", on_wait=partial(msg.edit, "**Waiting to process...**", reply_markup=CANCEL_BUTTON)):
+            # The metadata pass only grabs a thumbnail when the user has none
+            user_settings = await settings
+            caption_template = user_settings["caption"]
+            thumb = user_settings["thumb"]
+            user_media_preference = user_settings["media_preference"]
+            is_video = media_type == "video" or ext.lower() in VIDEO_EXTENSIONS
+            is_audio = media_type == "audio" or (user_media_preference or "").lower() == "audio"
+            extract_path = f"{metadata_path}.jpg" if not thumb and is_video else None
+
+            # Process metadata, thumbnail and duration in one ffmpeg pass
+            await msg.edit("**Processing metadata...**", reply_markup=CANCEL_BUTTON)
+            try:
+                with trace.stage("metadata", bytes=file_size) as stage:
+                    result, probe = await add_metadata(
+                        file_path, metadata_path, user_id, thumb_path=extract_path, audio=is_audio,
+                        metadata=user_settings["metadata"],
+                    )
+                    if result:
+                        stage.update(queue_wait=round(result.queue_wait, 3), run_time=round(result.run_time, 3))
+                    if probe:
+                        stage["method"] = probe.source
+                file_path = metadata_path
+            except Exception as e:
+                await cleanup_files(extract_path)
+                await msg.edit(f"Metadata processing failed: {e}")
+                raise
+
+            if extract_path and os.path.exists(extract_path) and os.path.getsize(extract_path):
+                thumb_path = extract_path
+            else:
+                await cleanup_files(extract_path)
+
+            # Get duration for video/audio files, hachoir only when ffmpeg could not tell
+            duration_seconds = int(probe.duration) if probe and probe.duration else None
+            duration = "00:00:00"
+            if duration_seconds is not None:
+                duration = str(timedelta(seconds=duration_seconds))
+            elif media_type in ["video", "audio"]:
+                with trace.stage("duration"):
+                    duration = await asyncio.to_thread(get_file_duration, file_path)
+
+            # Prepare for upload
+            await msg.edit("**Preparing upload...**", reply_markup=CANCEL_BUTTON)
+
+            if caption_template:
+                caption = format_caption(caption_template, new_filename, file_size, duration)
+            else:
+                caption = f"**{new_filename}**"
+
+            # Handle thumbnail - the user's own wins, Telegram's is the last resort
+            if thumb:
+                thumb_path = await thumb_task
+            elif not thumb_path and media_type == "video" and message.video.thumbs:
+                with trace.stage("thumbnail"):
+                    thumb_path = await client.download_media(message.video.thumbs[0].file_id)
+                    if thumb_path:
+                        thumb_path = await process_thumbnail(thumb_path)
+
+            # If no preference set, use original media type
+            if not user_media_preference:
+                user_media_preference = media_type
+            else:
+                # Convert to lowercase for consistent comparison
+                user_media_preference = user_media_preference.lower()
+
+            # Fallback to original media type if preference is invalid
+            if user_media_preference not in ("document", "video", "audio"):
+                logger.warning(f"Invalid preference: {user_media_preference}, using original: {media_type}")
+                user_media_preference = media_type
+            logger.info(f"Sending as {user_media_preference} (original type: {media_type})", extra={"sample": "media_preference"})
 
         # Upload file
-        await msg.edit("**Uploading...**")
+        await msg.edit("**Uploading...**", reply_markup=CANCEL_BUTTON)
+        trace.set(upload_type=user_media_preference)
         try:
             upload_params = {
                 'chat_id': message.chat.id,
@@ -348,32 +597,71 @@ async def auto_rename_files(client, message):
             if thumb_path:
                 upload_params['thumb'] = thumb_path
 
+            # Stream info from the metadata pass saves Telegram a probe of its own
+            if duration_seconds and user_media_preference in ("video", "audio"):
+                upload_params['duration'] = duration_seconds
+            if probe and probe.video and "width" in probe.video and user_media_preference == "video":
+                upload_params['width'] = probe.video['width']
+                upload_params['height'] = probe.video['height']
+
             # Use user's media preference for sending
-            if user_media_preference == "document":
-                await client.send_document(document=file_path, **upload_params)
-            elif user_media_preference == "video":
-                await client.send_video(video=file_path, **upload_params)
-            elif user_media_preference == "audio":
-                await client.send_audio(audio=file_path, **upload_params)
-            else:
-                # Fallback to original media type if preference is invalid
-                logger.warning(f"Invalid preference: {user_media_preference}, using original: {media_type}")
-                if media_type == "document":
-                    await client.send_document(document=file_path, **upload_params)
-                elif media_type == "video":
-                    await client.send_video(video=file_path, **upload_params)
-                elif media_type == "audio":
-                    await client.send_audio(audio=file_path, **upload_params)
+            # Retries resend the message without uploading the file again
+            budget = transfer.RetryBudget(on_retry=trace.retry)
+            async with pipeline_job.stage("upload", on_wait=partial(msg.edit, "**Waiting for an upload slot...**", reply_markup=CANCEL_BUTTON)):
+                with trace.stage("upload", bytes=os.path.getsize(file_path)):
+                    if user_media_preference == "document":
+                        await transfer.send(client.send_document, budget, document=file_path, **upload_params)
+                    elif user_media_preference == "video":
+                        await transfer.send(client.send_video, budget, video=file_path, **upload_params)
+                    elif user_media_preference == "audio":
+                        await transfer.send(client.send_audio, budget, audio=file_path, **upload_params)
 
             await msg.delete()
+            status = "done"
         except Exception as e:
             await msg.edit(f"Upload failed: {e}")
             raise
 
+    except asyncio.CancelledError:
+        if cancel_registry.interrupted():
+            # Restart deadline or lost lease: keep the lock and journal entry, the job resumes after it
+            status = "interrupted"
+            if msg and cancel_registry.draining:
+                await msg.edit("**Bot is restarting, your file will be renamed right after...**")
+            raise
+        # Cancel button: the transfer or ffmpeg process was aborted at its next await
+        status = "cancelled"
+        logger.info(f"Rename of {message.chat.id}:{message.id} cancelled")
+        if msg:
+            await msg.edit("**Cancelled.**")
+        raise
     except Exception as e:
         logger.error(f"Processing error: {e}")
         await message.reply_text(f"Error: {str(e)}")
+        if Config.BOT_MODE == "worker":
+            # The queue retries it up to JOB_MAX_ATTEMPTS times and releases the lock after the last
+            status = "retry"
+            raise
     finally:
+        # Nothing may still be writing into the job directory once it is removed
+        pending = [task for task in (settings, thumb_task) if task]
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        pipeline_job.close()
+        trace.set(pipeline_wait=pipeline_job.waited)
+        if fair_ticket:
+            fair_ticket.close()
+            trace.set(fair_wait=fair_ticket.waited)
+        if msg:
+            cancel_registry.unregister(message.chat.id, msg.id)
         # Clean up files - safe to pass None values
         await cleanup_files(download_path, metadata_path, thumb_path)
-        renaming_operations.pop(file_id, None)
+        for path in (download_path, metadata_path):
+            if path:
+                shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+        if lock_owner and status not in ("interrupted", "retry"):
+            await job_queue.release_lock(file_unique_id, lock_owner)
+            if journaled:
+                await journal.remove(lock_owner)
+        trace.finish("failed" if status == "retry" else status)
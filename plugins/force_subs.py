@@ -3,6 +3,7 @@ from pyrogram import Client, filters
 from pyrogram.types import InlineKeyboardButton, InlineKeyboardMarkup, CallbackQuery
 from pyrogram.errors import UserNotParticipant
 from config import Config
+from helper.assets import assets
 
 FORCE_SUB_CHANNELS = Config.FORCE_SUB_CHANNELS
 IMAGE_URL = "https://i.ibb.co/gFQFknCN/d8a33273f73c.jpg"
@@ -45,8 +46,9 @@ async def forces_sub(client, message):
     )
 
     text = "**ʙᴀᴋᴋᴀ!!, ʏᴏᴜ'ʀᴇ ɴᴏᴛ ᴊᴏɪɴᴇᴅ ᴛᴏ ᴀʟʟ ʀᴇǫᴜɪʀᴇᴅ ᴄʜᴀɴɴᴇʟs, ᴊᴏɪɴ ᴛʜᴇ ᴜᴘᴅᴀᴛᴇ ᴄʜᴀɴɴᴇʟs ᴛᴏ ᴄᴏɴᴛɪɴᴜᴇ**"
-    await message.reply_photo(
-        photo=IMAGE_URL,
+    await assets.send_photo(
+        message.reply_photo,
+        IMAGE_URL,
         caption=text,
         reply_markup=InlineKeyboardMarkup(buttons)
     )
@@ -1,15 +1,12 @@
 from pyrogram import Client, filters
+import math
 import datetime
 import pytz
 from helper.database import codeflixbots
+from helper.fair_scheduler import rename_scheduler, weights
 import logging
 from config import Config
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
 logger = logging.getLogger(__name__)
 
 # Command to add premium user
@@ -296,3 +293,81 @@ async def list_premium_users(client, message):
     except Exception as e:
         logger.error(f"Error in list_premium_users: {e}")
         await message.reply_text(f"❌ An error occurred: {str(e)}")
+
+
+# Fair queuing: how big a share of the bot each tier or user gets
+@Client.on_message(filters.command("setweight") & filters.user(Config.BOT_OWNER))
+async def set_weight_command(client, message):
+    """Set the weight of a tier, or of a single user"""
+    try:
+        usage = (
+            "**Usage:** `/setweight [tier/userid] [weight]`\n\n"
+            "**Examples:**\n"
+            "- `/setweight premium 2` (premium files get twice the share of free ones)\n"
+            "- `/setweight 123456789 4` (this user's own weight, over their tier's)\n"
+            "- `/setweight 123456789 reset` (back to their tier's weight)"
+        )
+        command_parts = message.text.split()
+        if len(command_parts) != 3:
+            return await message.reply_text(usage)
+
+        target, value = command_parts[1].lower(), command_parts[2].lower()
+        weight = None if value == "reset" and target.isdigit() else float(value)
+        # nan and inf parse too, either would break the fair queue's ordering
+        if weight is not None and (not math.isfinite(weight) or weight <= 0):
+            return await message.reply_text(f"❌ Weight must be a number above 0\n\n{usage}")
+
+        if target.isdigit():
+            await codeflixbots.set_weight(int(target), weight)
+            text = f"User ID: `{target}` back to their tier's weight" if weight is None else f"User ID: `{target}` now weighs `{weight:g}`"
+        else:
+            await weights.set(target, weight)
+            text = f"Tier `{target}` now weighs `{weight:g}`"
+        await message.reply_text(f"✅ {text}")
+
+    except ValueError:
+        await message.reply_text("❌ Weight must be a number")
+    except Exception as e:
+        logger.error(f"Error in set_weight_command: {e}")
+        await message.reply_text(f"❌ An error occurred: {str(e)}")
+
+
+@Client.on_message(filters.command("settier") & filters.user(Config.BOT_OWNER))
+async def set_tier_command(client, message):
+    """Put a user in a tier, reset puts them back in free/premium by their plan"""
+    try:
+        command_parts = message.text.split()
+        if len(command_parts) != 3 or not command_parts[1].isdigit():
+            return await message.reply_text(
+                "**Usage:** `/settier [userid] [tier/reset]`\n\n"
+                "Tiers and their weights are listed by /weights."
+            )
+
+        user_id, tier = int(command_parts[1]), command_parts[2].lower()
+        if tier == "reset":
+            await codeflixbots.set_tier(user_id, None)
+            return await message.reply_text(f"✅ User ID: `{user_id}` back in the tier of their plan")
+        if tier not in weights.tiers:
+            return await message.reply_text(f"❌ Unknown tier, give it a weight first: `/setweight {tier} [weight]`")
+        await codeflixbots.set_tier(user_id, tier)
+        await message.reply_text(f"✅ User ID: `{user_id}` is now in tier `{tier}` (weight `{weights.tiers[tier]:g}`)")
+
+    except Exception as e:
+        logger.error(f"Error in set_tier_command: {e}")
+        await message.reply_text(f"❌ An error occurred: {str(e)}")
+
+
+@Client.on_message(filters.command("weights") & filters.user(Config.BOT_OWNER))
+async def weights_command(client, message):
+    """Tier weights and who is holding rename slots right now"""
+    stats = rename_scheduler.stats()
+    tiers = "\n".join(f"- `{tier}` : `{weight:g}`" for tier, weight in sorted(weights.tiers.items()))
+    running = "\n".join(
+        f"- `{user_id}` : `{count}`" for user_id, count in sorted(rename_scheduler.running.items(), key=lambda item: -item[1])[:10]
+    )
+    await message.reply_text(
+        f"**Tier weights:**\n{tiers}\n\n"
+        f"**Renames :** `{stats['running']}/{stats['slots']}` running, `{stats['waiting']}` waiting, "
+        f"at most `{rename_scheduler.per_user}` per user\n"
+        + (f"\n**Running per user:**\n{running}" if running else "")
+    )
@@ -1,17 +1,28 @@
 import asyncio
+import logging
 from pyrogram import Client, filters
+from pyrogram.errors import FloodWait, MessageIdInvalid
 from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, Message
 import re
-from collections import defaultdict
-from pymongo import MongoClient
+from functools import partial
+from collections import defaultdict, deque
 from datetime import datetime
 from config import Config
+from helper.database import codeflixbots
+from helper.trace import JobTrace
+from helper.transfer import RetryBudget
+from helper.adaptive_limit import delivery_limit
+from helper.fair_scheduler import sequence_scheduler, weights
+from helper.memstat import track
+
+logger = logging.getLogger(__name__)
 
 # Database setup
-db_client = MongoClient(Config.DB_URL)
-db = db_client[Config.DB_NAME]
-users_collection = db["users_sequence"]
-sequence_collection = db["active_sequences"]  # Simplified collection name
+users_collection = codeflixbots.sequence_users
+sequence_collection = codeflixbots.sequences
+
+# Names shown in the live summary of a sequence session
+RECENT_NAMES = 5
 
 # Patterns for extracting episode numbers
 patterns = [
@@ -33,21 +44,108 @@ def extract_episode_number(filename):
             return int(match.groups()[-1])
     return float('inf')  
 
-def is_in_sequence_mode(user_id):
+async def is_in_sequence_mode(user_id):
     """Check if user is in sequence mode"""
-    return sequence_collection.find_one({"user_id": user_id}) is not None
+    if user_id in sequence_acks:
+        return True
+    return await sequence_collection.find_one({"user_id": user_id}, {"_id": 1}) is not None
+
+
+class SequenceAck:
+    """Files of a sequence session not yet written, and the one message acknowledging them.
+
+    A forwarded batch arrives as one update per file. They are buffered
+    here and every SEQUENCE_ACK_INTERVAL seconds written with a single
+    $push and reported by editing the same summary message.
+    """
+
+    def __init__(self, chat_id):
+        self.chat_id = chat_id
+        self.pending = []
+        self.count = 0
+        self.recent = deque(maxlen=RECENT_NAMES)
+        self.message = None
+        self.shown = None
+        self.timer = None
+        self.lock = asyncio.Lock()
+
+    def add(self, file_info):
+        self.pending.append(file_info)
+        self.count += 1
+        self.recent.append(file_info["filename"])
+
+    def text(self):
+        names = "\n".join(f"• {name}" for name in self.recent)
+        more = f"\n• ... and {self.count - len(self.recent)} more" if self.count > len(self.recent) else ""
+        return f"📂 Added to sequence: {self.count} file(s)\n\n{names}{more}\n\nSend more or use /endsequence."
+
+
+# user_id -> SequenceAck of the running session
+sequence_acks = {}
+track("sequence acks", lambda: sequence_acks)
+
+def schedule_ack(client, user_id, delay=None):
+    ack = sequence_acks[user_id]
+    if ack.timer is None:
+        ack.timer = asyncio.create_task(_ack_later(client, user_id, delay or Config.SEQUENCE_ACK_INTERVAL))
+
+async def _ack_later(client, user_id, delay):
+    await asyncio.sleep(delay)
+    ack = sequence_acks.get(user_id)
+    if ack is None:
+        return
+    # From here on the flush must not be cancelled, it owns the pending files
+    ack.timer = None
+    try:
+        await flush_sequence(client, user_id)
+    except Exception as e:
+        logger.error(f"Error acknowledging sequence files for {user_id}: {e}")
+
+async def flush_sequence(client, user_id, final=False):
+    """Write buffered files and bring the summary up to date, `final` ends the session's buffering"""
+    ack = sequence_acks.get(user_id)
+    if ack is None:
+        return
+    if final:
+        sequence_acks.pop(user_id, None)
+        if ack.timer:
+            ack.timer.cancel()
+    async with ack.lock:
+        files, ack.pending = ack.pending, []
+        if files:
+            await sequence_collection.update_one(
+                {"user_id": user_id},
+                {"$push": {"files": {"$each": files}}}
+            )
+        text = ack.text()
+        if text == ack.shown:
+            return
+        try:
+            if ack.message is not None:
+                try:
+                    await ack.message.edit_text(text)
+                except MessageIdInvalid:
+                    # The user deleted the summary, post a fresh one
+                    ack.message = None
+            if ack.message is None:
+                ack.message = await client.send_message(ack.chat_id, text)
+            ack.shown = text
+        except FloodWait as e:
+            # The summary is cosmetic, catch up once the wait is over
+            if not final:
+                schedule_ack(client, user_id, e.value)
 
 @Client.on_message(filters.private & filters.command("startsequence"))
 async def start_sequence(client, message):
     user_id = message.from_user.id
     
     # Check if already in sequence mode
-    if is_in_sequence_mode(user_id):
+    if await is_in_sequence_mode(user_id):
         await message.reply_text("⚠️ Sequence mode is already active. Send your files or use /endsequence.")
         return
         
     # Create new sequence entry
-    sequence_collection.insert_one({
+    await sequence_collection.insert_one({
         "user_id": user_id,
         "files": [],
         "started_at": datetime.now()
@@ -55,47 +153,70 @@ async def start_sequence(client, message):
     
     await message.reply_text("✅ Sequence mode started! Send your files now.")
 
+async def deliver(client, chat_id, file, budget):
+    """Copy one sequenced file to `chat_id`, waiting out FloodWaits instead of skipping it.
+
+    Files of one sequence still go out one at a time to keep their order,
+    `delivery_limit` caps how many sequences deliver at once.
+    """
+    while True:
+        try:
+            async with delivery_limit.slot():
+                await client.copy_message(chat_id=chat_id, from_chat_id=file["chat_id"], message_id=file["msg_id"])
+            delivery_limit.add(1)
+            return
+        except FloodWait as e:
+            delivery_limit.record_error(e)
+            await budget.wait(e)
+
 @Client.on_message(filters.private & filters.command("endsequence"))
 async def end_sequence(client, message):
     user_id = message.from_user.id
+    await flush_sequence(client, user_id, final=True)
     
     # Get sequence data
-    sequence_data = sequence_collection.find_one({"user_id": user_id})
+    sequence_data = await sequence_collection.find_one({"user_id": user_id})
     
     if not sequence_data or not sequence_data.get("files"):
         await message.reply_text("❌ No files in sequence!")
         return
     
+    trace = JobTrace("sequence", user_id, message.id)
+
     # Get files and sort them
     files = sequence_data.get("files", [])
-    sorted_files = sorted(files, key=lambda x: extract_episode_number(x["filename"]))
+    with trace.stage("sort", files=len(files)):
+        sorted_files = sorted(files, key=lambda x: extract_episode_number(x["filename"]))
     total = len(sorted_files)
+    trace.set(file_count=total)
     
     # Send progress message
     progress = await message.reply_text(f"⏳ Processing and sorting {total} files...")
     
     sent_count = 0
     
-    # Send files in sequence
-    for i, file in enumerate(sorted_files, 1):
-        try:
-            await client.copy_message(
-                chat_id=message.chat.id, 
-                from_chat_id=file["chat_id"], 
-                message_id=file["msg_id"]
-            )
-            sent_count += 1
-            
-            # Update progress every 5 files
-            if i % 5 == 0:
-                await progress.edit_text(f"📤 Sent {i}/{total} files...")
-            
-            await asyncio.sleep(0.5)  # Add delay to prevent flooding
-        except Exception as e:
-            print(f"Error sending file: {e}")
+    # Shorter sequences and heavier tiers go first when every slot is delivering
+    tier, weight = await weights.of(user_id)
+    trace.set(tier=tier)
+    async with sequence_scheduler.slot(user_id, weight, total, on_wait=partial(progress.edit_text, f"⏳ Queued, {total} files will be sent shortly...")) as ticket:
+        trace.set(fair_wait=ticket.waited)
+        # Send files in sequence
+        with trace.stage("deliver", files=total) as deliver_stage:
+            for i, file in enumerate(sorted_files, 1):
+                try:
+                    await deliver(client, message.chat.id, file, RetryBudget(on_retry=trace.retry))
+                    sent_count += 1
+                    
+                    # Update progress every 5 files
+                    if i % 5 == 0:
+                        await progress.edit_text(f"📤 Sent {i}/{total} files...")
+                    
+                except Exception as e:
+                    logger.error(f"Error sending {file['filename']} in the sequence of {user_id}: {e}")
+            deliver_stage["sent"] = sent_count
     
     # Update user stats
-    users_collection.update_one(
+    await users_collection.update_one(
         {"user_id": user_id},
         {"$inc": {"files_sequenced": sent_count}, 
          "$set": {"username": message.from_user.first_name}},
@@ -103,9 +224,15 @@ async def end_sequence(client, message):
     )
     
     # Remove sequence data
-    sequence_collection.delete_one({"user_id": user_id})
+    await sequence_collection.delete_one({"user_id": user_id})
+    trace.finish("done" if sent_count == total else "partial")
     
-    await progress.edit_text(f"✅ Successfully sent {sent_count} files in sequence!")
+    done = f"✅ Successfully sent {sent_count} files in sequence!"
+    try:
+        await progress.edit_text(done)
+    except MessageIdInvalid:
+        # The progress message was deleted while the files went out
+        await message.reply_text(done)
 
 # File handler with higher group priority to ensure it runs before rename handler
 @Client.on_message(filters.private & (filters.document | filters.video | filters.audio), group=0)
@@ -113,7 +240,7 @@ async def sequence_file_handler(client, message):
     user_id = message.from_user.id
     
     # Check if user is in sequence mode
-    if is_in_sequence_mode(user_id):
+    if await is_in_sequence_mode(user_id):
         # Get file name based on media type
         if message.document:
             file_name = message.document.file_name
@@ -132,23 +259,27 @@ async def sequence_file_handler(client, message):
             "added_at": datetime.now()
         }
         
-        # Add to sequence collection
-        sequence_collection.update_one(
-            {"user_id": user_id},
-            {"$push": {"files": file_info}}
-        )
+        # Buffered, written and acknowledged together with the rest of the burst
+        ack = sequence_acks.get(user_id)
+        if ack is None:
+            ack = sequence_acks[user_id] = SequenceAck(message.chat.id)
+        ack.add(file_info)
+        schedule_ack(client, user_id)
         
         # Set flag to indicate this is for sequence
         message.stop_propagation()
-        
-        await message.reply_text(f"📂 Added to sequence: {file_name}")
 
 @Client.on_message(filters.private & filters.command("cancelsequence"))
 async def cancel_sequence(client, message):
     user_id = message.from_user.id
     
+    # Drop buffered files with the rest of the session
+    ack = sequence_acks.pop(user_id, None)
+    if ack and ack.timer:
+        ack.timer.cancel()
+
     # Remove sequence data
-    result = sequence_collection.delete_one({"user_id": user_id})
+    result = await sequence_collection.delete_one({"user_id": user_id})
     
     if result.deleted_count > 0:
         await message.reply_text("❌ Sequence mode cancelled. All queued files have been cleared.")
@@ -158,9 +289,10 @@ async def cancel_sequence(client, message):
 @Client.on_message(filters.private & filters.command("showsequence"))
 async def show_sequence(client, message):
     user_id = message.from_user.id
+    await flush_sequence(client, user_id)
     
     # Get sequence data
-    sequence_data = sequence_collection.find_one({"user_id": user_id})
+    sequence_data = await sequence_collection.find_one({"user_id": user_id})
     
     if not sequence_data or not sequence_data.get("files"):
         await message.reply_text("No files in current sequence.")
@@ -183,7 +315,7 @@ async def show_sequence(client, message):
 
 @Client.on_message(filters.command("leaderboard"))
 async def leaderboard(client, message):
-    top_users = list(users_collection.find().sort("files_sequenced", -1).limit(5))
+    top_users = await users_collection.find().sort("files_sequenced", -1).limit(5).to_list(5)
     
     if not top_users:
         await message.reply_text("No data available in the leaderboard yet!")
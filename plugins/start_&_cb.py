@@ -1,13 +1,64 @@
 import random
 import asyncio
+from functools import partial
 from pyrogram import Client, filters
 from pyrogram.types import Message, InlineKeyboardButton, InlineKeyboardMarkup, CallbackQuery
 
 from helper.database import codeflixbots
+from helper.assets import assets
 from config import *
 from config import Config
 from config import Txt
 
+SUPPORT_URL = 'https://t.me/weebs_union'
+OWNER_URL = 'https://t.me/union_owner'
+PREMIUM_PIC = 'https://i.ibb.co/S7vgk8Hj/c8d9f3039813.jpg'
+
+# Keyboards are immutable, build them once instead of on every callback
+START_BUTTONS = InlineKeyboardMarkup([
+    [InlineKeyboardButton("• ᴍʏ ᴀʟʟ ᴄᴏᴍᴍᴀɴᴅs •", callback_data='help')],
+    [InlineKeyboardButton("• ᴘʀᴇᴍɪᴜᴍ •", callback_data='premiumx')],
+    [InlineKeyboardButton('• ᴜᴘᴅᴀᴛᴇs', url='https://t.me/+Union_Botss'), InlineKeyboardButton('sᴜᴘᴘᴏʀᴛ •', url='https://t.me/weebs_Union')],
+    [InlineKeyboardButton('• ᴀʙᴏᴜᴛ', callback_data='about')]
+])
+HOME_BUTTONS = InlineKeyboardMarkup([
+    [InlineKeyboardButton("• ᴍʏ ᴀʟʟ ᴄᴏᴍᴍᴀɴᴅs •", callback_data='help')],
+    [InlineKeyboardButton("• ᴘʀᴇᴍɪᴜᴍ •", callback_data='premiumx')],
+    [InlineKeyboardButton('• ᴜᴘᴅᴀᴛᴇs', url='https://t.me/Union_Association'), InlineKeyboardButton('sᴜᴘᴘᴏʀᴛ •', url=SUPPORT_URL)],
+    [InlineKeyboardButton('• ᴀʙᴏᴜᴛ', callback_data='about'), InlineKeyboardButton('sᴏᴜʀᴄᴇ •', callback_data='source')]
+])
+HELP_BUTTONS = InlineKeyboardMarkup([
+    [InlineKeyboardButton("• ᴀᴜᴛᴏ ʀᴇɴᴀᴍᴇ ғᴏʀᴍᴀᴛ •", callback_data='file_names')],
+    [InlineKeyboardButton("• sᴇǫᴜᴇɴᴄᴇ ғɪʟᴇs •", callback_data='sequence_help')],
+    [InlineKeyboardButton('• ᴛʜᴜᴍʙɴᴀɪʟ', callback_data='thumbnail'), InlineKeyboardButton('ᴄᴀᴘᴛɪᴏɴ •', callback_data='caption')],
+    [InlineKeyboardButton('• ᴍᴇᴛᴀᴅᴀᴛᴀ', callback_data='meta'), InlineKeyboardButton('ᴅᴏɴᴀᴛᴇ •', callback_data='donate')],
+    [InlineKeyboardButton('• ʜᴏᴍᴇ', callback_data='home')]
+])
+CLOSE_HELP_BUTTONS = InlineKeyboardMarkup([
+    [InlineKeyboardButton("• ᴄʟᴏsᴇ", callback_data="close"), InlineKeyboardButton("ʙᴀᴄᴋ •", callback_data="help")]
+])
+CAPTION_BUTTONS = InlineKeyboardMarkup([
+    [InlineKeyboardButton("• sᴜᴘᴘᴏʀᴛ", url=SUPPORT_URL), InlineKeyboardButton("ʙᴀᴄᴋ •", callback_data="help")]
+])
+DONATE_BUTTONS = InlineKeyboardMarkup([
+    [InlineKeyboardButton("• ʙᴀᴄᴋ", callback_data="help"), InlineKeyboardButton("ᴏᴡɴᴇʀ •", url='https://t.me/Union_Owner')]
+])
+SOURCE_BUTTONS = InlineKeyboardMarkup([
+    [InlineKeyboardButton("• ᴄʟᴏsᴇ", callback_data="close"), InlineKeyboardButton("ʙᴀᴄᴋ •", callback_data="home")]
+])
+PREMIUM_BUTTONS = InlineKeyboardMarkup([
+    [InlineKeyboardButton("• ᴘʟᴀɴs •", callback_data='plans')],
+    [InlineKeyboardButton("• ʙᴀᴄᴋ", callback_data="help"), InlineKeyboardButton("ʙᴜʏ ᴘʀᴇᴍɪᴜᴍ •", url=OWNER_URL)]
+])
+PLANS_BUTTONS = InlineKeyboardMarkup([
+    [InlineKeyboardButton("• ᴄʟᴏsᴇ", callback_data="close"), InlineKeyboardButton("ʙᴜʏ ᴘʀᴇᴍɪᴜᴍ •", url=OWNER_URL)]
+])
+ABOUT_BUTTONS = InlineKeyboardMarkup([
+    [InlineKeyboardButton("• sᴜᴘᴘᴏʀᴛ", url=SUPPORT_URL), InlineKeyboardButton("ᴄᴏᴍᴍᴀɴᴅs •", callback_data="help")],
+    [InlineKeyboardButton("• ᴅᴇᴠᴇʟᴏᴘᴇʀ", url=OWNER_URL), InlineKeyboardButton("ɴᴇᴛᴡᴏʀᴋ •", url='https://t.me/Union_Association')],
+    [InlineKeyboardButton("• ʙᴀᴄᴋ •", callback_data="home")]
+])
+
 # Start Command Handler
 @Client.on_message(filters.private & filters.command("start"))
 async def start(client, message: Message):
@@ -28,167 +79,72 @@ async def start(client, message: Message):
     # Send sticker after the text sequence
     await message.reply_sticker("CAACAgQAAxkBAAIOsGf5RIq9Zodm25_NfFJGKNFNFJv5AALHGAACukfIUwkk20UPuRnvNgQ")
 
-    # Define buttons for the start message
-    buttons = InlineKeyboardMarkup([
-        [
-            InlineKeyboardButton("• ᴍʏ ᴀʟʟ ᴄᴏᴍᴍᴀɴᴅs •", callback_data='help')
-        ],
-        
-        [
-            InlineKeyboardButton("• ᴘʀᴇᴍɪᴜᴍ •", callback_data='premiumx')
-        ],
-        
-        [
-            InlineKeyboardButton('• ᴜᴘᴅᴀᴛᴇs', url='https://t.me/+Union_Botss'),
-            InlineKeyboardButton('sᴜᴘᴘᴏʀᴛ •', url='https://t.me/weebs_Union')
-        ],
-        [
-            InlineKeyboardButton('• ᴀʙᴏᴜᴛ', callback_data='about')
-            #InlineKeyboardButton('sᴏᴜʀᴄᴇ •', callback_data='source')
-        ]
-    ])
-
     # Send start message with or without picture
     if Config.START_PIC:
-        await message.reply_photo(
+        await assets.send_photo(
+            message.reply_photo,
             Config.START_PIC,
             caption=Txt.START_TXT.format(user.mention),
-            reply_markup=buttons
+            reply_markup=START_BUTTONS
         )
     else:
         await message.reply_text(
             text=Txt.START_TXT.format(user.mention),
-            reply_markup=buttons,
+            reply_markup=START_BUTTONS,
             disable_web_page_preview=True
         )
 
 
-# Callback Query Handler
-@Client.on_callback_query()
+async def show_page(text, buttons, client, query):
+    """Swap the menu page in place, photo messages only have a caption to edit"""
+    if query.message.photo:
+        await query.message.edit_caption(caption=text, reply_markup=buttons)
+    else:
+        await query.message.edit_text(text=text, reply_markup=buttons, disable_web_page_preview=True)
+
+async def home(client, query):
+    await show_page(Txt.START_TXT.format(query.from_user.mention), HOME_BUTTONS, client, query)
+
+async def file_names(client, query):
+    format_template = await codeflixbots.get_format_template(query.from_user.id)
+    await show_page(Txt.FILE_NAME_TXT.format(format_template=format_template), CLOSE_HELP_BUTTONS, client, query)
+
+async def close(client, query):
+    try:
+        await query.message.delete()
+        await query.message.reply_to_message.delete()
+        await query.message.continue_propagation()
+    except:
+        await query.message.delete()
+        await query.message.continue_propagation()
+
+PAGES = {
+    "help": (Txt.HELP_TXT, HELP_BUTTONS),
+    "caption": (Txt.CAPTION_TXT, CAPTION_BUTTONS),
+    "meta": (Txt.SEND_METADATA, CLOSE_HELP_BUTTONS),
+    "metadatax": (Txt.SEND_METADATA, CLOSE_HELP_BUTTONS),
+    "donate": (Txt.DONATE_TXT, DONATE_BUTTONS),
+    "thumbnail": (Txt.THUMBNAIL_TXT, CLOSE_HELP_BUTTONS),
+    "sequence_help": (Txt.SEQUENCE_TXT, CLOSE_HELP_BUTTONS),
+    "source": (Txt.SOURCE_TXT, SOURCE_BUTTONS),
+    "premiumx": (Txt.PREMIUM_TXT, PREMIUM_BUTTONS),
+    "plans": (Txt.PREPLANS_TXT, PLANS_BUTTONS),
+    "about": (Txt.ABOUT_TXT, ABOUT_BUTTONS),
+}
+
+# callback_data -> handler(client, query)
+CALLBACKS = {
+    **{data: partial(show_page, text, buttons) for data, (text, buttons) in PAGES.items()},
+    "home": home,
+    "file_names": file_names,
+    "close": close,
+    "close_data": close,
+}
+
+# Callback Query Handler, only claims its own buttons so other plugins' callbacks never depend on load order
+@Client.on_callback_query(filters.create(lambda _, __, query: query.data in CALLBACKS))
 async def cb_handler(client, query: CallbackQuery):
-    data = query.data
-    user_id = query.from_user.id
-
-    print(f"Callback data received: {data}")  # Debugging line
-
-    if data == "home":
-        await query.message.edit_text(
-            text=Txt.START_TXT.format(query.from_user.mention),
-            disable_web_page_preview=True,
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("• ᴍʏ ᴀʟʟ ᴄᴏᴍᴍᴀɴᴅs •", callback_data='help')],
-                [InlineKeyboardButton("• ᴘʀᴇᴍɪᴜᴍ •", callback_data='premiumx')],
-                [InlineKeyboardButton('• ᴜᴘᴅᴀᴛᴇs', url='https://t.me/Union_Association'), InlineKeyboardButton('sᴜᴘᴘᴏʀᴛ •', url='https://t.me/weebs_union')],
-                [InlineKeyboardButton('• ᴀʙᴏᴜᴛ', callback_data='about'), InlineKeyboardButton('sᴏᴜʀᴄᴇ •', callback_data='source')]
-            ])
-        )
-    elif data == "caption":
-        await query.message.edit_text(
-            text=Txt.CAPTION_TXT,
-            disable_web_page_preview=True,
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("• sᴜᴘᴘᴏʀᴛ", url='https://t.me/weebs_union'), InlineKeyboardButton("ʙᴀᴄᴋ •", callback_data="help")]
-            ])
-        )
-
-    elif data == "help":
-        await query.message.edit_text(
-            text=Txt.HELP_TXT,
-            disable_web_page_preview=True,
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("• ᴀᴜᴛᴏ ʀᴇɴᴀᴍᴇ ғᴏʀᴍᴀᴛ •", callback_data='file_names')],
-                [InlineKeyboardButton("• sᴇǫᴜᴇɴᴄᴇ ғɪʟᴇs •", callback_data='sequence_help')],
-                [InlineKeyboardButton('• ᴛʜᴜᴍʙɴᴀɪʟ', callback_data='thumbnail'), InlineKeyboardButton('ᴄᴀᴘᴛɪᴏɴ •', callback_data='caption')],
-                [InlineKeyboardButton('• ᴍᴇᴛᴀᴅᴀᴛᴀ', callback_data='meta'), InlineKeyboardButton('ᴅᴏɴᴀᴛᴇ •', callback_data='donate')],
-                [InlineKeyboardButton('• ʜᴏᴍᴇ', callback_data='home')]
-            ])
-        )
-
-    elif data == "meta":
-        await query.message.edit_text(
-            text=Txt.SEND_METADATA,
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("• ᴄʟᴏsᴇ", callback_data="close"), InlineKeyboardButton("ʙᴀᴄᴋ •", callback_data="help")]
-            ])
-        )
-    elif data == "donate":
-        await query.message.edit_text(
-            text=Txt.DONATE_TXT,
-            disable_web_page_preview=True,
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("• ʙᴀᴄᴋ", callback_data="help"), InlineKeyboardButton("ᴏᴡɴᴇʀ •", url='https://t.me/Union_Owner')]
-            ])
-        )
-    elif data == "file_names":
-        format_template = await codeflixbots.get_format_template(user_id)
-        await query.message.edit_text(
-            text=Txt.FILE_NAME_TXT.format(format_template=format_template),
-            disable_web_page_preview=True,
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("• ᴄʟᴏsᴇ", callback_data="close"), InlineKeyboardButton("ʙᴀᴄᴋ •", callback_data="help")]
-            ])
-        )
-    elif data == "thumbnail":
-        await query.message.edit_caption(
-            caption=Txt.THUMBNAIL_TXT,
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("• ᴄʟᴏsᴇ", callback_data="close"), InlineKeyboardButton("ʙᴀᴄᴋ •", callback_data="help")]
-            ])
-        )
-    elif data == "sequence_help":
-        await query.message.edit_caption(
-            caption=Txt.SEQUENCE_TXT,
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("• ᴄʟᴏsᴇ", callback_data="close"), InlineKeyboardButton("ʙᴀᴄᴋ •", callback_data="help")]
-            ])
-        )
-    elif data == "metadatax":
-        await query.message.edit_caption(
-            caption=Txt.SEND_METADATA,
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("• ᴄʟᴏsᴇ", callback_data="close"), InlineKeyboardButton("ʙᴀᴄᴋ •", callback_data="help")]
-            ])
-        )
-    elif data == "source":
-        await query.message.edit_caption(
-            caption=Txt.SOURCE_TXT,
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("• ᴄʟᴏsᴇ", callback_data="close"), InlineKeyboardButton("ʙᴀᴄᴋ •", callback_data="home")]
-            ])
-        )
-    elif data == "premiumx":
-        await query.message.edit_caption(
-            caption=Txt.PREMIUM_TXT,
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("• ᴘʟᴀɴs •", callback_data='plans')],
-                [InlineKeyboardButton("• ʙᴀᴄᴋ", callback_data="help"), InlineKeyboardButton("ʙᴜʏ ᴘʀᴇᴍɪᴜᴍ •", url='https://t.me/union_owner')]
-            ])
-        )
-    elif data == "plans":
-        await query.message.edit_caption(
-            caption=Txt.PREPLANS_TXT,
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("• ᴄʟᴏsᴇ", callback_data="close"), InlineKeyboardButton("ʙᴜʏ ᴘʀᴇᴍɪᴜᴍ •", url='https://t.me/union_owner')]
-            ])
-        )
-    elif data == "about":
-        await query.message.edit_text(
-            text=Txt.ABOUT_TXT,
-            disable_web_page_preview=True,
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("• sᴜᴘᴘᴏʀᴛ", url='https://t.me/weebs_union'), InlineKeyboardButton("ᴄᴏᴍᴍᴀɴᴅs •", callback_data="help")],
-                [InlineKeyboardButton("• ᴅᴇᴠᴇʟᴏᴘᴇʀ", url='https://t.me/union_owner'), InlineKeyboardButton("ɴᴇᴛᴡᴏʀᴋ •", url='https://t.me/Union_Association')],
-                [InlineKeyboardButton("• ʙᴀᴄᴋ •", callback_data="home")]
-            ])
-        )
-    elif data == "close":
-        try:
-            await query.message.delete()
-            await query.message.reply_to_message.delete()
-            await query.message.continue_propagation()
-        except:
-            await query.message.delete()
-            await query.message.continue_propagation()
+    await CALLBACKS[query.data](client, query)
 
 # Donation Command Handler
 @Client.on_message(filters.command("donate"))
@@ -196,7 +152,7 @@ async def donation(client, message):
     buttons = InlineKeyboardMarkup([
         [InlineKeyboardButton(text="ʙᴀᴄᴋ", callback_data="help"), InlineKeyboardButton(text="ᴏᴡɴᴇʀ", url='https://t.me/Union_Owner')]
     ])
-    yt = await message.reply_photo(photo='https://i.ibb.co/S7vgk8Hj/c8d9f3039813.jpg', caption=Txt.DONATE_TXT, reply_markup=buttons)
+    yt = await assets.send_photo(message.reply_photo, PREMIUM_PIC, caption=Txt.DONATE_TXT, reply_markup=buttons)
     await asyncio.sleep(300)
     await yt.delete()
     await message.delete()
@@ -208,7 +164,7 @@ async def getpremium(bot, message):
         [InlineKeyboardButton("• ᴘʟᴀɴs •", callback_data='plans')],
         [InlineKeyboardButton("ᴏᴡɴᴇʀ", url="https://t.me/union_owner"), InlineKeyboardButton("ᴄʟᴏsᴇ", callback_data="close")]
     ])
-    yt = await message.reply_photo(photo='https://i.ibb.co/S7vgk8Hj/c8d9f3039813.jpg', caption=Txt.PREMIUM_TXT, reply_markup=buttons)
+    yt = await assets.send_photo(message.reply_photo, PREMIUM_PIC, caption=Txt.PREMIUM_TXT, reply_markup=buttons)
     await asyncio.sleep(300)
     await yt.delete()
     await message.delete()
@@ -219,7 +175,7 @@ async def premium(bot, message):
     buttons = InlineKeyboardMarkup([
         [InlineKeyboardButton("sᴇɴᴅ ss", url="https://t.me/union_owner"), InlineKeyboardButton("ᴄʟᴏsᴇ", callback_data="close")]
     ])
-    yt = await message.reply_photo(photo='https://i.ibb.co/S7vgk8Hj/c8d9f3039813.jpg', caption=Txt.PREPLANS_TXT, reply_markup=buttons)
+    yt = await assets.send_photo(message.reply_photo, PREMIUM_PIC, caption=Txt.PREPLANS_TXT, reply_markup=buttons)
     await asyncio.sleep(300)
     await yt.delete()
     await message.delete()
@@ -254,11 +210,5 @@ async def help_command(client, message):
     await message.reply_text(
         text=Txt.HELP_TXT,
         disable_web_page_preview=True,
-        reply_markup=InlineKeyboardMarkup([
-            [InlineKeyboardButton("• ᴀᴜᴛᴏ ʀᴇɴᴀᴍᴇ ғᴏʀᴍᴀᴛ •", callback_data='file_names')],
-            [InlineKeyboardButton("• sᴇǫᴜᴇɴᴄᴇ ғɪʟᴇs •", callback_data='sequence_help')],
-            [InlineKeyboardButton('• ᴛʜᴜᴍʙɴᴀɪʟ', callback_data='thumbnail'), InlineKeyboardButton('ᴄᴀᴘᴛɪᴏɴ •', callback_data='caption')],
-            [InlineKeyboardButton('• ᴍᴇᴛᴀᴅᴀᴛᴀ', callback_data='meta'), InlineKeyboardButton('ᴅᴏɴᴀᴛᴇ •', callback_data='donate')],
-            [InlineKeyboardButton('• ʜᴏᴍᴇ', callback_data='home')]
-        ])
+        reply_markup=HELP_BUTTONS
     )
@@ -1,4 +1,5 @@
 from aiohttp import web
+from helper.job_queue import job_queue
 
 routes = web.RouteTableDef()
 
@@ -7,6 +8,12 @@ async def root_route_handler(request):
     return web.json_response("Codeflix bots")
 
 
+@routes.get("/metrics")
+async def metrics_handler(request):
+    # Backlog gauge used for autoscaling the worker processes
+    return web.json_response(await job_queue.backlog())
+
+
 async def web_server():
     web_app = web.Application(client_max_size=30000000)
     web_app.add_routes(routes)